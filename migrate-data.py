@@ -1,150 +1,381 @@
 """
 No manual preprocessing is needed, just feed the algorithm the raw csv data given by the company.
 This script takes the lines available and migrates the provided data to the db.
+
+The file is parsed once, the missing ditte are inserted with multi-row statements and the
+dipendenti are inserted in batches, everything in a single transaction: either the whole file
+is imported or nothing is.
+
+With --sync the file is compared with the dipendenti already in the db instead, matching them on
+ditta, nome and cognome (ignoring case and spacing), and only the differences are written: the
+new dipendenti are inserted, the changed ones updated and, with --delete, the ones missing from
+the file deleted. --dry-run prints the changes without writing them.
+
+Usage: python migrate-data.py [data.csv] [--batch-size N] [--sync [--delete] [--dry-run]]
 """
 
 from python import fredbconn
+from python import data_versions
 from python import passwords
+import argparse
 import csv
-from datetime import datetime, date, timedelta
+from datetime import datetime
+
+DEFAULT_BATCH_SIZE = 1000
+
+# Fields compared by the sync, as (position in a parsed record, column of dipendenti)
+SYNC_FIELDS = (
+    (3, "note"),
+    (4, "scadenza_autorizzazione"),
+    (5, "is_badge_already_emesso"),
+    (6, "badge_sospeso"),
+)
+
+
+def normalize_name(nome):
+    """Key used to match a name of the file with the ones in the db, ignoring case and spacing"""
+    return " ".join(nome.split()).casefold()
+
+
+def natural_key(ditta, nome, cognome):
+    """Key identifying a dipendente across imports"""
+    return normalize_name(ditta), normalize_name(nome), normalize_name(cognome)
+
+
+def parse_date(scadenza_str):
+    """Parses a date in format DD/MM/YYYY or DD-MM-YYYY, None if empty or invalid"""
+    for date_format in ("%d/%m/%Y", "%d-%m-%Y"):
+        try:
+            return datetime.strptime(scadenza_str, date_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_data(data_file_path):
+    """Reads the raw csv given by the company.
+
+    Returns:
+        list: one tuple per dipendente with
+            (ditta, nome, cognome, note, scadenza_autorizzazione, is_badge_emesso, badge_sospeso)
+    """
+    records = []
+
+    with open(data_file_path, 'r', encoding='utf-8') as infile:
+        reader = csv.reader(infile, delimiter=';')
+
+        # Skip the first two header lines
+        next(reader, None)  # Skip header line 1
+        next(reader, None)  # Skip header line 2
+
+        for row in reader:
+            # Skip empty rows or rows with only separators/whitespace
+            if not any(field.strip() for field in row):
+                continue
+
+            # Extract relevant fields
+            ditta = row[0].strip('*').strip().strip('*')
+            nome = row[1].strip() if len(row) > 1 else ''
+            cognome = row[2].strip() if len(row) > 2 else ''
+            note = row[3].strip() if len(row) > 3 else ''
+            scadenza = row[4].strip() if len(row) > 4 else ''
+
+            # Map CSV fields to database fields directly
+            # - badge_valido in CSV maps to badge_sospeso in DB (direct mapping)
+            is_badge_emesso = 1 if len(row) > 5 and row[5].strip() == 'X' else 0
+            badge_sospeso = 1 if len(row) > 6 and row[6].strip() == 'X' else 0
+
+            records.append((
+                ditta,
+                nome,
+                cognome,
+                note,
+                parse_date(scadenza) if scadenza else None,
+                is_badge_emesso,
+                badge_sospeso
+            ))
+
+    return records
+
+
+def batches(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def fetch_ditte_ids(cursor):
+    """Maps the normalized name of every ditta in the db to its id"""
+    cursor.execute("SELECT id, nome FROM ditte")
+    ditte_ids = {}
+    for id_ditta, nome in cursor.fetchall():
+        # With duplicate names the oldest ditta wins, as the old per-row lookup did
+        ditte_ids.setdefault(normalize_name(nome), id_ditta)
+    return ditte_ids
+
+
+def insert_missing_ditte(cursor, names, ditte_ids, batch_size):
+    """Inserts the ditte not in ditte_ids with multi-row statements and adds their ids to it.
+
+    ditte.nome has no unique index, so the existing rows are matched in memory instead of with
+    INSERT ... ON DUPLICATE KEY UPDATE.
+
+    Returns:
+        int: number of ditte inserted
+    """
+    missing = []
+    seen = set()
+    for nome in names:
+        key = normalize_name(nome)
+        if key not in ditte_ids and key not in seen:
+            seen.add(key)
+            missing.append(nome)
+
+    for batch in batches(missing, batch_size):
+        cursor.execute(
+            "INSERT INTO ditte (nome) VALUES " + ", ".join(["(%s)"] * len(batch)),
+            batch
+        )
+
+    if missing:
+        ditte_ids.update(fetch_ditte_ids(cursor))
+
+    return len(missing)
+
+
+def insert_dipendenti(cursor, records, ditte_ids, batch_size):
+    """Inserts the parsed records with batched executemany, the ditte must be in ditte_ids"""
+    rows = [
+        (nome, cognome, ditte_ids[normalize_name(ditta)], is_badge_emesso, scadenza_autorizzazione,
+         1,  # accesso_bloccato (default: yes as per requirement)
+         badge_sospeso, note)
+        for ditta, nome, cognome, note, scadenza_autorizzazione, is_badge_emesso, badge_sospeso in records
+    ]
+
+    # pymysql rewrites executemany of an INSERT ... VALUES into multi-row statements
+    for batch in batches(rows, batch_size):
+        cursor.executemany("""
+        INSERT INTO dipendenti (
+            nome, 
+            cognome, 
+            ditta_id, 
+            is_badge_already_emesso, 
+            scadenza_autorizzazione, 
+            accesso_bloccato, 
+            badge_sospeso, 
+            note
+        )
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, batch)
+
+
+def import_data(records, batch_size=DEFAULT_BATCH_SIZE):
+    """Imports the parsed records in one transaction.
+
+    Returns:
+        tuple: (number of ditte inserted, number of dipendenti inserted)
+    """
+    @fredbconn.connected_to_database
+    def import_records(cursor):
+        ditte_ids = fetch_ditte_ids(cursor)
+        ditte_inserted = insert_missing_ditte(cursor, (record[0] for record in records), ditte_ids, batch_size)
+
+        insert_dipendenti(cursor, records, ditte_ids, batch_size)
+
+        data_versions.bump(cursor, "ditte", "dipendenti")
+
+        return ditte_inserted, len(records)
+
+    return import_records()
+
+
+class SyncChanges:
+    """Differences between the file and the db"""
+    def __init__(self):
+        self.ditte = []     # names of the ditte to add
+        self.inserts = []   # parsed records to insert
+        self.updates = []   # (id, record, {column: (old, new)})
+        self.deletes = []   # (id, ditta, nome, cognome)
+
+    def __bool__(self):
+        return bool(self.ditte or self.inserts or self.updates or self.deletes)
+
+
+def fetch_dipendenti(cursor):
+    """Maps the natural key of every dipendente in the db to its row.
+
+    With duplicates in the db the oldest dipendente is the one synced, the others count as
+    missing from the file.
+
+    Returns:
+        tuple: (dict natural key -> row, list of the duplicate rows)
+    """
+    cursor.execute("""
+    SELECT
+        dipendenti.id,
+        ditte.nome,
+        dipendenti.nome,
+        dipendenti.cognome,
+        dipendenti.note,
+        dipendenti.scadenza_autorizzazione,
+        dipendenti.is_badge_already_emesso,
+        dipendenti.badge_sospeso
+    FROM
+        dipendenti
+    JOIN
+        ditte ON dipendenti.ditta_id = ditte.id
+    ORDER BY
+        dipendenti.id
+    """)
+
+    dipendenti = {}
+    duplicates = []
+    for row in cursor.fetchall():
+        key = natural_key(row[1], row[2], row[3])
+        if key in dipendenti:
+            duplicates.append(row)
+        else:
+            dipendenti[key] = row
+    return dipendenti, duplicates
+
+
+def compute_changes(cursor, records, delete):
+    """Compares the parsed records with the db. When a dipendente is repeated in the file the last row wins."""
+    changes = SyncChanges()
+
+    ditte_ids = fetch_ditte_ids(cursor)
+    dipendenti, duplicates = fetch_dipendenti(cursor)
+
+    incoming = {}
+    for record in records:
+        incoming[natural_key(record[0], record[1], record[2])] = record
+
+    new_ditte = set()
+    for key, record in incoming.items():
+        row = dipendenti.get(key)
+
+        if row is None:
+            changes.inserts.append(record)
+            if key[0] not in ditte_ids and key[0] not in new_ditte:
+                new_ditte.add(key[0])
+                changes.ditte.append(record[0])
+            continue
+
+        # row has the id and the natural key first, the compared columns then follow in order
+        differences = {}
+        for (position, column), old in zip(SYNC_FIELDS, row[4:]):
+            new = record[position]
+            if (old or None) != (new or None):
+                differences[column] = (old, new)
+        if differences:
+            changes.updates.append((row[0], record, differences))
+
+    if delete:
+        for key, row in dipendenti.items():
+            if key not in incoming:
+                changes.deletes.append(row[:4])
+        changes.deletes.extend(row[:4] for row in duplicates)
+
+    return changes
+
+
+def apply_changes(cursor, changes, batch_size):
+    ditte_ids = fetch_ditte_ids(cursor)
+    insert_missing_ditte(cursor, changes.ditte, ditte_ids, batch_size)
+    insert_dipendenti(cursor, changes.inserts, ditte_ids, batch_size)
+
+    if changes.updates:
+        cursor.executemany(
+            "UPDATE dipendenti SET " + ", ".join(f"{column} = %s" for _, column in SYNC_FIELDS) + " WHERE id = %s",
+            [tuple(record[position] for position, _ in SYNC_FIELDS) + (id_dipendente,)
+             for id_dipendente, record, _ in changes.updates]
+        )
+
+    for batch in batches([row[0] for row in changes.deletes], batch_size):
+        cursor.execute(
+            "DELETE FROM dipendenti WHERE id IN (" + ", ".join(["%s"] * len(batch)) + ")",
+            batch
+        )
+
+    tables = ("ditte", "dipendenti") if changes.ditte else ("dipendenti",)
+    data_versions.bump(cursor, *tables)
+
+
+def sync_data(records, batch_size=DEFAULT_BATCH_SIZE, delete=False, dry_run=False):
+    """Writes only the differences between the parsed records and the db, in one transaction.
+
+    Returns:
+        SyncChanges: the changes, applied unless dry_run
+    """
+    @fredbconn.connected_to_database
+    def sync_records(cursor):
+        changes = compute_changes(cursor, records, delete)
+        if changes and not dry_run:
+            apply_changes(cursor, changes, batch_size)
+        return changes
+
+    return sync_records()
+
+
+def print_changes(changes):
+    for ditta in changes.ditte:
+        print(f"+ ditta {ditta}")
+    for record in changes.inserts:
+        print(f"+ {record[2]} {record[1]} ({record[0]})")
+    for _, record, differences in changes.updates:
+        details = ", ".join(f"{column}: {old!r} -> {new!r}" for column, (old, new) in differences.items())
+        print(f"~ {record[2]} {record[1]} ({record[0]}): {details}")
+    for _, ditta, nome, cognome in changes.deletes:
+        print(f"- {cognome} {nome} ({ditta})")
+
+    print(f"Ditte da aggiungere: {len(changes.ditte)}")
+    print(f"Dipendenti da aggiungere: {len(changes.inserts)}")
+    print(f"Dipendenti da aggiornare: {len(changes.updates)}")
+    print(f"Dipendenti da eliminare: {len(changes.deletes)}")
+
 
 def main():
-    data_file_path = 'data.csv'
-    temp_file_path = 'processed_data.csv'
-
-    def pre_process_data():
-        with open(data_file_path, 'r', encoding='utf-8') as infile, \
-            open(temp_file_path, 'w', encoding='utf-8', newline='') as outfile:
-
-            reader = csv.reader(infile, delimiter=';')
-            writer = csv.writer(outfile, delimiter=';')
-
-            # Skip the first two header lines
-            next(reader)  # Skip header line 1
-            next(reader)  # Skip header line 2
-            
-            for row in reader:
-                # Skip empty rows or rows with only separators/whitespace
-                if not any(field.strip() for field in row):
-                    continue
-
-                # Extract relevant fields
-                ditta = row[0].strip('*').strip().strip('*')
-                nome = row[1].strip() if len(row) > 1 and row[1].strip() else ''
-                cognome = row[2].strip() if len(row) > 2 and row[2].strip() else ''
-                note = row[3].strip() if len(row) > 3 and row[3].strip() else ''
-                
-                # New fields in the updated CSV
-                scadenza = row[4].strip() if len(row) > 4 and row[4].strip() else ''
-                badge_emesso = 'X' if len(row) > 5 and row[5].strip() == 'X' else ''
-                badge_valido = 'X' if len(row) > 6 and row[6].strip() == 'X' else ''
-                
-                # Write the processed row to the output file
-                writer.writerow([
-                    ditta,
-                    nome,
-                    cognome,
-                    note,
-                    scadenza,
-                    badge_emesso,
-                    badge_valido
-                ])
-    
-    def add_pre_processed_data_to_db():
-        with open(temp_file_path, 'r', encoding='utf-8') as infile:
-            reader = csv.reader(infile, delimiter=';')
-
-            ditte = set()
-
-            for row in reader:
-                ditte.add(row[0])
-
-            @fredbconn.connected_to_database
-            def aggiungi_ditta_to_db(cursor, ditta: str):
-                cursor.execute("""
-                INSERT INTO ditte (nome)
-                VALUES (%s)
-                """, (ditta,))
-            
-            for ditta in ditte:
-                aggiungi_ditta_to_db(ditta)
-
-        with open(temp_file_path, 'r', encoding='utf-8') as infile:
-            reader = csv.reader(infile, delimiter=';')
-
-            for row in reader:
-                ditta = row[0]
-                nome = row[1]
-                cognome = row[2]
-                note = row[3]
-                scadenza_str = row[4]
-                badge_emesso = row[5]
-                badge_valido = row[6]
-                
-                # Convert scadenza_str to a proper date if it exists
-                scadenza_autorizzazione = None
-                if scadenza_str:
-                    try:
-                        # Parse date in format DD/MM/YYYY
-                        scadenza_autorizzazione = datetime.strptime(scadenza_str, "%d/%m/%Y").date()
-                    except ValueError:
-                        # If parsing fails, try alternate format
-                        try:
-                            scadenza_autorizzazione = datetime.strptime(scadenza_str, "%d-%m-%Y").date()
-                        except ValueError:
-                            # If both fail, set to None
-                            scadenza_autorizzazione = None
-
-                @fredbconn.connected_to_database
-                def associa_nome_ditta_a_id(cursor, ditta):
-                    cursor.execute("""
-                    SELECT id
-                    FROM ditte
-                    WHERE nome = %s
-                    """, (ditta,))
-
-                    result = cursor.fetchone()
-                    return result[0] if result else None  # Extract the ID from the tuple
-                
-                id_ditta = associa_nome_ditta_a_id(ditta)
-
-                @fredbconn.connected_to_database
-                def add_dipendente_to_db(cursor):
-                    # Map CSV fields to database fields directly
-                    # - badge_valido in CSV maps to badge_sospeso in DB (direct mapping)
-                    # - accesso_bloccato in DB is set to 1 by default as per requirement
-                    
-                    is_badge_emesso = 1 if badge_emesso == 'X' else 0
-                    badge_sospeso = 1 if badge_valido == 'X' else 0  # Direct mapping as requested
-                    
-                    cursor.execute("""
-                    INSERT INTO dipendenti (
-                        nome, 
-                        cognome, 
-                        ditta_id, 
-                        is_badge_already_emesso, 
-                        scadenza_autorizzazione, 
-                        accesso_bloccato, 
-                        badge_sospeso, 
-                        note
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                    """, (
-                        nome, 
-                        cognome, 
-                        id_ditta, 
-                        is_badge_emesso,
-                        scadenza_autorizzazione,
-                        1,              # accesso_bloccato (default: yes as per requirement)
-                        badge_sospeso,  # Inverted from badge_valido
-                        note
-                    ))
-
-                add_dipendente_to_db()
-
-    pre_process_data()
-    add_pre_processed_data_to_db()
+    parser = argparse.ArgumentParser(description="Imports the csv of the dipendenti given by the company")
+    parser.add_argument("data_file", nargs="?", default="data.csv", help="csv file to import (default: data.csv)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help=f"rows per statement (default: {DEFAULT_BATCH_SIZE})")
+    parser.add_argument("--sync", action="store_true",
+                        help="write only the differences with the dipendenti already in the db")
+    parser.add_argument("--delete", action="store_true",
+                        help="with --sync, delete the dipendenti missing from the file")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="with --sync, print the changes without writing them")
+    args = parser.parse_args()
+
+    if (args.delete or args.dry_run) and not args.sync:
+        parser.error("--delete and --dry-run require --sync")
+
+    records = parse_data(args.data_file)
+
+    if args.sync:
+        changes = sync_data(records, args.batch_size, args.delete, args.dry_run)
+
+        if isinstance(changes, str):
+            print(f"Sincronizzazione fallita, nessuna modifica salvata: {changes}")
+            return 1
+
+        print_changes(changes)
+        if args.dry_run:
+            print("Dry run: nessuna modifica salvata")
+        elif changes:
+            print("Modifiche salvate")
+        return 0
+
+    result = import_data(records, args.batch_size)
+
+    if isinstance(result, str):
+        print(f"Import fallito, nessuna modifica salvata: {result}")
+        return 1
+
+    ditte_inserted, dipendenti_inserted = result
+    print(f"Ditte aggiunte: {ditte_inserted}")
+    print(f"Dipendenti aggiunti: {dipendenti_inserted}")
+    return 0
         
 if __name__ == "__main__":
     fredbconn.initialize_database(*passwords.database_config)
-    main()
\ No newline at end of file
+    raise SystemExit(main())
\ No newline at end of file
@@ -0,0 +1,12 @@
+-- Version stamp used by fredauth to keep the authorization cache coherent between processes.
+-- The trigger bumps it on every change made to a user, including the ones made by hand.
+
+USE ACCA;
+
+ALTER TABLE utenti
+  ADD COLUMN auth_version INT UNSIGNED NOT NULL DEFAULT 0;
+
+CREATE TRIGGER utenti_auth_version_bump
+  BEFORE UPDATE ON utenti
+  FOR EACH ROW
+  SET NEW.auth_version = OLD.auth_version + 1;
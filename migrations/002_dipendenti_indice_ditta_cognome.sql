@@ -0,0 +1,6 @@
+-- Lets the /dipendenti?id_ditta=... keyset pages, ordered by (cognome, id), be read as an index range scan.
+-- InnoDB appends the primary key to every secondary index, so id is already part of the key.
+
+USE ACCA;
+
+CREATE INDEX indice_ditta_cognome ON dipendenti (ditta_id, cognome);
\ No newline at end of file
@@ -0,0 +1,11 @@
+-- Indexes used by dipendenti_search.
+-- The case and accent insensitive collation lets "cognome LIKE 'ros%'" use indice_cognome,
+-- the ngram FULLTEXT index serves the substring and similar-name lookups.
+
+USE ACCA;
+
+ALTER TABLE dipendenti
+  MODIFY nome VARCHAR(50) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci,
+  MODIFY cognome VARCHAR(50) CHARACTER SET utf8mb4 COLLATE utf8mb4_0900_ai_ci;
+
+CREATE FULLTEXT INDEX ft_dipendenti_cognome_nome ON dipendenti (cognome, nome) WITH PARSER ngram;
\ No newline at end of file
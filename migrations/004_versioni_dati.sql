@@ -0,0 +1,20 @@
+-- Change counters read by data_versions, bumped by the write routes of the server.
+-- ruoli is only edited by hand, so its counter is bumped by triggers.
+
+USE ACCA;
+
+CREATE TABLE IF NOT EXISTS versioni_dati (
+  tabella VARCHAR(30) PRIMARY KEY,
+  versione BIGINT UNSIGNED NOT NULL DEFAULT 0
+);
+
+INSERT IGNORE INTO versioni_dati (tabella, versione) VALUES ('ditte', 0), ('dipendenti', 0), ('ruoli', 0);
+
+CREATE TRIGGER ruoli_versione_insert AFTER INSERT ON ruoli
+  FOR EACH ROW UPDATE versioni_dati SET versione = versione + 1 WHERE tabella = 'ruoli';
+
+CREATE TRIGGER ruoli_versione_update AFTER UPDATE ON ruoli
+  FOR EACH ROW UPDATE versioni_dati SET versione = versione + 1 WHERE tabella = 'ruoli';
+
+CREATE TRIGGER ruoli_versione_delete AFTER DELETE ON ruoli
+  FOR EACH ROW UPDATE versioni_dati SET versione = versione + 1 WHERE tabella = 'ruoli';
\ No newline at end of file
@@ -0,0 +1,19 @@
+-- Outbound mail queue written by the mailer scripts and drained by mail_outbox.
+-- Each row holds the fully rendered MIME message, so a retry sends exactly what was enqueued.
+
+USE ACCA;
+
+CREATE TABLE IF NOT EXISTS email_outbox (
+  id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+  destinatari TEXT NOT NULL,
+  oggetto VARCHAR(255) NOT NULL,
+  messaggio LONGBLOB NOT NULL,
+  stato ENUM('in_attesa', 'inviata', 'fallita') NOT NULL DEFAULT 'in_attesa',
+  tentativi INT UNSIGNED NOT NULL DEFAULT 0,
+  prossimo_tentativo DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  ultimo_errore TEXT,
+  creata_il DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  inviata_il DATETIME NULL,
+
+  INDEX indice_coda (stato, prossimo_tentativo)
+);
\ No newline at end of file
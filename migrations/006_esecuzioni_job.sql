@@ -0,0 +1,16 @@
+-- Run history of the jobs of scheduler.py.
+-- The unique key makes each scheduled occurrence run once, even with several schedulers running.
+
+USE ACCA;
+
+CREATE TABLE IF NOT EXISTS esecuzioni_job (
+  id INT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+  job VARCHAR(50) NOT NULL,
+  programmata_per DATETIME NOT NULL,
+  iniziata_il DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  terminata_il DATETIME NULL,
+  stato ENUM('in_corso', 'completata', 'fallita') NOT NULL DEFAULT 'in_corso',
+  errore TEXT,
+
+  UNIQUE KEY indice_job_programmata (job, programmata_per)
+);
\ No newline at end of file
@@ -0,0 +1,6 @@
+-- Index of the expiry queries of badge_expiry: the equality filters on the badge state first,
+-- then the range on the expiry date, so the buckets are counted with a range scan.
+
+USE ACCA;
+
+CREATE INDEX indice_scadenze ON dipendenti (badge_sospeso, badge_annullato, is_badge_already_emesso, scadenza_autorizzazione);
\ No newline at end of file
@@ -0,0 +1,21 @@
+-- The badge flags of dipendenti packed in one generated column, see badge_state.py for the bits.
+-- A NULL badge_annullato, left by migrate-data.py, has a bit of its own so that it stays neither
+-- cancelled nor not cancelled, as with badge_annullato = 0 and = 1.
+-- MySQL recomputes it on every write of the flags, the index serves the state filters of the
+-- reports with a range scan and replaces indice_scadenze.
+
+USE ACCA;
+
+ALTER TABLE dipendenti
+  ADD COLUMN badge_stato TINYINT UNSIGNED AS (
+    (COALESCE(is_badge_already_emesso, 0) <> 0)
+    | (COALESCE(badge_sospeso, 0) <> 0) << 1
+    | (COALESCE(badge_annullato, 0) <> 0) << 2
+    | (COALESCE(accesso_bloccato, 0) <> 0) << 3
+    | (COALESCE(is_badge_temporaneo, 0) <> 0) << 4
+    | (badge_annullato IS NULL) << 5
+  ) STORED NOT NULL;
+
+CREATE INDEX indice_badge_stato ON dipendenti (badge_stato, scadenza_autorizzazione);
+
+DROP INDEX indice_scadenze ON dipendenti;
\ No newline at end of file
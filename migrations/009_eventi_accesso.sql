@@ -0,0 +1,44 @@
+-- Gate events written by access_events, and their hourly and daily headcounts per ditta.
+-- eventi_accesso is append-only and partitioned by day: the daily job of scheduler.py adds the
+-- partitions of the next days out of p_futuro and drops the ones past the retention.
+-- Partitioned tables can't have foreign keys, the ids are kept as they were at the swipe.
+-- After applying it run once: python python/scheduler.py --run access_daily
+
+USE ACCA;
+
+CREATE TABLE IF NOT EXISTS eventi_accesso (
+  id BIGINT UNSIGNED AUTO_INCREMENT,
+  registrato_il DATETIME NOT NULL,
+  dipendente_id INT UNSIGNED NULL,
+  ditta_id INT UNSIGNED NULL,
+  numero_badge VARCHAR(50) NOT NULL DEFAULT '',
+  varco VARCHAR(50) NOT NULL DEFAULT '',
+  direzione ENUM('entrata', 'uscita') NOT NULL DEFAULT 'entrata',
+  esito TINYINT NOT NULL,
+
+  PRIMARY KEY (registrato_il, id),
+  KEY indice_id (id),
+  KEY indice_dipendente (dipendente_id, registrato_il)
+)
+PARTITION BY RANGE (TO_DAYS(registrato_il)) (
+  PARTITION p_iniziale VALUES LESS THAN (TO_DAYS('2026-01-01')),
+  PARTITION p_futuro VALUES LESS THAN MAXVALUE
+);
+
+CREATE TABLE IF NOT EXISTS presenze_orarie (
+  ora DATETIME NOT NULL,
+  ditta_id INT UNSIGNED NOT NULL,
+  persone INT UNSIGNED NOT NULL,
+  eventi INT UNSIGNED NOT NULL,
+
+  PRIMARY KEY (ora, ditta_id)
+);
+
+CREATE TABLE IF NOT EXISTS presenze_giornaliere (
+  giorno DATE NOT NULL,
+  ditta_id INT UNSIGNED NOT NULL,
+  persone INT UNSIGNED NOT NULL,
+  eventi INT UNSIGNED NOT NULL,
+
+  PRIMARY KEY (giorno, ditta_id)
+);
\ No newline at end of file
@@ -0,0 +1,21 @@
+-- Report jobs of report_jobs: the exports run in background and the pages poll their state.
+-- The state is in the database, so any server process can answer the polls and the downloads.
+
+USE ACCA;
+
+CREATE TABLE IF NOT EXISTS job_report (
+  id CHAR(32) PRIMARY KEY,
+  tipo VARCHAR(50) NOT NULL,
+  chiave CHAR(32) NOT NULL,
+  stato ENUM('in_coda', 'in_corso', 'completato', 'fallito') NOT NULL DEFAULT 'in_coda',
+  righe INT UNSIGNED NOT NULL DEFAULT 0,
+  totale INT UNSIGNED NULL,
+  percorso VARCHAR(500) NULL,
+  errore TEXT,
+  utente VARCHAR(50),
+  creato_il DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  aggiornato_il DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+
+  INDEX indice_tipo_chiave (tipo, chiave, stato),
+  INDEX indice_creato (creato_il)
+);
\ No newline at end of file
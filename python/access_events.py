@@ -0,0 +1,447 @@
+"""Log of the gate events (swipes) and their hourly and daily headcounts per ditta.
+
+The events sent by the turnstiles are buffered in memory and written by one thread in multi-row
+INSERTs, so thousands of swipes per shift cost a few short statements on one pooled connection
+instead of a transaction each, and the management pages sharing the database don't notice them.
+The badge is resolved with access_index, so ingesting never reads MySQL either.
+
+The buffer is bounded: when the database can't keep up, or is down, ingest refuses the events
+instead of growing without limit, and the turnstiles send them again later. A batch MySQL refuses
+for its values is split until the rows at fault are found, and only those are dropped. The events still
+buffered when the process exits are flushed by atexit, a crash loses at most flush_seconds of them.
+
+The rollups are recomputed by the scheduler jobs access_hourly and access_daily, the daily job
+also keeps the daily partitions of eventi_accesso.
+
+Requires migrations/009_eventi_accesso.sql
+"""
+
+import atexit
+import logging
+import threading
+from collections import deque
+from datetime import date, datetime, timedelta
+
+import pymysql
+
+try:
+    # First attempt direct import (works when running server.py)
+    import fredbconn
+    import access_index
+except ImportError:
+    # Fall back to package import (works when running the scripts from the root)
+    from python import fredbconn
+    from python import access_index
+
+logger = logging.getLogger("AccessEvents")
+
+DIRECTIONS = ("entrata", "uscita")
+
+# dipendente_id is an INT UNSIGNED, registrato_il a DATETIME
+MAX_ID = 2 ** 32 - 1
+MIN_YEAR = 1000
+
+# Errors on the values of the rows, which no retry can fix: out of range, wrong datetime, no partition
+_REJECTED_ERRORS = (pymysql.err.DataError, pymysql.err.IntegrityError)
+_REJECTED_CODES = (1292, 1526)
+
+_batch_size = 500
+_flush_seconds = 2
+_max_buffered = 50000
+_days_ahead = 7
+_retention_days = 400
+
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+
+# Rows ready for the INSERT, in arrival order
+_buffer = deque()
+
+_writer = None
+
+
+def configure_access_events(batch_size=500, flush_seconds=2, max_buffered=50000, days_ahead=7, retention_days=400):
+    """Configures the writer and the partitions.
+
+    Args:
+        batch_size (int): rows per INSERT
+        flush_seconds (float): how long an event waits in memory at most
+        max_buffered (int): events kept in memory while the database is slow or down
+        days_ahead (int): daily partitions created in advance
+        retention_days (int): days of events kept, the older partitions are dropped, None keeps everything
+    """
+    global _batch_size, _flush_seconds, _max_buffered, _days_ahead, _retention_days
+    _batch_size = batch_size
+    _flush_seconds = flush_seconds
+    _max_buffered = max_buffered
+    _days_ahead = days_ahead
+    _retention_days = retention_days
+
+
+def parse_event(values, now=None):
+    """Validates one event sent by a turnstile and resolves its badge with access_index.
+
+    Args:
+        values (dict): numero_badge or id, optional registrato_il (ISO format), varco, direzione
+            ("entrata" or "uscita") and esito (0 or 1, decided by the gate). Without esito the
+            access is checked now against the index
+
+    Returns:
+        tuple: the row to insert
+
+    Raises:
+        ValueError: if the event is not valid
+    """
+    numero_badge = str(values.get("numero_badge") or "").strip()
+    dipendente_id = values.get("id")
+
+    if not numero_badge and dipendente_id in (None, ""):
+        raise ValueError("Specificare numero_badge o id")
+
+    try:
+        dipendente_id = int(dipendente_id) if dipendente_id not in (None, "") else None
+    except (TypeError, ValueError):
+        raise ValueError("L'id deve essere un numero")
+
+    if dipendente_id is not None and not 0 < dipendente_id <= MAX_ID:
+        raise ValueError("L'id non è valido")
+
+    registrato_il = values.get("registrato_il")
+    try:
+        registrato_il = datetime.fromisoformat(registrato_il) if registrato_il else (now or datetime.now())
+    except (TypeError, ValueError):
+        raise ValueError("Data non valida, usare il formato ISO (AAAA-MM-GGTHH:MM:SS)")
+
+    # The timestamps are stored in local time, as every other date of ACCA
+    if registrato_il.tzinfo is not None:
+        registrato_il = registrato_il.astimezone().replace(tzinfo=None)
+
+    if registrato_il.year < MIN_YEAR:
+        raise ValueError("Data non valida")
+
+    direzione = values.get("direzione") or "entrata"
+    if direzione not in DIRECTIONS:
+        raise ValueError("La direzione deve essere 'entrata' o 'uscita'")
+
+    may_enter, _, badge = access_index.lookup(dipendente_id=dipendente_id,
+                                              numero_badge=numero_badge or None,
+                                              today=registrato_il.date())
+
+    esito = values.get("esito")
+    if esito is None:
+        esito = may_enter
+    elif esito not in (0, 1, True, False):
+        raise ValueError("L'esito deve essere 0 o 1")
+
+    if badge is not None:
+        dipendente_id = badge.id
+        numero_badge = numero_badge or badge.numero_badge
+
+    return (registrato_il.replace(microsecond=0), dipendente_id, badge.ditta_id if badge else None,
+            numero_badge[:50], str(values.get("varco") or "")[:50], direzione, int(bool(esito)))
+
+
+def ingest(rows):
+    """Buffers the parsed events, returns False if the buffer is full and none was accepted"""
+    _ensure_writer()
+
+    with _lock:
+        if len(_buffer) + len(rows) > _max_buffered:
+            return False
+        _buffer.extend(rows)
+
+    return True
+
+
+def buffered():
+    """Returns the number of events waiting to be written"""
+    return len(_buffer)
+
+
+@fredbconn.connected_to_database
+def _insert_rows(cursor, rows):
+    """Inserts the rows, returns False if MySQL refused their values, in which case none is written.
+
+    Called by flush only, outside of any unit of work, so rolling back only drops these rows.
+    """
+    # pymysql rewrites executemany of an INSERT ... VALUES into multi-row statements
+    try:
+        cursor.executemany("""
+        INSERT INTO eventi_accesso (registrato_il, dipendente_id, ditta_id, numero_badge, varco, direzione, esito)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """, rows)
+    except pymysql.err.MySQLError as e:
+        if not isinstance(e, _REJECTED_ERRORS) and (e.args[0] if e.args else None) not in _REJECTED_CODES:
+            raise
+        # Several statements may have run for a large batch, the earlier ones must not stay
+        cursor.connection.rollback()
+        logger.warning(f"MySQL refused {len(rows)} access events: {e}")
+        return False
+
+
+def flush():
+    """Writes the buffered events a batch at a time, returns the number written.
+
+    A batch refused for its values is split in halves until the single rows at fault, which are
+    dropped. A batch that fails otherwise, e.g. with the database down, goes back to the front of
+    the buffer with the rest of its halves, and is retried at the next flush.
+    """
+    written = 0
+
+    with _flush_lock:
+        while True:
+            with _lock:
+                batch = [_buffer.popleft() for _ in range(min(_batch_size, len(_buffer)))]
+
+            if not batch:
+                return written
+
+            # Chunks of the batch still to write, in order
+            pending = [batch]
+            while pending:
+                chunk = pending.pop(0)
+                result = _insert_rows(chunk)
+
+                if result is False:
+                    if len(chunk) == 1:
+                        logger.error(f"Dropped an access event refused by MySQL: {chunk[0]}")
+                    else:
+                        middle = len(chunk) // 2
+                        pending[:0] = [chunk[:middle], chunk[middle:]]
+                    continue
+
+                # The decorator returns the error as a string
+                if isinstance(result, str):
+                    rows = [row for part in [chunk] + pending for row in part]
+                    with _lock:
+                        _buffer.extendleft(reversed(rows))
+                    logger.error(f"Unable to write {len(rows)} access events, retrying later: {result}")
+                    return written
+
+                written += len(chunk)
+
+
+class _Writer(threading.Thread):
+    """Thread flushing the buffer every flush_seconds"""
+    def __init__(self):
+        super().__init__(name="access-events", daemon=True)
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(_flush_seconds):
+            try:
+                flush()
+            except Exception:
+                logger.exception("Error writing the access events")
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def _ensure_writer():
+    """Starts the writer on first use, in the process receiving the events"""
+    global _writer
+
+    if _writer is not None:
+        return
+
+    with _lock:
+        if _writer is None:
+            _writer = _Writer()
+            _writer.start()
+            atexit.register(flush)
+
+
+# The headcount of a period counts the distinct dipendenti let in, per ditta
+_HEADCOUNT_SELECT = """
+    SELECT
+        {period} AS periodo,
+        ditta_id,
+        COUNT(DISTINCT dipendente_id) AS persone,
+        COUNT(*) AS eventi
+    FROM
+        eventi_accesso
+    WHERE
+        registrato_il >= %s
+        AND registrato_il < %s
+        AND esito = 1
+        AND ditta_id IS NOT NULL
+    GROUP BY
+        periodo, ditta_id
+"""
+
+_HOUR = "TIMESTAMP(DATE(registrato_il), MAKETIME(HOUR(registrato_il), 0, 0))"
+_DAY = "DATE(registrato_il)"
+
+
+@fredbconn.connected_to_database
+def rollup_hours(cursor, start, end):
+    """Recomputes presenze_orarie for the hours from start to end, late events included"""
+    cursor.execute(f"""
+    INSERT INTO presenze_orarie (ora, ditta_id, persone, eventi)
+    {_HEADCOUNT_SELECT.format(period=_HOUR)}
+    ON DUPLICATE KEY UPDATE persone = VALUES(persone), eventi = VALUES(eventi)
+    """, (start, end))
+    return cursor.rowcount
+
+
+@fredbconn.connected_to_database
+def rollup_days(cursor, first_day, last_day):
+    """Recomputes presenze_giornaliere for the days from first_day to last_day included"""
+    cursor.execute(f"""
+    INSERT INTO presenze_giornaliere (giorno, ditta_id, persone, eventi)
+    {_HEADCOUNT_SELECT.format(period=_DAY)}
+    ON DUPLICATE KEY UPDATE persone = VALUES(persone), eventi = VALUES(eventi)
+    """, (datetime.combine(first_day, datetime.min.time()),
+          datetime.combine(last_day + timedelta(days=1), datetime.min.time())))
+    return cursor.rowcount
+
+
+def _partition_name(day):
+    return f"p{day:%Y%m%d}"
+
+
+@fredbconn.connected_to_database
+def maintain_partitions(cursor, today=None):
+    """Creates the daily partitions up to days_ahead and drops the ones older than retention_days.
+
+    The new partitions are split out of p_futuro, which is empty as long as this runs every day, so
+    the split moves no rows. Dropping a partition removes a day of events without a DELETE.
+
+    Returns:
+        tuple: (partitions created, partitions dropped)
+    """
+    today = today or date.today()
+
+    cursor.execute("""
+    SELECT partition_name
+    FROM information_schema.partitions
+    WHERE table_schema = DATABASE() AND table_name = 'eventi_accesso'
+    """)
+    existing = sorted(row[0] for row in cursor.fetchall() if row[0].startswith("p2"))
+
+    # Each partition holds its day and, the first one, everything before. The new ones must follow the last
+    day = today
+    if existing:
+        day = max(day, datetime.strptime(existing[-1], "p%Y%m%d").date() + timedelta(days=1))
+
+    to_create = []
+    while day <= today + timedelta(days=_days_ahead):
+        to_create.append(day)
+        day += timedelta(days=1)
+
+    if to_create:
+        partitions = ", ".join(
+            f"PARTITION {_partition_name(day)} VALUES LESS THAN (TO_DAYS('{day + timedelta(days=1)}'))"
+            for day in to_create
+        )
+        # DDL commits on its own
+        cursor.execute(f"""
+        ALTER TABLE eventi_accesso REORGANIZE PARTITION p_futuro INTO (
+            {partitions},
+            PARTITION p_futuro VALUES LESS THAN MAXVALUE
+        )
+        """)
+
+    to_drop = []
+    if _retention_days is not None:
+        oldest = _partition_name(today - timedelta(days=_retention_days))
+        to_drop = [name for name in existing if name < oldest]
+
+    if to_drop:
+        cursor.execute(f"ALTER TABLE eventi_accesso DROP PARTITION {', '.join(to_drop)}")
+
+    return len(to_create), len(to_drop)
+
+
+def run_hourly_rollup():
+    """Scheduler job: the headcounts of the current and of the previous hour, so the late events count"""
+    now = datetime.now().replace(minute=0, second=0, microsecond=0)
+    result = rollup_hours(now - timedelta(hours=1), now + timedelta(hours=1))
+    if isinstance(result, str):
+        logger.error(f"Hourly rollup failed: {result}")
+        return False
+    return True
+
+
+def run_daily_maintenance():
+    """Scheduler job: the headcounts of yesterday and today, then the partitions"""
+    today = date.today()
+
+    result = rollup_days(today - timedelta(days=1), today)
+    if isinstance(result, str):
+        logger.error(f"Daily rollup failed: {result}")
+        return False
+
+    partitions = maintain_partitions(today)
+    if isinstance(partitions, str):
+        logger.error(f"Partition maintenance failed: {partitions}")
+        return False
+
+    created, dropped = partitions
+    logger.info(f"Access events partitions: {created} created, {dropped} dropped")
+    return True
+
+
+@fredbconn.connected_to_database
+def fetch_daily_headcounts(cursor, day):
+    """Returns the (ditta_id, nome_ditta, persone, eventi) of the day, live for today"""
+    if day >= date.today():
+        # Today isn't rolled up yet, a single partition is read
+        cursor.execute(f"""
+        SELECT headcount.ditta_id, ditte.nome, headcount.persone, headcount.eventi
+        FROM (
+            {_HEADCOUNT_SELECT.format(period=_DAY)}
+        ) AS headcount
+        LEFT JOIN ditte ON ditte.id = headcount.ditta_id
+        ORDER BY ditte.nome ASC
+        """, (datetime.combine(day, datetime.min.time()),
+              datetime.combine(day + timedelta(days=1), datetime.min.time())))
+    else:
+        cursor.execute("""
+        SELECT presenze_giornaliere.ditta_id, ditte.nome, presenze_giornaliere.persone, presenze_giornaliere.eventi
+        FROM presenze_giornaliere
+        LEFT JOIN ditte ON ditte.id = presenze_giornaliere.ditta_id
+        WHERE presenze_giornaliere.giorno = %s
+        ORDER BY ditte.nome ASC
+        """, (day,))
+    return cursor.fetchall()
+
+
+@fredbconn.connected_to_database
+def fetch_hourly_headcounts(cursor, day):
+    """Returns the (ora, ditta_id, nome_ditta, persone, eventi) rolled up for the day"""
+    cursor.execute("""
+    SELECT presenze_orarie.ora, presenze_orarie.ditta_id, ditte.nome, presenze_orarie.persone, presenze_orarie.eventi
+    FROM presenze_orarie
+    LEFT JOIN ditte ON ditte.id = presenze_orarie.ditta_id
+    WHERE presenze_orarie.ora >= %s AND presenze_orarie.ora < %s
+    ORDER BY presenze_orarie.ora ASC, ditte.nome ASC
+    """, (datetime.combine(day, datetime.min.time()),
+          datetime.combine(day + timedelta(days=1), datetime.min.time())))
+    return cursor.fetchall()
+
+
+@fredbconn.connected_to_database
+def fetch_present(cursor, day):
+    """Returns who was let in on the day: (id, nome, cognome, nome_ditta, first event, last event)"""
+    cursor.execute("""
+    SELECT
+        eventi.dipendente_id,
+        dipendenti.nome,
+        dipendenti.cognome,
+        ditte.nome,
+        eventi.primo,
+        eventi.ultimo
+    FROM (
+        SELECT dipendente_id, ditta_id, MIN(registrato_il) AS primo, MAX(registrato_il) AS ultimo
+        FROM eventi_accesso
+        WHERE registrato_il >= %s AND registrato_il < %s AND esito = 1 AND dipendente_id IS NOT NULL
+        GROUP BY dipendente_id, ditta_id
+    ) AS eventi
+    LEFT JOIN dipendenti ON dipendenti.id = eventi.dipendente_id
+    LEFT JOIN ditte ON ditte.id = eventi.ditta_id
+    ORDER BY ditte.nome ASC, dipendenti.cognome ASC, dipendenti.nome ASC
+    """, (datetime.combine(day, datetime.min.time()),
+          datetime.combine(day + timedelta(days=1), datetime.min.time())))
+    return cursor.fetchall()
\ No newline at end of file
@@ -0,0 +1,281 @@
+"""In-memory index of the badges allowing the access, answering /api/access-check without the database.
+
+The index holds the dipendenti with an active badge (see badge_state.ACTIVE_BADGE_SQL), by id and by
+numero_badge. The expiry date is checked at lookup time, so the index stays valid across midnight.
+
+It's kept fresh in two ways:
+    - the write routes call track_changes in their transaction, and the changed rows are read again
+      right after the commit, so this process sees its own writes at once
+    - a thread polls the versions of dipendenti and ditte (see data_versions) and rebuilds the whole
+      index when another process wrote, so the other processes are at most poll_seconds behind
+
+Requires migrations/008_dipendenti_badge_stato.sql
+"""
+
+import logging
+import threading
+from collections import namedtuple
+from datetime import date
+
+try:
+    # First attempt direct import (works when running server.py)
+    import fredbconn
+    import data_versions
+    import badge_state
+except ImportError:
+    # Fall back to package import (works when running the scripts from the root)
+    from python import fredbconn
+    from python import data_versions
+    from python import badge_state
+
+logger = logging.getLogger(__name__)
+
+TABLES = ("dipendenti", "ditte")
+
+Badge = namedtuple("Badge", "id nome cognome ditta_id nome_ditta numero_badge scadenza_autorizzazione is_badge_temporaneo")
+
+_SELECT = """
+    SELECT
+        dipendenti.id,
+        dipendenti.nome,
+        dipendenti.cognome,
+        ditte.id,
+        ditte.nome,
+        dipendenti.numero_badge,
+        dipendenti.scadenza_autorizzazione,
+        dipendenti.is_badge_temporaneo,
+        dipendenti.badge_stato
+    FROM
+        dipendenti
+    JOIN
+        ditte
+    ON
+        dipendenti.ditta_id = ditte.id
+"""
+
+_ACTIVE_STATES = frozenset(badge_state.states(badge_state.EMESSO | badge_state.VALIDO, badge_state.ANNULLATO))
+
+_poll_seconds = 2
+
+# Only one rebuild or patch at a time, the lookups never wait
+_write_lock = threading.Lock()
+_start_lock = threading.Lock()
+
+# The dicts are replaced as a whole by a rebuild and patched in place otherwise
+_by_id = {}
+_by_badge = {}
+
+# {table: version} of the data in the index, None until the first build
+_versions = None
+
+_refresher = None
+
+
+def configure_access_index(poll_seconds=2):
+    """Sets how often the versions are checked for the writes of the other processes"""
+    global _poll_seconds
+    _poll_seconds = poll_seconds
+
+
+def _to_badge(row):
+    return Badge(row[0], row[1], row[2], row[3], row[4], (row[5] or "").strip(), row[6], bool(row[7]))
+
+
+def _read_versions(cursor):
+    placeholders = ", ".join(["%s"] * len(TABLES))
+    cursor.execute(f"""
+    SELECT tabella, versione
+    FROM versioni_dati
+    WHERE tabella IN ({placeholders})
+    """, TABLES)
+    return {row[0]: int(row[1]) for row in cursor.fetchall()}
+
+
+@fredbconn.connected_to_database
+def _fetch_all(cursor):
+    # The versions and the rows come from the same snapshot of the transaction
+    versions = _read_versions(cursor)
+
+    cursor.execute(f"""
+    {_SELECT}
+    WHERE
+        {badge_state.ACTIVE_BADGE_SQL}
+    """)
+
+    return versions, [_to_badge(row) for row in cursor.fetchall()]
+
+
+@fredbconn.connected_to_database
+def _fetch_changed(cursor, dipendenti_ids, ditta_ids):
+    conditions = []
+    params = []
+    if dipendenti_ids:
+        conditions.append(f"dipendenti.id IN ({', '.join(['%s'] * len(dipendenti_ids))})")
+        params.extend(dipendenti_ids)
+    if ditta_ids:
+        conditions.append(f"ditte.id IN ({', '.join(['%s'] * len(ditta_ids))})")
+        params.extend(ditta_ids)
+
+    cursor.execute(f"""
+    {_SELECT}
+    WHERE
+        {" OR ".join(conditions)}
+    """, tuple(params))
+
+    return [(_to_badge(row), row[8] in _ACTIVE_STATES) for row in cursor.fetchall()]
+
+
+def rebuild():
+    """Reads the whole index again, returns False if the database couldn't be read"""
+    global _by_id, _by_badge, _versions
+
+    with _write_lock:
+        fetched = _fetch_all()
+
+        # The decorator returns the error as a string, the current index is kept
+        if isinstance(fetched, str):
+            logger.error(f"Unable to build the access index: {fetched}")
+            return False
+
+        versions, badges = fetched
+
+        by_id = {badge.id: badge for badge in badges}
+        by_badge = {badge.numero_badge: badge for badge in badges if badge.numero_badge}
+
+        _by_id, _by_badge, _versions = by_id, by_badge, versions
+
+    logger.info(f"Access index built with {len(by_id)} active badges")
+    return True
+
+
+def _remove(badge_id):
+    old = _by_id.pop(badge_id, None)
+    if old is not None and _by_badge.get(old.numero_badge) is old:
+        del _by_badge[old.numero_badge]
+
+
+def _apply_changes(tables, versions, dipendenti_ids, ditta_ids):
+    """Reads the changed rows again after the commit of a write route, see track_changes"""
+    global _versions
+
+    with _write_lock:
+        if _versions is None:
+            return
+
+        # Without ids the write didn't touch the index, only its versions move
+        fetched = _fetch_changed(dipendenti_ids, ditta_ids) if dipendenti_ids or ditta_ids else []
+        if isinstance(fetched, str):
+            # Left to the version check of the refresher
+            logger.error(f"Unable to update the access index: {fetched}")
+            return
+
+        # Every row of the changes is dropped, then the ones still active are added back,
+        # so the deleted rows and the badges no longer active leave the index
+        stale = set(dipendenti_ids)
+        if ditta_ids:
+            stale.update(badge.id for badge in _by_id.values() if badge.ditta_id in ditta_ids)
+
+        for badge_id in stale:
+            _remove(badge_id)
+
+        for badge, active in fetched:
+            _remove(badge.id)
+            if active:
+                _by_id[badge.id] = badge
+                if badge.numero_badge:
+                    _by_badge[badge.numero_badge] = badge
+
+        # The index is now at the versions of the write only if it was just before it, otherwise
+        # another process wrote meanwhile and the refresher rebuilds the whole index
+        if all(_versions.get(table) == versions.get(table, 0) - 1 for table in tables):
+            _versions = dict(_versions, **{table: versions[table] for table in tables})
+
+
+def track_changes(cursor, tables, dipendenti_ids=(), ditta_ids=()):
+    """Updates the index with the rows changed by a write route, once its transaction commits.
+
+    Call it in the transaction of the write, after data_versions.bump.
+
+    Args:
+        cursor: the cursor of the write
+        tables (tuple): the tables bumped by the write
+        dipendenti_ids: the ids of the dipendenti changed or deleted
+        ditta_ids: the ids of the ditte changed or deleted, all their dipendenti are read again
+    """
+    if _versions is None:
+        return
+
+    dipendenti_ids = {int(id) for id in dipendenti_ids}
+    ditta_ids = {int(id) for id in ditta_ids}
+
+    # Read after the bump, so the versions of the bumped tables are exactly the ones of this write
+    versions = _read_versions(cursor)
+
+    fredbconn.call_after_commit(lambda: _apply_changes(tables, versions, dipendenti_ids, ditta_ids))
+
+
+class _Refresher(threading.Thread):
+    """Thread rebuilding the index when another process changed dipendenti or ditte"""
+    def __init__(self):
+        super().__init__(name="access-index", daemon=True)
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.wait(_poll_seconds):
+            try:
+                current = dict(zip(TABLES, data_versions.version_of(*TABLES)))
+                if _versions is None or any(_versions.get(table) != current[table] for table in TABLES):
+                    rebuild()
+            except Exception:
+                logger.exception("Error refreshing the access index")
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def ensure_started():
+    """Builds the index and starts the refresher on first use, in the process serving the requests
+
+    Returns:
+        bool: False if the index couldn't be built yet
+    """
+    global _refresher
+
+    if _refresher is not None and _versions is not None:
+        return True
+
+    with _start_lock:
+        if _versions is None and not rebuild():
+            return False
+
+        if _refresher is None:
+            _refresher = _Refresher()
+            _refresher.start()
+
+    return True
+
+
+def lookup(dipendente_id=None, numero_badge=None, today=None):
+    """Checks if the dipendente, or the holder of the badge, may enter today, without the database.
+
+    Returns:
+        tuple: (may enter, reason, Badge or None), the reason is None when the access is allowed
+    """
+    if numero_badge is not None:
+        badge = _by_badge.get(numero_badge.strip())
+    else:
+        badge = _by_id.get(dipendente_id)
+
+    if badge is None:
+        return False, "Badge non valido", None
+
+    # Expired on the day of the scadenza, as for the expired badges mailer
+    if badge.scadenza_autorizzazione is not None and badge.scadenza_autorizzazione <= (today or date.today()):
+        return False, "Autorizzazione scaduta", badge
+
+    return True, None, badge
+
+
+def stats():
+    """Returns the number of badges in the index and the versions it reflects"""
+    return {"badge_attivi": len(_by_id), "versioni": dict(_versions or {})}
\ No newline at end of file
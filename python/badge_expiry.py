@@ -0,0 +1,122 @@
+"""Buckets of the issued and valid badges by expiry date: expired, and expiring within 7, 30 and 60 days.
+
+The counts are read with one grouped query over indice_badge_stato and cached in process until the
+dipendenti version (see data_versions) or the day changes. The same bucket filters are used by the
+/dipendenti listing and by the expired badges mailer.
+
+Requires migrations/008_dipendenti_badge_stato.sql
+"""
+
+import threading
+from datetime import date, timedelta
+
+try:
+    # First attempt direct import (works when running server.py)
+    import fredbconn
+    import data_versions
+    import badge_state
+except ImportError:
+    # Fall back to package import (works when running the scripts from the root)
+    from python import fredbconn
+    from python import data_versions
+    from python import badge_state
+
+# (key, label, days from today: lower bound excluded, upper bound included), the buckets don't overlap
+BUCKETS = (
+    ("scaduti", "Scaduti", None, 0),
+    ("7", "In scadenza entro 7 giorni", 0, 7),
+    ("30", "In scadenza tra 8 e 30 giorni", 7, 30),
+    ("60", "In scadenza tra 31 e 60 giorni", 30, 60),
+)
+
+# The badges that can expire: issued, valid and not cancelled. The prefix of indice_badge_stato
+ACTIVE_BADGE_SQL = badge_state.ACTIVE_BADGE_SQL
+
+_lock = threading.Lock()
+
+# (dipendenti version, day, counts)
+_cache = None
+
+
+def bucket_bounds(key, today=None):
+    """Returns the (lower excluded, upper included) expiry dates of a bucket, the lower is None for the
+    expired badges. None for an unknown key
+    """
+    today = today or date.today()
+
+    for bucket_key, _, low, high in BUCKETS:
+        if bucket_key == key:
+            return (today + timedelta(days=low) if low is not None else None), today + timedelta(days=high)
+
+    return None
+
+
+def bucket_filter(key, today=None):
+    """Returns the (sql, params) WHERE condition selecting the dipendenti of a bucket, None for an unknown key"""
+    bounds = bucket_bounds(key, today)
+    if bounds is None:
+        return None
+
+    low_date, high_date = bounds
+    if low_date is None:
+        return f"{ACTIVE_BADGE_SQL} AND dipendenti.scadenza_autorizzazione <= %s", (high_date,)
+    return (f"{ACTIVE_BADGE_SQL} AND dipendenti.scadenza_autorizzazione > %s "
+            "AND dipendenti.scadenza_autorizzazione <= %s"), (low_date, high_date)
+
+
+def bucket_label(key):
+    for bucket_key, label, _, _ in BUCKETS:
+        if bucket_key == key:
+            return label
+    return None
+
+
+@fredbconn.connected_to_database
+def _fetch_counts(cursor, today):
+    cases = []
+    params = []
+    for key, _, _, high in BUCKETS:
+        cases.append("WHEN dipendenti.scadenza_autorizzazione <= %s THEN %s")
+        params.extend((today + timedelta(days=high), key))
+
+    params.append(today + timedelta(days=BUCKETS[-1][3]))
+
+    cursor.execute(f"""
+    SELECT
+        CASE {" ".join(cases)} END AS fascia,
+        COUNT(*)
+    FROM
+        dipendenti
+    WHERE
+        {ACTIVE_BADGE_SQL}
+        AND dipendenti.scadenza_autorizzazione <= %s
+    GROUP BY
+        fascia
+    """, tuple(params))
+
+    return dict(cursor.fetchall())
+
+
+def get_bucket_counts():
+    """Returns the (key, label, count) of every bucket, in order"""
+    global _cache
+
+    version = data_versions.version_of("dipendenti")
+    today = date.today()
+
+    with _lock:
+        entry = _cache
+
+    if entry is not None and entry[0] == version and entry[1] == today:
+        counts = entry[2]
+    else:
+        counts = _fetch_counts(today)
+
+        # The decorator returns the error as a string, which must never be cached
+        if isinstance(counts, str):
+            counts = {}
+        else:
+            with _lock:
+                _cache = (version, today, counts)
+
+    return [(key, label, counts.get(key, 0)) for key, label, _, _ in BUCKETS]
\ No newline at end of file
@@ -0,0 +1,64 @@
+"""The badge state of a dipendente packed in one number, the badge_stato column.
+
+badge_stato is a STORED generated column over the five badge flags of dipendenti, so MySQL keeps it
+in sync with them and nothing writes it directly. The queries filter on it with an IN list of the
+states matching a combination of flags, which is a range scan of indice_badge_stato
+(badge_stato, scadenza_autorizzazione) in place of a scan of the whole table.
+
+The flags are compared as the columns were, with = 1 and = 0: a NULL flag is not set, and
+badge_annullato, the only flag also required to be clear, has a bit marking it NULL, so that a
+NULL badge_annullato is neither cancelled nor not cancelled.
+
+Requires migrations/008_dipendenti_badge_stato.sql
+"""
+
+# Bits of badge_stato, one per column
+EMESSO = 1            # is_badge_already_emesso
+VALIDO = 2            # badge_sospeso, which holds "badge valido" despite its name
+ANNULLATO = 4         # badge_annullato
+ACCESSO_BLOCCATO = 8  # accesso_bloccato, shown as "data aggiornata"
+TEMPORANEO = 16       # is_badge_temporaneo
+ANNULLATO_NULL = 32   # badge_annullato IS NULL
+
+# A NULL badge_annullato counts as 0 in the ANNULLATO bit, so the two are never set together
+ALL_STATES = [state for state in range(64) if not (state & ANNULLATO and state & ANNULLATO_NULL)]
+
+# Bits marking a flag NULL, which a condition requiring the flag clear excludes as well
+_NULL_BITS = {ANNULLATO: ANNULLATO_NULL}
+
+
+def states(set_bits=0, clear_bits=0):
+    """Returns the values of badge_stato having all of set_bits and none of clear_bits"""
+    if set_bits & clear_bits:
+        raise ValueError("A bit can't be both set and clear")
+
+    for bit, null_bit in _NULL_BITS.items():
+        if clear_bits & bit:
+            clear_bits |= null_bit
+    return [state for state in ALL_STATES if state & set_bits == set_bits and not state & clear_bits]
+
+
+def condition(set_bits=0, clear_bits=0, column="dipendenti.badge_stato"):
+    """Returns the SQL condition selecting the dipendenti having all of set_bits and none of clear_bits.
+
+    The values are computed here and never come from the user, so they are inlined in the SQL.
+    """
+    return f"{column} IN ({', '.join(str(state) for state in states(set_bits, clear_bits))})"
+
+
+# The valid badges listed by the weekly report
+VALID_BADGE_SQL = condition(VALIDO, ANNULLATO)
+
+# The badges that can expire: issued, valid and not cancelled
+ACTIVE_BADGE_SQL = condition(EMESSO | VALIDO, ANNULLATO)
+
+# The cancelled badges of /dipendenti?annullati=1
+CANCELLED_BADGE_SQL = condition(ANNULLATO)
+
+
+def may_enter_filter(today):
+    """Returns the (sql, params) WHERE condition selecting who may enter today: an active badge not
+    expired, or without expiry. A single range scan of indice_badge_stato
+    """
+    return (f"{ACTIVE_BADGE_SQL} AND (dipendenti.scadenza_autorizzazione IS NULL "
+            "OR dipendenti.scadenza_autorizzazione > %s)"), (today,)
\ No newline at end of file
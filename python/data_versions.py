@@ -0,0 +1,127 @@
+"""Change counters of the tables, stored in versioni_dati and bumped by the write routes.
+
+The in-process caches key their content on these versions. Inside a unit of work they are read once,
+in the transaction of the unit, so a cache is never keyed on a version newer than the rows the unit
+can see in its snapshot. Outside of one, every read is a new transaction, and the table is polled
+at most every poll_seconds: a bump made by this process is seen at once, as soon as it commits.
+
+Requires migrations/004_versioni_dati.sql
+"""
+
+import itertools
+import threading
+from time import monotonic
+
+try:
+    # First attempt direct import (works when running server.py)
+    import fredbconn
+except ImportError:
+    # Fall back to package import (works when running the scripts from the root)
+    from python import fredbconn
+
+TABLES = ("ditte", "dipendenti", "ruoli")
+
+_poll_seconds = 2
+
+_lock = threading.Lock()
+_versions = None
+_checked_at = None
+
+# Versions given out when they can't be read, never equal to one another nor to a real version
+_unknown = itertools.count(-1, -1)
+
+
+def configure_data_versions(poll_seconds=2):
+    """Sets how often the versions are read again, which bounds how stale another process can be"""
+    global _poll_seconds
+    _poll_seconds = poll_seconds
+    invalidate_local()
+
+
+def invalidate_local():
+    """Forces the next read of the versions to go to the database"""
+    global _checked_at
+    with _lock:
+        _checked_at = None
+
+
+@fredbconn.connected_to_database
+def _fetch_versions(cursor):
+    cursor.execute("""
+    SELECT tabella, versione
+    FROM versioni_dati
+    """)
+    return {row[0]: int(row[1]) for row in cursor.fetchall()}
+
+
+def _unknown_versions():
+    """Returns versions no cache entry is keyed on, so nothing is served or kept for them"""
+    version = next(_unknown)
+    return {table: version for table in TABLES}
+
+
+def current_versions():
+    """Returns a dict with the version of every table.
+
+    Inside a unit of work, the versions its transaction sees, otherwise up to poll_seconds old.
+    """
+    global _versions, _checked_at
+
+    cache = fredbconn.unit_cache()
+    if cache is not None:
+        versions = cache.get("data_versions")
+        if versions is None:
+            versions = _fetch_versions()
+
+            # The decorator returns the error as a string
+            if isinstance(versions, str):
+                return _unknown_versions()
+
+            cache["data_versions"] = versions
+        return versions
+
+    now = monotonic()
+
+    with _lock:
+        if _versions is not None and _checked_at is not None and now - _checked_at < _poll_seconds:
+            return _versions
+
+    fetched = _fetch_versions()
+
+    # The decorator returns the error as a string, the last known versions are kept
+    if isinstance(fetched, str):
+        return _versions or _unknown_versions()
+
+    # Its own transaction, so the rows read after it are at least as new
+    with _lock:
+        _versions = fetched
+        _checked_at = now
+
+    return fetched
+
+
+def version_of(*tables):
+    """Returns the versions of the given tables as a tuple, usable as a cache key"""
+    versions = current_versions()
+    return tuple(versions.get(table, 0) for table in tables)
+
+
+def bump(cursor, *tables):
+    """Bumps the version of the given tables, to be called in the same transaction of the write
+
+    The unit reads the versions again, its own bump included, and the local versions are
+    invalidated after the commit, so this process never keys fresh data on an old version.
+    """
+    placeholders = ", ".join(["%s"] * len(tables))
+
+    cursor.execute(f"""
+    UPDATE versioni_dati
+    SET versione = versione + 1
+    WHERE tabella IN ({placeholders})
+    """, tables)
+
+    cache = fredbconn.unit_cache()
+    if cache is not None:
+        cache.pop("data_versions", None)
+
+    fredbconn.call_after_commit(invalidate_local)
\ No newline at end of file
@@ -0,0 +1,161 @@
+"""Ranked surname search for the dipendenti, where every lookup is an index probe.
+
+Ranking:
+    1. prefix matches on cognome, exact matches first, read from indice_cognome
+    2. substring matches on cognome, from the ngram FULLTEXT index
+    3. similar names sharing some ngrams, from the same FULLTEXT index
+
+The /dipendenti listing pages the first two tiers with search_dipendenti_page, the suggestions of
+/dipendenti/cerca take the best matches of all three with search_dipendenti_ids.
+
+Requires migrations/003_dipendenti_search.sql
+"""
+
+try:
+    # First attempt direct import (works when running server.py)
+    import fredbconn
+    import pagination
+except ImportError:
+    # Fall back to package import (works when running the scripts from the root)
+    from python import fredbconn
+    from python import pagination
+
+# Must match ngram_token_size of the MySQL server (2 by default), shorter queries only match by prefix
+NGRAM_TOKEN_SIZE = 2
+
+MATCH_PREFIX = "prefisso"
+MATCH_SUBSTRING = "sottostringa"
+MATCH_SIMILAR = "simile"
+
+
+def normalize_query(text):
+    """Strips the query and collapses the inner whitespace."""
+    return " ".join((text or "").split())
+
+
+def escape_like(text):
+    """Escapes the LIKE wildcards, so the text only matches literally."""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _fulltext_ids(cursor, against, mode, limit, exclude, cognome_like=None):
+    """Returns the ids matching the FULLTEXT query, best score first, skipping the excluded ones.
+
+    The index covers cognome and nome together, cognome_like keeps only the hits matching on cognome.
+    """
+    condition, params = ("AND cognome LIKE %s", (cognome_like,)) if cognome_like is not None else ("", ())
+
+    cursor.execute(f"""
+    SELECT id
+    FROM dipendenti
+    WHERE MATCH(cognome, nome) AGAINST (%s IN {mode}) {condition}
+    ORDER BY MATCH(cognome, nome) AGAINST (%s IN {mode}) DESC, id ASC
+    LIMIT %s
+    """, (against, *params, against, limit + len(exclude)))
+
+    return [row[0] for row in cursor.fetchall() if row[0] not in exclude][:limit]
+
+
+@fredbconn.connected_to_database
+def search_dipendenti_ids(cursor, text, limit):
+    """Searches the dipendenti by surname.
+
+    Each tier only runs if the previous ones returned less than limit results.
+
+    Returns:
+        list: (id, match kind) tuples, best match first
+    """
+    text = normalize_query(text)
+    if not text:
+        return []
+
+    # The column collation is case and accent insensitive, so LIKE 'text%' is a range on indice_cognome
+    cursor.execute("""
+    SELECT id
+    FROM dipendenti
+    WHERE cognome LIKE %s
+    ORDER BY cognome ASC, id ASC
+    LIMIT %s
+    """, (escape_like(text) + "%", limit))
+
+    results = [(row[0], MATCH_PREFIX) for row in cursor.fetchall()]
+
+    if len(results) >= limit or len(text) < NGRAM_TOKEN_SIZE:
+        return results
+
+    found = {row_id for row_id, _ in results}
+    phrase = '"' + text.replace('"', " ") + '"'
+
+    substring = "%" + escape_like(text) + "%"
+
+    for against, mode, kind, cognome_like in ((phrase, "BOOLEAN MODE", MATCH_SUBSTRING, substring),
+                                              (text, "NATURAL LANGUAGE MODE", MATCH_SIMILAR, None)):
+        ids = _fulltext_ids(cursor, against, mode, limit - len(results), found, cognome_like)
+        results.extend((row_id, kind) for row_id in ids)
+        found.update(ids)
+
+        if len(results) >= limit:
+            break
+
+    return results
+
+
+@fredbconn.connected_to_database
+def search_dipendenti_page(cursor, text, key, backwards, limit):
+    """Fetches one keyset page of the surname search: the prefix matches, then the substring ones.
+
+    Both tiers are ordered by (cognome, id), so a cursor of pagination continues the tier its key is
+    in and skips the ones before it. The prefix tier is a range on indice_cognome, the substring tier
+    reads the hits of the FULLTEXT index, never the whole table.
+
+    Returns:
+        list: the ids of at most limit rows, in query order (the last first when backwards)
+    """
+    text = normalize_query(text)
+    if not text:
+        return []
+
+    prefix = escape_like(text) + "%"
+    tiers = [("cognome LIKE %s", (prefix,))]
+
+    if len(text) >= NGRAM_TOKEN_SIZE:
+        phrase = '"' + text.replace('"', " ") + '"'
+        tiers.append(("MATCH(cognome, nome) AGAINST (%s IN BOOLEAN MODE) AND cognome LIKE %s AND cognome NOT LIKE %s",
+                      (phrase, "%" + escape_like(text) + "%", prefix)))
+
+    key_tier = None
+    if key is not None:
+        # Compared as the column is, case and accent insensitive
+        cursor.execute("SELECT %s COLLATE utf8mb4_0900_ai_ci LIKE %s", (key[0], prefix))
+        key_tier = 0 if cursor.fetchone()[0] else 1
+
+    order = range(len(tiers) - 1, -1, -1) if backwards else range(len(tiers))
+    ids = []
+
+    for tier in order:
+        if key_tier is not None and (tier > key_tier if backwards else tier < key_tier):
+            continue
+
+        condition, params = tiers[tier]
+        conditions = [condition]
+        params = list(params)
+
+        if tier == key_tier:
+            keyset_sql, keyset_params = pagination.keyset_condition("cognome", "id", key, backwards)
+            conditions.append(keyset_sql)
+            params.extend(keyset_params)
+
+        cursor.execute(f"""
+        SELECT id
+        FROM dipendenti
+        WHERE {" AND ".join(conditions)}
+        ORDER BY {pagination.keyset_order("cognome", "id", backwards)}
+        LIMIT %s
+        """, (*params, limit - len(ids)))
+
+        ids.extend(row[0] for row in cursor.fetchall())
+
+        if len(ids) >= limit:
+            break
+
+    return ids
\ No newline at end of file
@@ -7,6 +7,9 @@ import traceback
 import gmail_oauth
 import fredbconn
 
+# The OAuth tokens table is checked once per process
+_oauth_table_checked = False
+
 class EmailManager:
     """Class to manage all email operations using Gmail OAuth 2.0."""
     
@@ -63,6 +66,10 @@ class EmailManager:
     
     def _ensure_oauth_table_exists(self):
         """Ensure that the OAuth tokens table exists in the database."""
+        global _oauth_table_checked
+        if _oauth_table_checked:
+            return
+        
         try:
             @fredbconn.connected_to_database
             def create_oauth_table(cursor):
@@ -82,7 +89,8 @@ class EmailManager:
                 )
                 """)
             
-            create_oauth_table()
+            # Checked again next time if the database returned an error
+            _oauth_table_checked = not isinstance(create_oauth_table(), str)
             self.logger.info("OAuth tokens table initialized")
         except Exception as e:
             self.logger.error(f"Error ensuring OAuth table exists: {str(e)}")
@@ -0,0 +1,123 @@
+"""In-process cache of the rendered rows of the ditte and dipendenti tables.
+
+A fragment is keyed on its route, its filter arguments and the versions of the tables it shows (see
+data_versions), so a write route bumping a version makes the next view render it again, in every
+process: a request reads the versions in its own transaction. The rest of the page (flash messages,
+lookup lists) is rendered live at every view.
+
+The fragments are evicted least recently used first, once their total size goes over max_bytes.
+"""
+
+import sys
+import threading
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+try:
+    # First attempt direct import (works when running server.py)
+    import data_versions
+except ImportError:
+    # Fall back to package import (works when running the scripts from the root)
+    from python import data_versions
+
+_enabled = True
+_max_bytes = 32 * 1024 * 1024
+
+_lock = threading.Lock()
+
+# key -> (html, data, size), the most recently used last
+_fragments = OrderedDict()
+_size = 0
+
+_hits = 0
+_misses = 0
+_evictions = 0
+
+
+def configure_fragment_cache(enabled=True, max_bytes=32 * 1024 * 1024):
+    """Switches the cache and sets the memory it may take"""
+    global _enabled, _max_bytes
+    _enabled = enabled
+    _max_bytes = max_bytes
+    clear()
+
+
+def make_key(route, args, tables):
+    """Returns the key of a fragment, to be taken before reading the data.
+
+    Args:
+        route (str): the route rendering the fragment
+        args (dict): the arguments selecting its rows, the None values are left out
+        tables (tuple): the tables it shows
+    """
+    # Read first: data changing while the fragment renders is keyed on the old version, never the new one
+    return (route, tuple(sorted((name, str(value)) for name, value in args.items() if value is not None)),
+            data_versions.version_of(*tables))
+
+
+def get(key):
+    """Returns the (html, data) of a fragment, None if not cached"""
+    global _hits, _misses
+
+    if not _enabled:
+        return None
+
+    with _lock:
+        entry = _fragments.get(key)
+        if entry is None:
+            _misses += 1
+            return None
+
+        _fragments.move_to_end(key)
+        _hits += 1
+
+    return Markup(entry[0]), entry[1]
+
+
+def put(key, html, data=None):
+    """Caches a rendered fragment, with the data the page needs along with it (e.g. the cursors of a page)"""
+    global _size, _evictions
+
+    if not _enabled:
+        return
+
+    html = str(html)
+    size = sys.getsizeof(html)
+
+    # A fragment taking most of the cache would evict everything else
+    if size > _max_bytes // 4:
+        return
+
+    with _lock:
+        old = _fragments.pop(key, None)
+        if old is not None:
+            _size -= old[2]
+
+        _fragments[key] = (html, data, size)
+        _size += size
+
+        while _size > _max_bytes and _fragments:
+            _, (_, _, evicted_size) = _fragments.popitem(last=False)
+            _size -= evicted_size
+            _evictions += 1
+
+
+def clear():
+    global _size
+    with _lock:
+        _fragments.clear()
+        _size = 0
+
+
+def stats():
+    """Returns the hits, misses, evictions and size of the cache"""
+    with _lock:
+        return {
+            "frammenti": len(_fragments),
+            "byte": _size,
+            "byte_massimi": _max_bytes,
+            "hit": _hits,
+            "miss": _misses,
+            "rimossi": _evictions,
+        }
\ No newline at end of file
@@ -2,6 +2,9 @@
 
 Functionality:
     Use the authorized function to ensure that the user is authorized
+    Use api_key_authorized for the endpoints called by other systems with an API key
+    Use invalidate_authorization when a user is disabled, removed or demoted
 """
 
-from .fred_auth import authorized
\ No newline at end of file
+from .fred_auth import authorized, api_key_authorized
+from .authorization_cache import configure_authorization_cache, invalidate_authorization
\ No newline at end of file
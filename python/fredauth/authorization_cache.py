@@ -0,0 +1,134 @@
+"""In-process cache of the authorization flags of the users, so that authorized doesn't query utenti on every request
+
+Configuration:
+    Call configure_authorization_cache to change the TTL or to enable the auth_version column,
+    which keeps multiple processes coherent (see migrations/001_utenti_auth_version.sql)
+"""
+
+import threading
+from time import monotonic
+import fredbconn
+
+_ttl_seconds = 30
+_use_version_column = False
+_version_poll_seconds = 5
+
+_lock = threading.Lock()
+
+# username -> ((is_admin, abilitato) or None if the user doesn't exist, fetched_at)
+_entries = {}
+
+_version_stamp = None
+_version_checked_at = None
+
+
+def configure_authorization_cache(ttl_seconds=30, use_version_column=False, version_poll_seconds=5):
+    """Configures the cache
+
+    With use_version_column the utenti table is polled at most every version_poll_seconds with one
+    cheap aggregate query, and the whole cache is dropped when any user changed, so ttl_seconds can be long.
+    """
+    global _ttl_seconds, _use_version_column, _version_poll_seconds
+    global _version_stamp, _version_checked_at
+
+    with _lock:
+        _ttl_seconds = ttl_seconds
+        _use_version_column = use_version_column
+        _version_poll_seconds = version_poll_seconds
+        _entries.clear()
+        _version_stamp = None
+        _version_checked_at = None
+
+
+@fredbconn.connected_to_database
+def _fetch_authorization(cursor, username):
+    cursor.execute("""
+    SELECT is_admin, abilitato
+    FROM utenti
+    WHERE username = %s
+    """, (username,))
+    return cursor.fetchone()
+
+
+@fredbconn.connected_to_database
+def _fetch_version_stamp(cursor):
+    cursor.execute("""
+    SELECT COUNT(*), COALESCE(MAX(id), 0), COALESCE(SUM(auth_version), 0)
+    FROM utenti
+    """)
+    return tuple(int(value) for value in cursor.fetchone())
+
+
+@fredbconn.connected_to_database
+def _bump_auth_version(cursor, username):
+    cursor.execute("""
+    UPDATE utenti
+    SET auth_version = auth_version + 1
+    WHERE username = %s
+    """, (username,))
+
+
+def _check_version(now):
+    """Drops the whole cache if the version stamp of utenti changed since the last poll"""
+    global _version_stamp, _version_checked_at
+
+    with _lock:
+        if _version_checked_at is not None and now - _version_checked_at < _version_poll_seconds:
+            return
+        _version_checked_at = now
+
+    stamp = _fetch_version_stamp()
+    if isinstance(stamp, str):
+        return
+
+    with _lock:
+        if stamp != _version_stamp:
+            _entries.clear()
+            _version_stamp = stamp
+
+
+def get_authorization(username):
+    """Returns the (is_admin, abilitato) tuple of the user, None if the user doesn't exist
+
+    Raises:
+        ConnectionError if the flags are not cached and the database can't be read
+    """
+    now = monotonic()
+
+    if _use_version_column:
+        _check_version(now)
+
+    with _lock:
+        entry = _entries.get(username)
+
+    if entry is not None and now - entry[1] < _ttl_seconds:
+        return entry[0]
+
+    fetched = _fetch_authorization(username)
+
+    # The decorator returns the error as a string, which must never be cached
+    if isinstance(fetched, str):
+        raise ConnectionError(fetched)
+
+    flags = None if fetched is None else (fetched[0], fetched[1])
+
+    with _lock:
+        _entries[username] = (flags, now)
+
+    return flags
+
+
+def invalidate_authorization(username=None, bump_version=True):
+    """Forgets the cached flags of a user, or of every user if username is None
+
+    Call it whenever a user is disabled, removed or demoted. With the version column enabled the
+    auth_version of the user is also bumped, so the other processes drop their cache at the next poll.
+    """
+    with _lock:
+        if username is None:
+            _entries.clear()
+        else:
+            _entries.pop(username, None)
+
+    if _use_version_column and bump_version and username is not None:
+        _bump_auth_version(username)
\ No newline at end of file
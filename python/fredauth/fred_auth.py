@@ -1,12 +1,14 @@
+import hmac
 from functools import wraps
-from flask import flash, redirect, session, render_template, request, url_for
-import fredbconn
+from flask import flash, jsonify, redirect, session, render_template, request, url_for
+from .authorization_cache import get_authorization
 
 def authorized(auth_type):
     """Decorator to censure authorized access to a server
 
     Usage:
         Use as decorator to the function to force the authorization in, and the authorization will be forced
+        The flags of the user are read through the authorization cache, see invalidate_authorization
     """
     def decorator(fn):
     
@@ -14,42 +16,53 @@ def authorized(auth_type):
         def ret_func(*args, **kwargs):
             if 'user' in session:
 
+                try:
+                    result = get_authorization(session["user"])
+                except ConnectionError:
+                    flash("Impossibile verificare le autorizzazioni, riprovare più tardi", "error")
+                    return redirect("/login")
+
+                if result is None:
+                    flash("Il suo account è stato rimosso.", "error")
+                    return redirect("/login")
+
+                is_admin, abilitato = result
+
                 if(auth_type == "admin"):
-                    @fredbconn.connected_to_database
-                    def fetch_is_admin(cursor):
-                        cursor.execute("""
-                        SELECT is_admin
-                        FROM utenti
-                        WHERE username = %s
-                        """, (session["user"],))
-                        return cursor.fetchone()
-                    
-                    # Will never return None because of previous check
-                    if fetch_is_admin()[0] == 0:
+                    if is_admin == 0:
                         flash("Il suo account non dispone delle autorizzazioni necessarie per questa operazione", "error")
                         return redirect(request.referrer or url_for("/")) 
 
                 if(auth_type == "user"):
-                    @fredbconn.connected_to_database
-                    def fetch_abilitato(cursor):
-                        cursor.execute("""
-                        SELECT abilitato
-                        FROM utenti
-                        WHERE username = %s
-                        """, (session["user"],))
-                        return cursor.fetchone()
-
-                    result = fetch_abilitato()
-
-                    if result is None:
-                        flash("Il suo account è stato rimosso.", "error")
-                        return redirect("/login")
-
-                    if result[0] == 0:
+                    if abilitato == 0:
                         flash("Il suo account è stato disabilitato.", "error")
                         return redirect("/login")
 
                 return fn(*args, **kwargs)
             else: return render_template("login.html")
         return ret_func
+    return decorator
+
+
+def api_key_authorized(api_keys):
+    """Decorator for the endpoints called by other systems, e.g. the turnstiles, without a session
+
+    Usage:
+        Use as decorator with the accepted keys, the request must send one of them in the X-API-Key header
+        Without a valid key it answers 401 with a JSON error, never the login page
+    """
+    accepted = [key.encode() for key in api_keys]
+
+    def decorator(fn):
+
+        @wraps(fn)
+        def ret_func(*args, **kwargs):
+            sent = request.headers.get("X-API-Key", "").encode()
+
+            # Every key is compared in constant time, so the timing doesn't tell how much of a key matched
+            if not sent or not any([hmac.compare_digest(sent, key) for key in accepted]):
+                return jsonify({"error": "Chiave API mancante o non valida"}), 401
+
+            return fn(*args, **kwargs)
+        return ret_func
     return decorator
\ No newline at end of file
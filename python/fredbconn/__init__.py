@@ -2,6 +2,23 @@
 
 Initialization:
     call initialize_database before using database
+
+Unit of work:
+    call init_app(app) to share one connection per Flask request, or use unit_of_work() in scripts
+
+Pool metrics:
+    call configure_pool before initialize_database, read them with pool_stats
+
+Profiling:
+    call configure_profiling, or profiling.set_enabled at runtime, read it with profiling.report
 """
 
-from .database_connections import initialize_database, connected_to_database, fetch_generator
\ No newline at end of file
+from .database_connections import initialize_database, connected_to_database, fetch_generator
+from .database_connections import connected_to_database_streaming
+from .database_connections import init_app, unit_of_work, begin_unit_of_work, end_unit_of_work, in_unit_of_work
+from .database_connections import unit_cache
+from .database_connections import db_time
+from .database_connections import call_after_commit, named_lock
+from .database_connections import configure_pool, pool_stats
+from . import profiling
+from .profiling import configure_profiling
\ No newline at end of file
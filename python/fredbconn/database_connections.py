@@ -2,16 +2,53 @@
 
 Initialization:
     Call initialize_database before using the decorator
+
+Unit of work:
+    Inside unit_of_work (or a Flask request, after init_app) every decorated call shares
+    one connection and one transaction, committed once at the end of the unit.
+
+Pool metrics:
+    Every checkout is timed and its connection checked, see pool_metrics and pool_stats.
+    Call configure_pool before initialize_database to warm up the pool or size it adaptively.
+
+Profiling:
+    When switched on, every decorated call and every statement is timed, see profiling.
 """
 
 import pymysql
+import pymysql.cursors
+import threading
+import time
 import traceback
+from contextlib import contextmanager
 from dbutils.pooled_db import PooledDB
 from functools import wraps
 from time import sleep
 
+from . import profiling
+from .pool_metrics import PoolMetrics, Tuner
+
 pool = None
 
+# PoolMetrics of the pool, created with it
+metrics = None
+
+_tuner = None
+
+_pool_settings = {
+    "ping": True,
+    "warm_up": 0,
+    "min_connections": None,
+    "resize_seconds": 30,
+    "slow_wait_ms": 50,
+}
+
+# Per-thread state of the active unit of work, see begin_unit_of_work
+_unit = threading.local()
+
+# Per-thread callbacks waiting for the commit of a decorated call outside of a unit of work
+_call = threading.local()
+
 def initialize_database(max_total_connections, min_cached_connections,
                         max_cached_connections, database_host, database_user, database_password, database_name):
     """Function to be called to initialize the database pool of connections
@@ -33,20 +70,38 @@ def initialize_database(max_total_connections, min_cached_connections,
     )
 
 
+def configure_pool(ping=True, warm_up=0, min_connections=None, resize_seconds=30, slow_wait_ms=50):
+    """Sets the tuning of the pool, takes passwords.pool_config as keyword arguments.
+
+    Args:
+        ping (bool): check every connection taken from the pool, reopening the ones closed by MySQL
+            after wait_timeout
+        warm_up (int): connections opened in background right after the pool is created
+        min_connections (int, optional): lower bound of the adaptive limit, the maxconnections of the
+            pool being the upper one. None keeps the limit at maxconnections
+        resize_seconds (int): how often the adaptive limit is moved
+        slow_wait_ms (int): a checkout waiting longer than this makes the limit grow
+    """
+    _pool_settings.update(ping=ping, warm_up=warm_up, min_connections=min_connections,
+                          resize_seconds=resize_seconds, slow_wait_ms=slow_wait_ms)
+
+
 def initialize_database(max_total_connections, min_cached_connections,
                         max_cached_connections, database_host, database_user,
                         database_password, database_name):
     """Function to initialize the database pool of connections.
     It will retry until MySQL is available.
     """
-    global pool
+    global pool, metrics, _tuner
 
+    # ping=0: the connections are checked by _checkout, which counts the dead ones
     pool = PooledDB(
                 creator=pymysql,
                 maxconnections=max_total_connections,
                 mincached=min_cached_connections,
                 maxcached=max_cached_connections,
                 blocking=True,
+                ping=0,
                 host=database_host,
                 user=database_user,
                 password=database_password,
@@ -63,29 +118,340 @@ def initialize_database(max_total_connections, min_cached_connections,
         except pymysql.Error as e:
             sleep(10)  # Wait for 10 seconds before retrying
 
+    metrics = PoolMetrics(max_total_connections, _pool_settings["min_connections"], _pool_settings["slow_wait_ms"])
+
+    if _pool_settings["warm_up"] or metrics.adaptive:
+        _tuner = Tuner(pool, metrics, _pool_settings["warm_up"], _pool_settings["resize_seconds"])
+        _tuner.start()
+
+
+def _checkout():
+    """Takes a connection from the pool through the gate of the metrics.
+
+    Returns:
+        tuple: (connection, checkout time) to give back to _checkin
+    """
+    started = time.perf_counter()
+    in_use = metrics.gate.acquire()
+    try:
+        conn = pool.connection()
+    except Exception:
+        metrics.gate.release()
+        metrics.failed()
+        raise
+
+    if _pool_settings["ping"]:
+        try:
+            conn.ping(False)
+        except Exception:
+            # Closed by MySQL, e.g. after wait_timeout: pymysql opens it again
+            metrics.dead()
+            try:
+                conn.ping(True)
+            except Exception:
+                conn.close()
+                metrics.gate.release()
+                metrics.failed()
+                raise
+
+    checked_out_at = time.perf_counter()
+    metrics.checked_out((checked_out_at - started) * 1000, in_use)
+    return conn, checked_out_at
+
+
+def _checkin(conn, checked_out_at):
+    """Gives the connection of _checkout back to the pool"""
+    try:
+        conn.close()
+    finally:
+        metrics.checked_in((time.perf_counter() - checked_out_at) * 1000)
+        metrics.gate.release()
+
+
+def pool_stats():
+    """Returns the metrics of the pool as a dict, None before initialize_database"""
+    if metrics is None:
+        return None
+    return metrics.snapshot()
+
+def begin_unit_of_work():
+    """Starts a unit of work on the current thread.
+
+    The connection is checked out lazily by the first decorated call, so a unit that never
+    touches the database costs nothing. Units can be nested, only the outermost one commits.
+    """
+    if getattr(_unit, "depth", 0) > 0:
+        _unit.depth += 1
+        return
+
+    _unit.depth = 1
+    _unit.connection = None
+    _unit.checked_out_at = None
+    _unit.failed = False
+    _unit.db_time = 0.0
+    _unit.after_commit = []
+    _unit.cache = {}
+
+
+def end_unit_of_work(commit=True):
+    """Ends the unit of work started by begin_unit_of_work.
+
+    The shared transaction is committed, or rolled back if commit is False or if any
+    decorated call inside the unit failed, and the connection goes back to the pool.
+
+    Returns:
+        bool: False if the unit was rolled back or its commit failed, so nothing it wrote was kept
+    """
+    depth = getattr(_unit, "depth", 0)
+    if depth == 0:
+        return True
+
+    if not commit:
+        _unit.failed = True
+
+    _unit.depth = depth - 1
+    if _unit.depth > 0:
+        return True
+
+    conn = _unit.connection
+    checked_out_at = _unit.checked_out_at
+    callbacks = _unit.after_commit
+    _unit.connection = None
+    _unit.after_commit = []
+
+    if conn is None:
+        if _unit.failed:
+            return False
+        _run_callbacks(callbacks)
+        return True
+
+    committed = False
+    started = time.perf_counter()
+    try:
+        if commit and not _unit.failed:
+            conn.commit()
+            committed = True
+        else:
+            conn.rollback()
+            callbacks = []
+    except Exception:
+        traceback.print_exc()
+        callbacks = []
+    finally:
+        _checkin(conn, checked_out_at)
+        _unit.db_time += time.perf_counter() - started
+
+    _run_callbacks(callbacks)
+    return committed
+
+
+def db_time():
+    """Returns the seconds the current, or last, unit of work of this thread spent in the database,
+    checkouts and commit included
+    """
+    return getattr(_unit, "db_time", 0.0)
+
+
+def _run_callbacks(callbacks):
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception:
+            traceback.print_exc()
+
+
+def call_after_commit(callback):
+    """Runs callback once the current transaction is committed, to invalidate in-process caches.
+
+    Inside a unit of work it runs after the unit commits and is dropped if the unit rolls back,
+    inside a decorated call it runs after the decorator commits, otherwise it runs immediately.
+    """
+    if in_unit_of_work():
+        _unit.after_commit.append(callback)
+        return
+
+    pending = getattr(_call, "after_commit", None)
+    if pending is not None:
+        pending.append(callback)
+        return
+
+    callback()
+
+
+def in_unit_of_work():
+    """Returns True if the current thread is inside a unit of work."""
+    return getattr(_unit, "depth", 0) > 0
+
+
+def unit_cache():
+    """Returns a dict living as long as the current unit of work, None outside of one.
+
+    For the values that must come from the transaction of the unit, e.g. the data versions.
+    """
+    return _unit.cache if in_unit_of_work() else None
+
+
+@contextmanager
+def unit_of_work():
+    """Context manager running the block as one unit of work, usable from the cron scripts.
+
+    Usage:
+        with fredbconn.unit_of_work():
+            recipients = fetch_recipients()
+            report = generate_report()
+    """
+    begin_unit_of_work()
+    try:
+        yield
+    except BaseException:
+        end_unit_of_work(commit=False)
+        raise
+    end_unit_of_work()
+
+
+def init_app(app):
+    """Opts a Flask app into one unit of work per request.
+
+    The transaction is committed in after_request, before the response leaves the server,
+    so a redirect after a POST always sees its own writes. When the unit is rolled back instead,
+    because a decorated call failed or the commit did, the response becomes a 500 and its flash
+    messages are dropped, so nothing tells the user that a write was saved. teardown_request only
+    cleans up requests that ended with an unhandled exception.
+    """
+    from flask import session
+    from werkzeug.exceptions import InternalServerError
+
+    @app.before_request
+    def _fredbconn_begin_unit_of_work():
+        begin_unit_of_work()
+
+    @app.after_request
+    def _fredbconn_commit_unit_of_work(response):
+        if end_unit_of_work(commit=response.status_code < 500) or response.status_code >= 500:
+            return response
+
+        session.pop("_flashes", None)
+        return app.make_response(InternalServerError())
+
+    @app.teardown_request
+    def _fredbconn_close_unit_of_work(exc):
+        while in_unit_of_work():
+            end_unit_of_work(commit=False)
+
+
+def _unit_connection():
+    """Returns the connection of the current unit of work, checking it out if needed."""
+    if _unit.connection is None:
+        _unit.connection, _unit.checked_out_at = _checkout()
+    return _unit.connection
+
+
 def connected_to_database(fn):
     """Decorator to connect to database
 
     Usage:
         Passes as first parameter a cursor to work with the database and execute commands and fetch results.
         All actions performed inside the db are inside a big transaction, which is committed by the decorator when the function ends.
+        Inside a unit of work the connection and the transaction are shared with the other decorated calls,
+        and a failure rolls back the whole unit.
+    """
+    return _connected(fn)
+
+
+def connected_to_database_streaming(fn):
+    """Decorator like connected_to_database, passing an unbuffered cursor
+
+    Usage:
+        The rows are read from the server while iterating with fetch_generator, so they must all be consumed
+        inside the decorated function, and no other query can run on the cursor until then.
     """
+    return _connected(fn, pymysql.cursors.SSCursor)
+
+
+def _connected(fn, cursor_class=None):
+    cursor_args = () if cursor_class is None else (cursor_class,)
+    name = f"{fn.__module__}.{fn.__qualname__}"
+
+    def call(cursor, args, kwargs):
+        if not profiling.is_enabled():
+            return fn(cursor, *args, **kwargs)
+
+        started = time.perf_counter()
+        failed = True
+        try:
+            ret = fn(profiling.ProfilingCursor(cursor, name), *args, **kwargs)
+            failed = False
+            return ret
+        finally:
+            profiling.record_call(name, (time.perf_counter() - started) * 1000, failed)
+
     @wraps(fn)
     def ret_func(*args, **kwargs):
-        conn = pool.connection()
+        if in_unit_of_work():
+            ret = None
+            started = time.perf_counter()
+            try:
+                with _unit_connection().cursor(*cursor_args) as cursor:
+                    ret = call(cursor, args, kwargs)
+            except Exception as e:
+                traceback.print_exc()
+                _unit.failed = True
+                ret = f"Error: {e}"
+            finally:
+                _unit.db_time += time.perf_counter() - started
+                return ret
+
         try:
-            with conn.cursor() as cursor:
-                ret = fn(cursor, *args, **kwargs)
+            conn, checked_out_at = _checkout()
+        except Exception as e:
+            traceback.print_exc()
+            return f"Error: {e}"
+
+        previous_callbacks = getattr(_call, "after_commit", None)
+        _call.after_commit = callbacks = []
+        try:
+            with conn.cursor(*cursor_args) as cursor:
+                ret = call(cursor, args, kwargs)
                 conn.commit()
+            _call.after_commit = previous_callbacks
+            _run_callbacks(callbacks)
         except Exception as e:
             traceback.print_exc()
             ret = f"Error: {e}"
         finally:
-            conn.close()
+            _call.after_commit = previous_callbacks
+            _checkin(conn, checked_out_at)
             return ret
     return ret_func
 
 
+@contextmanager
+def named_lock(name, timeout=0):
+    """Context manager holding a MySQL named lock (GET_LOCK) on a dedicated connection, to run something
+    in only one process at a time.
+
+    Usage:
+        with fredbconn.named_lock("acca_job_weekly_report") as acquired:
+            if acquired:
+                run_job()
+
+    The lock is released when the block ends, or by MySQL if the process dies.
+    """
+    conn, checked_out_at = _checkout()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT GET_LOCK(%s, %s)", (name, timeout))
+            acquired = cursor.fetchone()[0] == 1
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT RELEASE_LOCK(%s)", (name,))
+    finally:
+        _checkin(conn, checked_out_at)
+
+
 def fetch_generator(cursor):
     """Yields rows one by one from a cursor."""
     while True:
@@ -0,0 +1,242 @@
+"""Metrics and tuning of the connection pool: wait and hold time histograms, liveness checks, warm-up
+and adaptive sizing.
+
+Every checkout of database_connections goes through a Gate, a resizable limit in front of PooledDB:
+the time spent waiting for it and for the connection is the wait time, the time until the connection
+goes back to the pool is the hold time. With min_connections lower than the maxconnections of the
+pool, the Tuner thread moves the limit between the two: it grows when the checkouts waited more than
+slow_wait_ms or are still waiting, and shrinks when most of the connections were idle, so a quiet server holds fewer of
+them. The connections above maxcached are closed by PooledDB when given back.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger("fredbconn")
+
+# Upper bounds in milliseconds of the buckets of the histograms, the last one is unbounded
+BUCKETS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram:
+    """Counts of durations by bucket, cheap enough to record every checkout"""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, ms):
+        # Linear scan: fewer than 15 buckets and most durations fall in the first ones
+        index = 0
+        while index < len(BUCKETS_MS) and ms > BUCKETS_MS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def percentile(self, fraction):
+        """Returns the upper bound of the bucket holding the given fraction of the durations"""
+        if not self.count:
+            return None
+        threshold = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= threshold:
+                return BUCKETS_MS[index] if index < len(BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "total_ms": round(self.total_ms, 3),
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else None,
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "buckets": [[bound, count] for bound, count in zip(list(BUCKETS_MS) + ["+Inf"], self.counts)],
+        }
+
+
+class Gate:
+    """Limit of the connections checked out at once, which can be moved while in use.
+
+    A thread already holding a connection passes through: its nested checkout, e.g. the progress
+    updates of a report job or the job run under a named lock, would otherwise wait for a connection
+    only it can give back, and with every held connection waiting so the gate would never open.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+        self._held = threading.local()
+
+    def acquire(self):
+        held = getattr(self._held, "count", 0)
+        self._held.count = held + 1
+
+        with self.condition:
+            if held == 0 and self.limit and self.in_use >= self.limit:
+                self.waiting += 1
+                try:
+                    while self.limit and self.in_use >= self.limit:
+                        self.condition.wait()
+                finally:
+                    self.waiting -= 1
+            self.in_use += 1
+            return self.in_use
+
+    def release(self):
+        self._held.count -= 1
+
+        with self.condition:
+            self.in_use -= 1
+            self.condition.notify()
+
+    def resize(self, limit):
+        with self.condition:
+            self.limit = limit
+            self.condition.notify_all()
+
+
+class PoolMetrics:
+    """Counters and histograms of the checkouts of one pool, since its creation"""
+    def __init__(self, max_connections, min_connections=None, slow_wait_ms=50):
+        self.max_connections = max_connections
+        self.min_connections = min(min_connections or max_connections, max_connections) if max_connections else 0
+        self.slow_wait_ms = slow_wait_ms
+
+        self.gate = Gate(max_connections)
+        self.lock = threading.Lock()
+        self.wait = Histogram()
+        self.hold = Histogram()
+        self.checkouts = 0
+        self.failed_checkouts = 0
+        self.dead_connections = 0
+        self.peak_in_use = 0
+        self.resizes = 0
+        self.created_at = time.time()
+
+        # Reset by the Tuner at every look
+        self.window_peak = 0
+        self.window_slow_waits = 0
+
+    @property
+    def adaptive(self):
+        return bool(self.max_connections) and self.min_connections < self.max_connections
+
+    def checked_out(self, wait_ms, in_use):
+        with self.lock:
+            self.checkouts += 1
+            self.wait.record(wait_ms)
+            if in_use > self.peak_in_use:
+                self.peak_in_use = in_use
+            if in_use > self.window_peak:
+                self.window_peak = in_use
+            if wait_ms > self.slow_wait_ms:
+                self.window_slow_waits += 1
+
+    def checked_in(self, hold_ms):
+        with self.lock:
+            self.hold.record(hold_ms)
+
+    def failed(self):
+        with self.lock:
+            self.failed_checkouts += 1
+
+    def dead(self):
+        with self.lock:
+            self.dead_connections += 1
+
+    def take_window(self):
+        """Returns (peak of the connections in use, slow waits) since the last call"""
+        with self.lock:
+            window = (max(self.window_peak, self.gate.in_use), self.window_slow_waits)
+            self.window_peak = 0
+            self.window_slow_waits = 0
+            return window
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "limite": self.gate.limit,
+                "minimo": self.min_connections,
+                "massimo": self.max_connections,
+                "in_uso": self.gate.in_use,
+                "in_attesa": self.gate.waiting,
+                "picco_in_uso": self.peak_in_use,
+                "checkout": self.checkouts,
+                "checkout_falliti": self.failed_checkouts,
+                "connessioni_morte": self.dead_connections,
+                "ridimensionamenti": self.resizes,
+                "attesa": self.wait.snapshot(),
+                "utilizzo": self.hold.snapshot(),
+                "da_secondi": round(time.time() - self.created_at),
+            }
+
+
+class Tuner(threading.Thread):
+    """Thread warming up the pool once, then moving the limit of the gate every resize_seconds"""
+    def __init__(self, pool, metrics, warm_up=0, resize_seconds=30):
+        super().__init__(name="fredbconn-pool", daemon=True)
+        self.pool = pool
+        self.metrics = metrics
+        self.warm_up = warm_up
+        self.resize_seconds = resize_seconds
+        self.stop_event = threading.Event()
+
+    def _warm_up(self):
+        """Opens warm_up connections at once and gives them back, so that they wait in the idle cache"""
+        count = min(self.warm_up, self.metrics.gate.limit or self.warm_up)
+        connections = []
+        try:
+            for _ in range(count):
+                connections.append(self.pool.connection())
+        except Exception:
+            logger.exception("Error warming up the connection pool")
+        finally:
+            for connection in connections:
+                connection.close()
+        logger.info(f"Connection pool warmed up with {len(connections)} connections")
+
+    def _resize(self):
+        metrics = self.metrics
+        peak, slow_waits = metrics.take_window()
+        limit = metrics.gate.limit
+        waiting = metrics.gate.waiting
+
+        # The checkouts still blocked count as much as the ones that waited
+        if (slow_waits or waiting) and limit < metrics.max_connections:
+            new_limit = min(metrics.max_connections, limit + max(1, limit // 4))
+        elif peak * 2 < limit and limit > metrics.min_connections:
+            new_limit = max(metrics.min_connections, limit - 1)
+        else:
+            return
+
+        metrics.gate.resize(new_limit)
+        with metrics.lock:
+            metrics.resizes += 1
+        logger.info(f"Connection pool limit moved from {limit} to {new_limit} "
+                    f"(peak in use {peak}, slow waits {slow_waits}, waiting {waiting})")
+
+    def run(self):
+        if self.warm_up:
+            self._warm_up()
+
+        if not self.metrics.adaptive:
+            return
+
+        while not self.stop_event.wait(self.resize_seconds):
+            try:
+                self._resize()
+            except Exception:
+                logger.exception("Error resizing the connection pool")
+
+    def stop(self):
+        self.stop_event.set()
\ No newline at end of file
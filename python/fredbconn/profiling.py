@@ -0,0 +1,318 @@
+"""Profiling of the decorated database functions and of their statements, off by default.
+
+When enabled, the decorators of database_connections time every call and hand the function a cursor
+timing every execute. The statements are aggregated by fingerprint, the SQL with the literals and the
+placeholders replaced by ?, so that the same inline query with different values counts once. The
+statements slower than slow_ms go to a rotating log, with their EXPLAIN if explain_slow is set,
+otherwise the EXPLAIN of the last slow sample of a fingerprint is run on demand, see explain.
+
+The state is per process: with several workers, see serving.py, each one profiles its own requests.
+"""
+
+import logging
+import logging.handlers
+import os
+import re
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+
+import pymysql.cursors
+
+# Durations kept per fingerprint to compute the percentiles, the most recent ones
+SAMPLES = 512
+
+# Rowcount of an SSCursor after execute, before its rows are read
+UNKNOWN_ROWCOUNT = 2 ** 64 - 1
+
+# Statements MySQL can EXPLAIN
+EXPLAINABLE = ("SELECT", "UPDATE", "DELETE", "INSERT", "REPLACE")
+
+_settings = {
+    "enabled": False,
+    "slow_ms": 200,
+    "explain_slow": False,
+    "log_file": os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                             "query-logs", "slow-queries.log"),
+    "max_bytes": 5 * 1024 * 1024,
+    "backup_count": 5,
+}
+
+_lock = threading.Lock()
+
+# fingerprint -> _Stat of the statements, function name -> _Stat of the decorated calls
+_statements = {}
+_calls = {}
+
+_slow_logger = None
+
+
+def configure_profiling(enabled=False, slow_ms=200, explain_slow=False, log_file=None,
+                        max_bytes=5 * 1024 * 1024, backup_count=5):
+    """Sets the profiling up, takes passwords.profiling_config as keyword arguments.
+
+    Args:
+        enabled (bool): profile from the start, otherwise only once switched on with set_enabled
+        slow_ms (int): statements slower than this are written to the slow log
+        explain_slow (bool): write the EXPLAIN of the slow SELECTs with them, an extra query for each
+        log_file (str, optional): the slow log, query-logs/slow-queries.log by default
+        max_bytes (int): size of the slow log before it rotates
+        backup_count (int): rotated slow logs kept
+    """
+    global _slow_logger
+
+    _settings.update(enabled=enabled, slow_ms=slow_ms, explain_slow=explain_slow,
+                     max_bytes=max_bytes, backup_count=backup_count)
+    if log_file:
+        _settings["log_file"] = log_file
+
+    # Opened again with the new settings at the next slow statement
+    with _lock:
+        if _slow_logger is not None:
+            for handler in list(_slow_logger.handlers):
+                _slow_logger.removeHandler(handler)
+                handler.close()
+        _slow_logger = None
+
+
+def is_enabled():
+    return _settings["enabled"]
+
+
+def set_enabled(enabled, slow_ms=None, explain_slow=None):
+    """Switches the profiling at runtime, in this process"""
+    _settings["enabled"] = bool(enabled)
+    if slow_ms is not None:
+        _settings["slow_ms"] = slow_ms
+    if explain_slow is not None:
+        _settings["explain_slow"] = bool(explain_slow)
+
+
+def settings():
+    return {
+        "attivo": _settings["enabled"],
+        "soglia_ms": _settings["slow_ms"],
+        "explain_lente": _settings["explain_slow"],
+        "log": _settings["log_file"],
+    }
+
+
+_COMMENTS = re.compile(r"/\*.*?\*/|--[^\n]*", re.S)
+_STRINGS = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBERS = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDERS = re.compile(r"%s|%\(\w+\)s")
+_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACES = re.compile(r"\s+")
+
+
+@lru_cache(maxsize=2048)
+def fingerprint(sql):
+    """Returns the SQL with comments, literals and placeholders normalized, e.g. IN (%s, %s) -> IN (?+)"""
+    sql = _COMMENTS.sub(" ", sql)
+    sql = _STRINGS.sub("?", sql)
+    sql = _NUMBERS.sub("?", sql)
+    sql = _PLACEHOLDERS.sub("?", sql)
+    sql = _LISTS.sub("(?+)", sql)
+    return _SPACES.sub(" ", sql).strip()
+
+
+class _Stat:
+    """Count, errors and durations of a fingerprint or a function"""
+    __slots__ = ("count", "errors", "rows", "total_ms", "max_ms", "samples", "last_sql", "last_args", "last_slow_at")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.samples = deque(maxlen=SAMPLES)
+        self.last_sql = None
+        self.last_args = None
+        self.last_slow_at = None
+
+    def record(self, ms, failed=False, rows=0):
+        self.count += 1
+        self.total_ms += ms
+        self.rows += rows
+        if failed:
+            self.errors += 1
+        if ms > self.max_ms:
+            self.max_ms = ms
+        self.samples.append(ms)
+
+    def snapshot(self):
+        samples = sorted(self.samples)
+
+        def percentile(fraction):
+            return round(samples[min(len(samples) - 1, int(fraction * len(samples)))], 3) if samples else None
+
+        return {
+            "count": self.count,
+            "errori": self.errors,
+            "righe": self.rows,
+            "totale_ms": round(self.total_ms, 3),
+            "media_ms": round(self.total_ms / self.count, 3) if self.count else None,
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": percentile(0.5),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "ultima_lenta": self.last_slow_at,
+        }
+
+
+def _stat(table, key):
+    stat = table.get(key)
+    if stat is None:
+        stat = table.setdefault(key, _Stat())
+    return stat
+
+
+def _get_slow_logger():
+    global _slow_logger
+
+    if _slow_logger is not None:
+        return _slow_logger
+
+    with _lock:
+        if _slow_logger is None:
+            # Created only once a statement is slow, as the crash logs of server.py
+            os.makedirs(os.path.dirname(_settings["log_file"]), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                _settings["log_file"], maxBytes=_settings["max_bytes"],
+                backupCount=_settings["backup_count"], encoding="utf-8",
+            )
+            handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s"))
+
+            slow_logger = logging.getLogger("fredbconn.slow")
+            slow_logger.setLevel(logging.INFO)
+            slow_logger.propagate = False
+            slow_logger.addHandler(handler)
+            _slow_logger = slow_logger
+
+    return _slow_logger
+
+
+def record_call(name, ms, failed=False):
+    """Records the duration of a decorated function"""
+    with _lock:
+        _stat(_calls, name).record(ms, failed)
+
+
+def _record_statement(cursor, function, sql, args, ms, failed, rows, many=False):
+    key = fingerprint(sql)
+    slow = ms >= _settings["slow_ms"]
+
+    with _lock:
+        stat = _stat(_statements, key)
+        stat.record(ms, failed, rows)
+        if slow and not many:
+            # The values stay in memory for explain, the log only gets the fingerprint
+            stat.last_sql = sql
+            stat.last_args = args
+            stat.last_slow_at = time.strftime("%Y-%m-%d %H:%M:%S")
+
+    if not slow:
+        return
+
+    message = f"{ms:.1f} ms in {function}: {key}"
+    # Not for executemany, nor on an unbuffered cursor, whose unread rows another query would discard
+    if (_settings["explain_slow"] and not failed and not many and _is_explainable(sql)
+            and not isinstance(cursor, pymysql.cursors.SSCursor)):
+        try:
+            message += "\n" + _format_explain(_run_explain(cursor, sql, args))
+        except Exception as e:
+            message += f"\nEXPLAIN non riuscito: {e}"
+
+    _get_slow_logger().info(message)
+
+
+def _is_explainable(sql):
+    return _COMMENTS.sub(" ", sql).split(None, 1)[0].upper() in EXPLAINABLE
+
+
+def _run_explain(cursor, sql, args):
+    """Runs the EXPLAIN on a new cursor of the same connection, so the rows of the statement stay readable"""
+    with cursor.connection.cursor() as explain_cursor:
+        explain_cursor.execute("EXPLAIN " + sql, args)
+        columns = [column[0] for column in explain_cursor.description]
+        return [dict(zip(columns, row)) for row in explain_cursor.fetchall()]
+
+
+def _format_explain(rows):
+    return "\n".join("    " + ", ".join(f"{key}={value}" for key, value in row.items() if value is not None)
+                     for row in rows)
+
+
+def explain(cursor, key):
+    """Runs the EXPLAIN of the last slow sample of a fingerprint, call it through connected_to_database.
+
+    Returns:
+        list: the rows of the EXPLAIN as dicts, None if the fingerprint has no slow sample to explain
+    """
+    with _lock:
+        stat = _statements.get(key)
+        sql, args = (stat.last_sql, stat.last_args) if stat is not None else (None, None)
+
+    if sql is None or not _is_explainable(sql):
+        return None
+
+    return _run_explain(cursor, sql, args)
+
+
+class ProfilingCursor:
+    """Cursor timing its execute and executemany, everything else goes to the wrapped cursor"""
+    def __init__(self, cursor, function):
+        self._cursor = cursor
+        self._function = function
+
+    def _timed(self, method, sql, args, many=False):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = method(sql, args)
+            failed = False
+            return result
+        finally:
+            ms = (time.perf_counter() - started) * 1000
+            rows = self._cursor.rowcount if not failed else 0
+            # Unknown on an unbuffered cursor until its rows are read, pymysql sets it to 2**64 - 1 meanwhile
+            if rows is None or rows < 0 or rows >= UNKNOWN_ROWCOUNT:
+                rows = 0
+            _record_statement(self._cursor, self._function, sql, args, ms, failed, rows, many)
+
+    def execute(self, query, args=None):
+        return self._timed(self._cursor.execute, query, args)
+
+    def executemany(self, query, args):
+        return self._timed(self._cursor.executemany, query, args, many=True)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def report(order_by="totale_ms", limit=50):
+    """Returns the profiled statements and functions, the most expensive first"""
+    with _lock:
+        statements = [dict(stat.snapshot(), fingerprint=key) for key, stat in _statements.items()]
+        calls = [dict(stat.snapshot(), funzione=name) for name, stat in _calls.items()]
+
+    statements.sort(key=lambda entry: entry.get(order_by) or 0, reverse=True)
+    calls.sort(key=lambda entry: entry.get(order_by) or 0, reverse=True)
+
+    return {
+        "impostazioni": settings(),
+        "query": statements[:limit],
+        "funzioni": calls[:limit],
+    }
+
+
+def reset():
+    """Forgets everything recorded so far"""
+    with _lock:
+        _statements.clear()
+        _calls.clear()
\ No newline at end of file
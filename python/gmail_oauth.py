@@ -5,7 +5,9 @@ storing tokens in the database for persistence across application restarts.
 """
 
 import base64
+import json
 import logging
+import threading
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
@@ -13,15 +15,167 @@ from email.utils import formatdate
 from email import encoders
 from datetime import datetime, timedelta
 
+import google_auth_httplib2
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
 from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.errors import HttpError
+from googleapiclient.http import build_http
 
 # Define the scopes for Gmail API access
 SCOPES = ['https://www.googleapis.com/auth/gmail.send']
 
+# The access token is refreshed this long before it expires, so a send never starts with a token about to expire
+REFRESH_MARGIN = timedelta(minutes=5)
+
+# Credentials and Gmail service of each sender, shared by every GmailOAuth of the process.
+# The requests go through an http of the calling thread, httplib2 isn't thread-safe
+_clients = {}
+_clients_lock = threading.Lock()
+_discovery_document = None
+
+
+class _CachedClient:
+    def __init__(self):
+        # Held while loading or refreshing, so concurrent callers wait for a single refresh
+        self.lock = threading.Lock()
+        self.creds = None
+        self.service = None
+        # Token fields as last read from or written to the database
+        self.stored = None
+        # The AuthorizedHttp of each thread, and the credentials it was made for
+        self.local = threading.local()
+
+    def thread_http(self, creds):
+        """Returns the http the current thread sends through, made again when the credentials change"""
+        if getattr(self.local, "creds", None) is not creds:
+            self.local.http = google_auth_httplib2.AuthorizedHttp(creds, http=build_http())
+            self.local.creds = creds
+        return self.local.http
+
+
+def _cached_client(user_email):
+    with _clients_lock:
+        client = _clients.get(user_email)
+        if client is None:
+            client = _clients[user_email] = _CachedClient()
+        return client
+
+
+def _gmail_discovery_document():
+    """The Gmail API discovery document bundled with google-api-python-client, parsed once per process"""
+    global _discovery_document
+    if _discovery_document is None:
+        _discovery_document = json.loads(get_static_doc('gmail', 'v1'))
+    return _discovery_document
+
+
+def _token_fields(creds):
+    return (creds.token, creds.refresh_token, creds.expiry)
+
+
+def _needs_refresh(creds):
+    if not creds.token:
+        return True
+    if creds.expiry is None:
+        return False
+    # google-auth keeps expiry as a naive UTC datetime
+    return datetime.utcnow() >= creds.expiry - REFRESH_MARGIN
+
+def build_mime_message(sender, to, subject, body, attachments=None, use_bcc=False):
+    """
+    Build the MIME message of an email.
+    
+    Args:
+        sender (str): Email address of the sender
+        to (list): Recipients' email addresses
+        subject (str): Email subject
+        body (str): Email body text
+        attachments (list, optional): List of dict with format:
+            [{'data': bytes_or_file, 'filename': 'name.ext', 'mimetype': 'type/subtype'}]
+        use_bcc (bool): Whether to use BCC instead of TO field
+        
+    Returns:
+        MIMEMultipart: The message
+    """
+    msg = MIMEMultipart()
+    msg['From'] = sender
+    
+    if use_bcc:
+        # Set the TO field to the sender (common practice for BCC emails)
+        msg['To'] = sender
+        # Add BCC recipients
+        if to:
+            msg['Bcc'] = ", ".join(to)
+    else:
+        # All recipients can see each other
+        msg['To'] = ", ".join(to)
+    
+    msg['Date'] = formatdate(localtime=True)
+    msg['Subject'] = subject
+    
+    # Attach text body
+    msg.attach(MIMEText(body))
+    
+    # Attach files if present
+    if attachments:
+        for attachment in attachments:
+            attachment_part = MIMEBase(*attachment.get('mimetype', 'application/octet-stream').split('/'))
+            
+            # Get the data
+            data = attachment['data']
+            # If data is a file-like object, read it
+            if hasattr(data, 'read'):
+                content = data.read()
+            else:
+                content = data
+                
+            attachment_part.set_payload(content)
+            encoders.encode_base64(attachment_part)
+            attachment_part.add_header(
+                'Content-Disposition', 
+                f'attachment; filename="{attachment["filename"]}"'
+            )
+            msg.attach(attachment_part)
+    
+    return msg
+
+
+def weekly_report_email(report_data):
+    """
+    Build the subject, body and attachments of the weekly report email.
+    
+    Args:
+        report_data (BytesIO): Excel report data as a BytesIO object
+        
+    Returns:
+        tuple: (subject, body, attachments)
+    """
+    today = datetime.now().strftime('%d/%m/%Y')
+    subject = f"Report Settimanale Accesso Cantieri - {today}"
+    
+    body = f"""
+Buongiorno,
+
+In allegato il report settimanale aggiornato al {today}.
+
+Questo messaggio è stato generato automaticamente, si prega di non rispondere.
+
+Cordiali saluti,
+Sistema Gestionale Accesso Cantieri
+    """
+    
+    attachments = [{
+        'data': report_data,
+        'filename': f"report_{datetime.now().strftime('%d_%m_%Y')}.xlsx",
+        'mimetype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    }]
+    
+    return subject, body, attachments
+
+
 class GmailOAuth:
     """Class to handle Gmail OAuth 2.0 authentication and email sending for web applications."""
     
@@ -103,6 +257,13 @@ class GmailOAuth:
             # Store token in database
             self._store_token(token_data)
             
+            # The new authorization replaces the credentials cached by this process
+            client = _cached_client(self.user_email)
+            with client.lock:
+                client.creds = creds
+                client.stored = _token_fields(creds)
+                client.service = None
+            
             self.creds = creds
             return token_data
         except Exception as e:
@@ -216,68 +377,106 @@ class GmailOAuth:
             self.logger.error(f"Error loading token: {str(e)}")
             return None
     
-    def authenticate(self):
+    def _credentials_from_token(self, token_data):
         """
-        Authenticate using stored tokens.
+        Create credentials from the token data stored in the database.
         
+        Args:
+            token_data (dict): Token data from _load_token
+            
         Returns:
-            bool: True if authentication was successful, False if needs authorization
+            Credentials: The credentials
         """
         try:
-            # Load token from database
-            token_data = self._load_token()
-            
-            if not token_data:
-                self.logger.info("No token found in database")
-                return False
+            expiry = None
+            if token_data['expiry']:
+                try:
+                    expiry = datetime.fromisoformat(token_data['expiry'])
+                except ValueError:
+                    # Handle older ISO format
+                    expiry = datetime.strptime(token_data['expiry'], "%Y-%m-%dT%H:%M:%S.%f")
+        except Exception as e:
+            self.logger.warning(f"Error parsing expiry: {str(e)}")
+            expiry = None
+        
+        return Credentials(
+            token=token_data['token'],
+            refresh_token=token_data['refresh_token'],
+            token_uri=token_data['token_uri'],
+            client_id=token_data['client_id'],
+            client_secret=token_data['client_secret'],
+            scopes=token_data['scopes'],
+            expiry=expiry
+        )
+    
+    def authenticate(self, force_refresh=False):
+        """
+        Authenticate using the credentials cached by the process, loading them from the database the first time.
+        
+        The token is refreshed shortly before it expires and written back only when it changed,
+        and the Gmail service is built once from the bundled discovery document.
+        
+        Args:
+            force_refresh (bool): Refresh the token even if it looks valid, e.g. after a 401
             
-            # Create credentials from token data
-            try:
-                expiry = None
-                if token_data['expiry']:
+        Returns:
+            bool: True if authentication was successful, False if needs authorization
+        """
+        client = _cached_client(self.user_email)
+        
+        try:
+            with client.lock:
+                if client.creds is None:
+                    # Load token from database
+                    token_data = self._load_token()
+                    
+                    if not token_data:
+                        self.logger.info("No token found in database")
+                        return False
+                    
+                    client.creds = self._credentials_from_token(token_data)
+                    client.stored = _token_fields(client.creds)
+                    client.service = None
+                
+                creds = client.creds
+                
+                # Refresh token if expired or about to expire
+                if force_refresh or _needs_refresh(creds):
+                    if not creds.refresh_token:
+                        self.logger.warning("Token is invalid and cannot be refreshed")
+                        # Read it again next time, it may have been authorized in the meantime
+                        client.creds = None
+                        return False
+                    
+                    self.logger.info("Refreshing token")
                     try:
-                        expiry = datetime.fromisoformat(token_data['expiry'])
-                    except ValueError:
-                        # Handle older ISO format
-                        expiry = datetime.strptime(token_data['expiry'], "%Y-%m-%dT%H:%M:%S.%f")
-            except Exception as e:
-                self.logger.warning(f"Error parsing expiry: {str(e)}")
-                expiry = None
-            
-            self.creds = Credentials(
-                token=token_data['token'],
-                refresh_token=token_data['refresh_token'],
-                token_uri=token_data['token_uri'],
-                client_id=token_data['client_id'],
-                client_secret=token_data['client_secret'],
-                scopes=token_data['scopes'],
-                expiry=expiry
-            )
-            
-            # Refresh token if expired
-            if not self.creds.valid:
-                if self.creds.expired and self.creds.refresh_token:
-                    self.logger.info("Refreshing expired token")
-                    self.creds.refresh(Request())
+                        creds.refresh(Request())
+                    except Exception:
+                        client.creds = None
+                        raise
                     
-                    # Update token in database
-                    token_data = {
-                        'token': self.creds.token,
-                        'refresh_token': self.creds.refresh_token,
-                        'token_uri': self.creds.token_uri,
-                        'client_id': self.creds.client_id,
-                        'client_secret': self.creds.client_secret,
-                        'scopes': self.creds.scopes,
-                        'expiry': self.creds.expiry.isoformat() if self.creds.expiry else None
-                    }
-                    self._store_token(token_data)
-                else:
-                    self.logger.warning("Token is invalid and cannot be refreshed")
-                    return False
+                    # Update token in database only if it changed
+                    if _token_fields(creds) != client.stored:
+                        token_data = {
+                            'token': creds.token,
+                            'refresh_token': creds.refresh_token,
+                            'token_uri': creds.token_uri,
+                            'client_id': creds.client_id,
+                            'client_secret': creds.client_secret,
+                            'scopes': creds.scopes,
+                            'expiry': creds.expiry.isoformat() if creds.expiry else None
+                        }
+                        self._store_token(token_data)
+                        client.stored = _token_fields(creds)
+                
+                # Create Gmail API service, it refers to creds so it follows the refreshes
+                if client.service is None:
+                    client.service = build_from_document(_gmail_discovery_document(), credentials=creds)
+                    self.logger.info("Gmail OAuth authentication successful")
+                
+                self.creds = creds
+                self.service = client.service
             
-            # Create Gmail API service
-            self.service = build('gmail', 'v1', credentials=self.creds)
-            self.logger.info("Gmail OAuth authentication successful")
             return True
             
         except Exception as e:
@@ -299,45 +498,7 @@ class GmailOAuth:
         Returns:
             dict: A message object for the Gmail API
         """
-        msg = MIMEMultipart()
-        msg['From'] = self.user_email
-        
-        if use_bcc:
-            # Set the TO field to the sender (common practice for BCC emails)
-            msg['To'] = self.user_email
-            # Add BCC recipients
-            if to:
-                msg['Bcc'] = ", ".join(to)
-        else:
-            # All recipients can see each other
-            msg['To'] = ", ".join(to)
-        
-        msg['Date'] = formatdate(localtime=True)
-        msg['Subject'] = subject
-        
-        # Attach text body
-        msg.attach(MIMEText(body))
-        
-        # Attach files if present
-        if attachments:
-            for attachment in attachments:
-                attachment_part = MIMEBase(*attachment.get('mimetype', 'application/octet-stream').split('/'))
-                
-                # Get the data
-                data = attachment['data']
-                # If data is a file-like object, read it
-                if hasattr(data, 'read'):
-                    content = data.read()
-                else:
-                    content = data
-                    
-                attachment_part.set_payload(content)
-                encoders.encode_base64(attachment_part)
-                attachment_part.add_header(
-                    'Content-Disposition', 
-                    f'attachment; filename="{attachment["filename"]}"'
-                )
-                msg.attach(attachment_part)
+        msg = build_mime_message(self.user_email, to, subject, body, attachments, use_bcc)
         
         # Convert to base64 format for Gmail API
         raw_message = base64.urlsafe_b64encode(msg.as_bytes()).decode()
@@ -353,30 +514,30 @@ class GmailOAuth:
         Returns:
             dict: The sent message response from the API
         """
-        try:
-            if not self.service:
-                if not self.authenticate():
-                    raise Exception("Authentication failed. Need to complete OAuth flow.")
-            
-            # Attempt to send the message
-            sent_message = self.service.users().messages().send(
-                userId='me', body=message).execute()
-            self.logger.info(f"Message sent successfully. Message ID: {sent_message['id']}")
-            return sent_message
-            
-        except HttpError as error:
-            if error.resp.status == 401:
-                # Token might be invalid - try to refresh
-                self.logger.warning("Authentication error - attempting to refresh token")
-                self.creds = None
-                if self.authenticate():
-                    # Retry sending after re-authentication
-                    return self.send_message(message)
-                else:
-                    raise Exception("Authentication failed. Need to complete OAuth flow.")
-            
-            self.logger.error(f"Error sending message: {error}")
-            raise
+        # Refresh the token if needed, this is cheap when it's still valid
+        if not self.authenticate():
+            raise Exception("Authentication failed. Need to complete OAuth flow.")
+        
+        client = _cached_client(self.user_email)
+        
+        for attempt in range(2):
+            try:
+                # The service is shared, the connection is this thread's own
+                sent_message = self.service.users().messages().send(
+                    userId='me', body=message).execute(http=client.thread_http(self.creds))
+                self.logger.info(f"Message sent successfully. Message ID: {sent_message['id']}")
+                return sent_message
+                
+            except HttpError as error:
+                if error.resp.status == 401 and attempt == 0:
+                    # Token might have been revoked or replaced - refresh it and retry once
+                    self.logger.warning("Authentication error - attempting to refresh token")
+                    if not self.authenticate(force_refresh=True):
+                        raise Exception("Authentication failed. Need to complete OAuth flow.")
+                    continue
+                
+                self.logger.error(f"Error sending message: {error}")
+                raise
     
     def send_email(self, subject, recipients, body, attachments=None, use_bcc=True):
         """
@@ -417,25 +578,7 @@ class GmailOAuth:
         Returns:
             bool: True if email was sent successfully, False otherwise
         """
-        today = datetime.now().strftime('%d/%m/%Y')
-        subject = f"Report Settimanale Accesso Cantieri - {today}"
-        
-        body = f"""
-Buongiorno,
-
-In allegato il report settimanale aggiornato al {today}.
-
-Questo messaggio è stato generato automaticamente, si prega di non rispondere.
-
-Cordiali saluti,
-Sistema Gestionale Accesso Cantieri
-        """
-        
-        attachments = [{
-            'data': report_data,
-            'filename': f"report_{datetime.now().strftime('%d_%m_%Y')}.xlsx",
-            'mimetype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        }]
+        subject, body, attachments = weekly_report_email(report_data)
         
         # Always use BCC for the weekly report
         return self.send_email(subject, recipients, body, attachments, use_bcc=True)
\ No newline at end of file
@@ -0,0 +1,99 @@
+"""Conditional GET for the list pages and their JSON: an ETag derived from the versions of the tables
+shown (see data_versions), so a browser reloading a page nothing changed in gets a 304 without the
+view running its queries or its templates.
+
+The ETag covers the endpoint, the query arguments, the user, the versions of the tables, the day for
+the pages depending on it, and a stamp of the code and the templates, so a deploy changing the
+pages changes every ETag. The versions are the ones of data_versions, read in the transaction of the
+request, so a write of another process is seen by the next request, as by the other caches.
+
+No ETag is sent while flash messages are pending, nor when the view changed the session, since the
+flash messages are part of the page only once.
+"""
+
+import hashlib
+import os
+from datetime import date
+from functools import wraps
+
+from flask import current_app, make_response, request, session
+
+try:
+    # First attempt direct import (works when running server.py)
+    import data_versions
+except ImportError:
+    # Fall back to package import (works when running the scripts from the root)
+    from python import data_versions
+
+# The browser checks the ETag at every navigation, and shared caches never store the pages
+CACHE_CONTROL = "private, no-cache"
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _code_stamp():
+    """Returns a stamp of the latest change to the code, templates and static files of the app"""
+    latest = 0
+    for directory in ("python", "templates", "static"):
+        for dirpath, _, filenames in os.walk(os.path.join(_ROOT, directory)):
+            for filename in filenames:
+                if filename.endswith((".py", ".html", ".js", ".css")):
+                    latest = max(latest, os.stat(os.path.join(dirpath, filename)).st_mtime_ns)
+    return latest
+
+
+# Computed once at import, before the workers fork, so that they all send the same ETags
+_stamp = _code_stamp()
+
+
+def make_etag(tables, daily=False):
+    """Returns the ETag of the current request for a page showing the given tables"""
+    parts = (
+        _stamp,
+        request.endpoint,
+        tuple(sorted(request.args.items(multi=True))),
+        session.get("user"),
+        data_versions.version_of(*tables),
+        date.today().isoformat() if daily else None,
+    )
+    return hashlib.sha1(repr(parts).encode()).hexdigest()[:24]
+
+
+def _set_headers(response, etag):
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = CACHE_CONTROL
+    response.vary.add("Cookie")
+    return response
+
+
+def conditional_get(*tables, daily=False):
+    """Decorator answering 304 Not Modified to the GET of a page whose tables didn't change.
+
+    Usage:
+        Use it below fredauth.authorized, so the authorization is still checked at every request
+
+    Args:
+        tables: the tables whose rows the page shows
+        daily (bool): the page also changes with the day, e.g. the expiry buckets
+    """
+    def decorator(fn):
+
+        @wraps(fn)
+        def ret_func(*args, **kwargs):
+            # The flash messages pending are shown by this response only
+            if request.method not in ("GET", "HEAD") or session.get("_flashes"):
+                return fn(*args, **kwargs)
+
+            etag = make_etag(tables, daily)
+
+            if request.if_none_match.contains(etag):
+                return _set_headers(current_app.response_class(status=304), etag)
+
+            response = make_response(fn(*args, **kwargs))
+
+            if response.status_code == 200 and not session.modified:
+                _set_headers(response, etag)
+
+            return response
+        return ret_func
+    return decorator
\ No newline at end of file
@@ -0,0 +1,227 @@
+"""Outbound mail queue stored in the email_outbox table.
+
+The mailers enqueue the fully rendered MIME message and a sender drains the queue: the messages
+due are claimed in batches, sent through one reused transport and marked as sent, or rescheduled
+with an exponential backoff until max_attempts is reached. A message that can't be delivered now
+stays in the queue instead of being lost with the run that generated it.
+
+The transport is Gmail in production. For testing offline the smtp transport sends to a local
+debugging server instead, for example: python -m aiosmtpd -n -l localhost:1025
+
+Requires migrations/005_email_outbox.sql
+"""
+
+import base64
+import email
+import logging
+import smtplib
+
+try:
+    # First attempt direct import (works when running server.py)
+    import fredbconn
+    import gmail_oauth
+except ImportError:
+    # Fall back to package import (works when running the scripts from the root)
+    from python import fredbconn
+    from python import gmail_oauth
+
+logger = logging.getLogger("MailOutbox")
+
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BASE_DELAY_SECONDS = 60
+DEFAULT_MAX_DELAY_SECONDS = 6 * 3600
+
+# While a sender holds a batch, the messages are hidden from the other senders for this long
+LEASE_SECONDS = 600
+
+
+def enqueue(sender, recipients, subject, body, attachments=None, use_bcc=True):
+    """Renders the email and adds it to the queue, in the current unit of work if there is one.
+
+    Args:
+        sender (str): email address of the sender
+        recipients (list): recipients' email addresses
+        subject (str): email subject
+        body (str): email body text
+        attachments (list, optional): see gmail_oauth.build_mime_message
+        use_bcc (bool): whether to use BCC for the recipients
+
+    Returns:
+        int: id of the queued message, or an error string from fredbconn
+    """
+    message = gmail_oauth.build_mime_message(sender, recipients, subject, body, attachments, use_bcc)
+
+    @fredbconn.connected_to_database
+    def insert_message(cursor):
+        cursor.execute("""
+        INSERT INTO email_outbox (destinatari, oggetto, messaggio)
+        VALUES (%s, %s, %s)
+        """, (", ".join(recipients), subject, message.as_bytes()))
+        return cursor.lastrowid
+
+    return insert_message()
+
+
+class GmailTransport:
+    """Sends the queued messages through the Gmail API, authenticating once for all of them"""
+    def __init__(self, email_config, logger=logger):
+        self.email_config = email_config
+        self.logger = logger
+        self.oauth_handler = None
+
+    def send(self, message, recipients):
+        if self.oauth_handler is None:
+            # Imported here so that the smtp transport works without the Gmail configuration
+            try:
+                import email_manager_oauth
+            except ImportError:
+                from python import email_manager_oauth
+
+            handler = email_manager_oauth.EmailManager(self.email_config, self.logger).oauth_handler
+            if not handler.authenticate():
+                raise RuntimeError(
+                    "Gmail OAuth not authenticated, authorize it at http://localhost:16000/oauth/check_gmail_auth"
+                )
+            self.oauth_handler = handler
+
+        # The Bcc header is read by Gmail to deliver the message and then removed
+        self.oauth_handler.send_message({'raw': base64.urlsafe_b64encode(message).decode()})
+
+
+class SmtpTransport:
+    """Sends the queued messages to an SMTP server, one connection per drained batch"""
+    def __init__(self, host="localhost", port=1025):
+        self.host = host
+        self.port = port
+        self.connection = None
+
+    def send(self, message, recipients):
+        if self.connection is None:
+            self.connection = smtplib.SMTP(self.host, self.port, timeout=30)
+        try:
+            # The envelope is read from the From, To and Bcc headers, and Bcc is not transmitted
+            self.connection.send_message(email.message_from_bytes(message))
+        except smtplib.SMTPServerDisconnected:
+            self.connection = None
+            raise
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except smtplib.SMTPException:
+                pass
+            self.connection = None
+
+
+def transport_from_config(email_config, transport="gmail", smtp_host="localhost", smtp_port=1025):
+    """Builds the transport chosen in passwords.outbox_config"""
+    if transport == "smtp":
+        return SmtpTransport(smtp_host, smtp_port)
+    return GmailTransport(email_config)
+
+
+def retry_delay(attempts, base_delay=DEFAULT_BASE_DELAY_SECONDS, max_delay=DEFAULT_MAX_DELAY_SECONDS):
+    """Seconds to wait before the next attempt, doubling at each failed attempt"""
+    return min(base_delay * 2 ** (attempts - 1), max_delay)
+
+
+@fredbconn.connected_to_database
+def _claim_batch(cursor, batch_size):
+    """Leases the messages due, so that a concurrent sender skips them"""
+    cursor.execute("""
+    SELECT id, destinatari, messaggio, tentativi
+    FROM email_outbox
+    WHERE stato = 'in_attesa' AND prossimo_tentativo <= NOW()
+    ORDER BY id
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+    """, (batch_size,))
+    batch = cursor.fetchall()
+
+    if batch:
+        cursor.execute(
+            "UPDATE email_outbox SET prossimo_tentativo = NOW() + INTERVAL %s SECOND WHERE id IN ("
+            + ", ".join(["%s"] * len(batch)) + ")",
+            (LEASE_SECONDS, *(row[0] for row in batch))
+        )
+    return batch
+
+
+@fredbconn.connected_to_database
+def _record_results(cursor, sent, failed):
+    """Marks the sent messages, reschedules or gives up on the failed ones.
+
+    Args:
+        sent (list): ids of the messages sent
+        failed (list): (id, error, delay in seconds or None to give up)
+    """
+    if sent:
+        cursor.execute(
+            "UPDATE email_outbox SET stato = 'inviata', inviata_il = NOW(), tentativi = tentativi + 1 WHERE id IN ("
+            + ", ".join(["%s"] * len(sent)) + ")",
+            sent
+        )
+    if failed:
+        cursor.executemany("""
+        UPDATE email_outbox
+        SET
+            tentativi = tentativi + 1,
+            ultimo_errore = %s,
+            stato = IF(%s IS NULL, 'fallita', 'in_attesa'),
+            prossimo_tentativo = NOW() + INTERVAL COALESCE(%s, 0) SECOND
+        WHERE id = %s
+        """, [(error[:1000], delay, delay, id_message) for id_message, error, delay in failed])
+
+
+def drain(transport, batch_size=DEFAULT_BATCH_SIZE, max_attempts=DEFAULT_MAX_ATTEMPTS,
+          base_delay=DEFAULT_BASE_DELAY_SECONDS, max_delay=DEFAULT_MAX_DELAY_SECONDS):
+    """Sends the messages due until the queue has none left.
+
+    Returns:
+        tuple: (number of messages sent, number of failed attempts)
+    """
+    total_sent = total_failed = 0
+
+    try:
+        while True:
+            batch = _claim_batch(batch_size)
+            if isinstance(batch, str):
+                logger.error(f"Unable to read the outbox: {batch}")
+                break
+            if not batch:
+                break
+
+            sent = []
+            failed = []
+            for id_message, destinatari, messaggio, tentativi in batch:
+                try:
+                    transport.send(bytes(messaggio), [address.strip() for address in destinatari.split(",")])
+                    sent.append(id_message)
+                    logger.info(f"Message {id_message} sent")
+                except Exception as e:
+                    attempts = tentativi + 1
+                    delay = retry_delay(attempts, base_delay, max_delay) if attempts < max_attempts else None
+                    failed.append((id_message, str(e), delay))
+                    if delay is None:
+                        logger.error(f"Message {id_message} failed {attempts} times, giving up: {e}")
+                    else:
+                        logger.warning(f"Message {id_message} failed, retrying in {delay} seconds: {e}")
+
+            result = _record_results(sent, failed)
+            if isinstance(result, str):
+                # The leases expire and the messages will be retried
+                logger.error(f"Unable to record the sending results: {result}")
+                break
+
+            total_sent += len(sent)
+            total_failed += len(failed)
+
+            if len(batch) < batch_size:
+                break
+    finally:
+        if hasattr(transport, "close"):
+            transport.close()
+
+    return total_sent, total_failed
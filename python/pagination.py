@@ -0,0 +1,112 @@
+"""Keyset pagination helpers for the listings ordered by (sort column, id).
+
+Pages are addressed by an opaque cursor holding the sort key of the last (or first) row shown,
+so every page is an index range scan no matter how deep the user scrolls.
+"""
+
+import base64
+import json
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+
+
+def parse_page_size(value):
+    """Returns the requested page size clamped to [1, MAX_PAGE_SIZE], the default if missing or invalid."""
+    try:
+        page_size = int(value)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+def encode_cursor(sort_value, row_id):
+    """Encodes the sort key of a row into an url-safe cursor."""
+    raw = json.dumps([sort_value, row_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor made by encode_cursor.
+
+    Returns:
+        tuple: (sort_value, row_id), or None if the cursor is missing or malformed
+    """
+    if not cursor:
+        return None
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (ValueError, TypeError):
+        return None
+
+    if not isinstance(row_id, int) or not (sort_value is None or isinstance(sort_value, str)):
+        return None
+
+    return sort_value, row_id
+
+
+def keyset_condition(sort_column, id_column, key, backwards=False):
+    """Builds the WHERE condition selecting the rows after (or before) the given key.
+
+    NULL sort values come first in ascending order, as MySQL sorts them.
+
+    Returns:
+        tuple: (sql, params) to be AND-ed to the query
+    """
+    sort_value, row_id = key
+
+    if not backwards:
+        if sort_value is None:
+            return (f"(({sort_column} IS NULL AND {id_column} > %s) OR {sort_column} IS NOT NULL)",
+                    (row_id,))
+        return (f"({sort_column} > %s OR ({sort_column} = %s AND {id_column} > %s))",
+                (sort_value, sort_value, row_id))
+
+    if sort_value is None:
+        return f"({sort_column} IS NULL AND {id_column} < %s)", (row_id,)
+    return (f"({sort_column} < %s OR ({sort_column} = %s AND {id_column} < %s) OR {sort_column} IS NULL)",
+            (sort_value, sort_value, row_id))
+
+
+def keyset_order(sort_column, id_column, backwards=False):
+    """Returns the ORDER BY clause matching keyset_condition."""
+    direction = "DESC" if backwards else "ASC"
+    return f"{sort_column} {direction}, {id_column} {direction}"
+
+
+def paginate(rows, page_size, backwards, had_cursor, key_of):
+    """Trims a page fetched with LIMIT page_size + 1 and computes its cursors.
+
+    Args:
+        rows (list): rows in query order, at most page_size + 1
+        page_size (int): rows per page
+        backwards (bool): whether the rows were fetched with a before cursor
+        had_cursor (bool): whether the page was requested with a cursor
+        key_of (callable): returns the (sort_value, id) key of a row
+
+    Returns:
+        tuple: (rows in display order, next cursor or None, previous cursor or None)
+    """
+    has_more = len(rows) > page_size
+    rows = list(rows[:page_size])
+
+    if backwards:
+        rows.reverse()
+
+    if not rows:
+        return rows, None, None
+
+    first_key = key_of(rows[0])
+    last_key = key_of(rows[-1])
+
+    if backwards:
+        next_cursor = encode_cursor(*last_key)
+        prev_cursor = encode_cursor(*first_key) if has_more else None
+    else:
+        next_cursor = encode_cursor(*last_key) if has_more else None
+        prev_cursor = encode_cursor(*first_key) if had_cursor else None
+
+    return rows, next_cursor, prev_cursor
\ No newline at end of file
@@ -0,0 +1,92 @@
+"""In-process cache of the lookup lists shown on almost every page: the ditte and the ruoli.
+
+Each list is keyed on the version of its table (see data_versions), so it's read again only after
+a write route bumped the version, in this process or in another one.
+"""
+
+import threading
+
+try:
+    # First attempt direct import (works when running server.py)
+    import fredbconn
+    import data_versions
+except ImportError:
+    # Fall back to package import (works when running the scripts from the root)
+    from python import fredbconn
+    from python import data_versions
+
+_lock = threading.Lock()
+
+# list name -> (version, rows)
+_cache = {}
+
+
+@fredbconn.connected_to_database
+def _fetch_ditte(cursor):
+    cursor.execute("""
+    SELECT id, nome
+    FROM ditte
+    ORDER BY nome ASC
+    """)
+    return tuple(cursor.fetchall())
+
+
+@fredbconn.connected_to_database
+def _fetch_ruoli(cursor):
+    cursor.execute("""
+    SELECT id, nome_ruolo
+    FROM ruoli
+    ORDER BY id ASC
+    """)
+    return tuple(cursor.fetchall())
+
+
+def _cached(name, table, fetch):
+    version = data_versions.version_of(table)
+
+    with _lock:
+        entry = _cache.get(name)
+
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    rows = fetch()
+
+    # The decorator returns the error as a string, which must never be cached
+    if isinstance(rows, str):
+        return ()
+
+    # The version was read before the rows, so a concurrent write only costs one more fetch
+    with _lock:
+        _cache[name] = (version, rows)
+
+    return rows
+
+
+def get_ditte():
+    """Returns the (id, nome) tuples of all the ditte, sorted by nome"""
+    return _cached("ditte", "ditte", _fetch_ditte)
+
+
+def get_ditte_names():
+    """Returns the names of all the ditte, sorted"""
+    return [nome for _, nome in get_ditte()]
+
+
+def get_ditta_name(ditta_id):
+    """Returns the name of the ditta with the given id, None if it doesn't exist"""
+    for id, nome in get_ditte():
+        if str(id) == str(ditta_id):
+            return nome
+    return None
+
+
+def get_ruoli():
+    """Returns the (id, nome_ruolo) tuples of all the ruoli, sorted by id"""
+    return _cached("ruoli", "ruoli", _fetch_ruoli)
+
+
+def invalidate():
+    """Drops the cached lists of this process"""
+    with _lock:
+        _cache.clear()
\ No newline at end of file
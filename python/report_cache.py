@@ -0,0 +1,151 @@
+"""On-disk cache of the generated Excel reports.
+
+An artifact is keyed by the report type, the versions of the tables it reads (see data_versions)
+and the current date, printed in the title of every report. Repeat downloads only cost the
+version check, and the key doubles as the ETag of the response.
+
+The store is bounded in size, the least recently served artifacts are evicted first. An artifact
+being served only moves its access time, its modification time stays the one of its generation,
+which is the Last-Modified of the downloads.
+"""
+
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+from datetime import date
+from time import time
+
+try:
+    # First attempt direct import (works when running server.py)
+    import data_versions
+except ImportError:
+    # Fall back to package import (works when running the scripts from the root)
+    from python import data_versions
+
+_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "report-cache")
+_max_bytes = 200 * 1024 * 1024
+
+_locks_lock = threading.Lock()
+
+# key -> [lock, threads holding or waiting for it], dropped once no thread needs it
+_locks = {}
+
+
+def configure_report_cache(directory=None, max_bytes=200 * 1024 * 1024):
+    """Sets where the artifacts are stored and how much disk they can take"""
+    global _directory, _max_bytes
+
+    if directory is not None:
+        _directory = os.path.abspath(directory)
+    _max_bytes = max_bytes
+
+
+@contextmanager
+def _key_lock(key):
+    """Holds the lock of a key, which lives as long as a thread holds it or waits for it"""
+    with _locks_lock:
+        entry = _locks.get(key)
+        if entry is None:
+            entry = _locks[key] = [threading.Lock(), 0]
+        entry[1] += 1
+
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _locks_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _locks[key]
+
+
+def artifact_key(report_type, tables):
+    """Returns the cache key of the current artifact of a report"""
+    versions = data_versions.version_of(*tables)
+    raw = f"{report_type}|{tables}|{versions}|{date.today().isoformat()}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+
+def artifact_path(report_type, key):
+    """Returns the path of the artifact with the given key, which may not exist"""
+    return os.path.join(_directory, f"{report_type}-{key}.xlsx")
+
+
+def get_report(report_type, tables, generate):
+    """Returns the path of the up to date artifact of a report, generating it if needed.
+
+    Args:
+        report_type (str): name of the report, part of the file name
+        tables (tuple): tables read by the report
+        generate (callable): writes the report to the path it receives
+
+    Returns:
+        tuple: (path, key), the key can be used as ETag
+    """
+    key = artifact_key(report_type, tables)
+    path = artifact_path(report_type, key)
+
+    # Only one thread of this process generates a given artifact, the others wait for it
+    with _key_lock(key):
+        if os.path.exists(path):
+            _touch(path)
+            return path, key
+
+        os.makedirs(_directory, exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        try:
+            generate(temp_path)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    evict(keep=path)
+
+    return path, key
+
+
+def _touch(path):
+    """Marks an artifact as recently used, eviction follows the access time"""
+    try:
+        os.utime(path, (time(), os.stat(path).st_mtime))
+    except OSError:
+        pass
+
+
+def evict(keep=None, max_age_seconds=None):
+    """Deletes the least recently used artifacts until the store fits in max_bytes, and the ones
+    not served for more than max_age_seconds
+    """
+    try:
+        entries = [entry for entry in os.scandir(_directory)
+                   if entry.is_file() and entry.name.endswith(".xlsx")]
+    except FileNotFoundError:
+        return
+
+    stats = []
+    for entry in entries:
+        try:
+            stat = entry.stat()
+            # Set by _touch at every hit, and never older than the generation
+            stats.append((max(stat.st_atime, stat.st_mtime), stat.st_size, entry.path))
+        except OSError:
+            continue
+
+    total = sum(size for _, size, _ in stats)
+    oldest = time() - max_age_seconds if max_age_seconds is not None else None
+
+    for used_at, size, path in sorted(stats):
+        if total <= _max_bytes and (oldest is None or used_at >= oldest):
+            break
+        if keep is not None and os.path.samefile(path, keep):
+            continue
+
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            # Still being sent on Windows, it will be evicted next time
+            continue
\ No newline at end of file
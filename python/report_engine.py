@@ -0,0 +1,248 @@
+"""Declarative engine writing the Excel reports in a single pass over the rows.
+
+A report is described by a ReportSpec: the title, the columns, an optional section grouping and
+optional summary lines. render streams the rows into the workbook, formatting each one with the
+value getters compiled from the columns, grouping consecutive rows into sections, collecting the
+summary counters and tracking the column widths, all while the rows go by. Format objects are
+created once per workbook and shared by every cell using them.
+"""
+
+import tempfile
+import xlsxwriter
+from datetime import datetime
+
+# Properties of the named formats a report can use
+FORMATS = {
+    "default": {'font_size': 13, 'align': 'center', 'valign': 'vcenter', 'border': 1},
+    "ditta": {'bold': True, 'font_size': 13, 'align': 'center', 'valign': 'vcenter', 'border': 1},
+    "ruolo": {'italic': True, 'font_size': 13, 'align': 'center', 'valign': 'vcenter', 'border': 1},
+    "header_yellow": {'bold': True, 'font_size': 14, 'align': 'center', 'valign': 'vcenter',
+                      'border': 1, 'bg_color': '#FFFF00', 'text_wrap': True},
+    "header_blue": {'bold': True, 'font_size': 14, 'align': 'center', 'valign': 'vcenter',
+                    'border': 1, 'bg_color': '#00B0F0', 'text_wrap': True},
+    "header_green": {'bold': True, 'font_size': 14, 'align': 'center', 'valign': 'vcenter',
+                     'border': 1, 'bg_color': '#92D050', 'text_wrap': True},
+    "title_18": {'font_size': 18, 'align': 'center', 'valign': 'vcenter', 'border': 1, 'bold': True},
+    "title_14": {'font_size': 14, 'align': 'center', 'valign': 'vcenter', 'border': 1, 'bold': True},
+    "section": {'bold': True, 'font_size': 14, 'align': 'center', 'valign': 'vcenter',
+                'border': 1, 'bg_color': '#D9D9D9'},  # Light grey background
+    "summary": {'bold': True, 'font_size': 12, 'align': 'left', 'valign': 'vcenter'},
+}
+
+
+def format_date(scadenza):
+    """Formats a date as dd/mm/yyyy, leaving unparsable values as they are."""
+    formatted_date = ""
+    if scadenza:
+        if isinstance(scadenza, str):
+            try:
+                scadenza_dt = datetime.strptime(scadenza, "%Y-%m-%d")
+                formatted_date = scadenza_dt.strftime("%d/%m/%Y")
+            except ValueError:
+                formatted_date = scadenza
+        else:
+            try:
+                formatted_date = scadenza.strftime("%d/%m/%Y")
+            except AttributeError:
+                formatted_date = str(scadenza)
+    return formatted_date
+
+
+def text(index):
+    """Value getter returning the field at index, empty if NULL"""
+    return lambda row: row[index] or ""
+
+
+def date(index):
+    """Value getter returning the field at index formatted as a date"""
+    return lambda row: format_date(row[index])
+
+
+def check(index):
+    """Value getter returning X if the field at index is set"""
+    return lambda row: "X" if row[index] else ""
+
+
+class Column:
+    """A column of a report.
+
+    Args:
+        header (str): header text, may contain newlines
+        value (callable): returns the cell value from a row, see text, date and check
+        cell_format (str): name of the format of the cells
+        header_format (str): name of the format of the header
+        auto_width (bool): size the column on its content, otherwise on its header only
+        padding (int): added to the width
+        max_width (int, optional): cap of the content width, before the padding
+    """
+    def __init__(self, header, value, cell_format="default", header_format="header_green",
+                 auto_width=True, padding=10, max_width=None):
+        self.header = header
+        self.value = value
+        self.cell_format = cell_format
+        self.header_format = header_format
+        self.auto_width = auto_width
+        self.padding = padding
+        self.max_width = max_width
+
+
+class ReportSpec:
+    """The description of a report.
+
+    Args:
+        sheet_name (str): name of the worksheet
+        title (str): title of the report, followed by the update date
+        columns (list): the Column objects
+        merged_title (bool): write the title merged over all the columns instead of as a rich string
+        section_of (callable, optional): returns the section label of a row, the rows must come
+            grouped by section, and a section header is written whenever the label changes
+        summary (callable, optional): returns the summary lines from the ReportStats
+        summary_gap (int): empty rows between the data and the summary
+        distinct_columns (tuple): indexes of the columns whose distinct values are counted
+    """
+    def __init__(self, sheet_name, title, columns, merged_title=False, section_of=None,
+                 summary=None, summary_gap=2, distinct_columns=()):
+        self.sheet_name = sheet_name
+        self.title = title
+        self.columns = columns
+        self.merged_title = merged_title
+        self.section_of = section_of
+        self.summary = summary
+        self.summary_gap = summary_gap
+        self.distinct_columns = distinct_columns
+
+
+class ReportStats:
+    """Counters collected while writing a report"""
+    def __init__(self, distinct_columns):
+        self.rows = 0
+        self.section_counts = {}
+        self.distinct = {index: set() for index in distinct_columns}
+
+    def section_count(self, label):
+        return self.section_counts.get(label, 0)
+
+    def distinct_count(self, index):
+        return len(self.distinct[index])
+
+
+class _Formats:
+    """Creates each named format once per workbook"""
+    def __init__(self, workbook):
+        self.workbook = workbook
+        self.cache = {}
+
+    def __getitem__(self, name):
+        fmt = self.cache.get(name)
+        if fmt is None:
+            fmt = self.cache[name] = self.workbook.add_format(FORMATS[name])
+        return fmt
+
+
+def render(spec, rows, output=None, progress=None):
+    """Writes the report to output in a single pass over rows.
+
+    Args:
+        spec (ReportSpec): the report
+        rows (iterable): the rows, can be a generator streaming from the database
+        output: path or binary file object, a new temporary file if None
+        progress (callable, optional): called with the number of rows written so far, every 500 rows
+
+    Returns:
+        tuple: (output rewound to the start if it's a file object, ReportStats)
+    """
+    if output is None:
+        output = tempfile.TemporaryFile()
+
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    worksheet = workbook.add_worksheet(spec.sheet_name)
+    formats = _Formats(workbook)
+
+    columns = spec.columns
+    last_col = len(columns) - 1
+    aggiornato = datetime.now().strftime("%d-%m-%Y")
+
+    # Write report title
+    if spec.merged_title:
+        worksheet.merge_range(0, 0, 0, last_col, f"{spec.title} (Agg. {aggiornato})", formats["title_18"])
+    else:
+        worksheet.write_rich_string(0, 0,
+                                    formats["title_18"], spec.title,
+                                    formats["title_14"], f" (Agg. {aggiornato})")
+
+    # Set up headers
+    header_row = 1
+    worksheet.set_row(header_row, 45)
+
+    for col, column in enumerate(columns):
+        worksheet.write(header_row, col, column.header, formats[column.header_format])
+
+    # Everything needed per row is resolved once, before the loop
+    getters = tuple(column.value for column in columns)
+    cell_formats = tuple(formats[column.cell_format] for column in columns)
+    auto_columns = tuple(col for col, column in enumerate(columns) if column.auto_width)
+    col_widths = [len(column.header.replace("\n", " ")) for column in columns]
+    max_widths = [column.max_width for column in columns]
+    section_format = formats["section"] if spec.section_of is not None else None
+
+    stats = ReportStats(spec.distinct_columns)
+    distinct = tuple(stats.distinct.items())
+    section = None
+    current_row = header_row + 1
+
+    for row in rows:
+        try:
+            values = [getter(row) for getter in getters]
+            label = spec.section_of(row) if spec.section_of is not None else None
+        except Exception as e:
+            print(f"Error processing record: {str(row)}, Error: {str(e)}")
+            continue
+
+        if label is not None and label != section:
+            section = label
+            worksheet.set_row(current_row, 25)  # Taller row for section header
+            worksheet.merge_range(current_row, 0, current_row, last_col, label, section_format)
+            current_row += 1
+
+        worksheet.set_row(current_row, 15)
+        for col, value in enumerate(values):
+            worksheet.write(current_row, col, value, cell_formats[col])
+        current_row += 1
+
+        for col in auto_columns:
+            cell_length = len(str(values[col]))
+            if max_widths[col] is not None:
+                cell_length = min(cell_length, max_widths[col])
+            if cell_length > col_widths[col]:
+                col_widths[col] = cell_length
+
+        stats.rows += 1
+        if label is not None:
+            stats.section_counts[label] = stats.section_counts.get(label, 0) + 1
+        for index, values_seen in distinct:
+            if values[index]:
+                values_seen.add(values[index])
+
+        if progress is not None and stats.rows % 500 == 0:
+            progress(stats.rows)
+
+    # Add summary of counts
+    if spec.summary is not None:
+        current_row += spec.summary_gap
+        for line in spec.summary(stats):
+            worksheet.write(current_row, 0, line, formats["summary"])
+            current_row += 1
+
+    # Set column widths
+    for col, column in enumerate(columns):
+        worksheet.set_column(col, col, col_widths[col] + column.padding)
+
+    workbook.close()
+
+    if hasattr(output, "seek"):
+        output.seek(0)
+
+    if progress is not None:
+        progress(stats.rows)
+
+    return output, stats
\ No newline at end of file
@@ -0,0 +1,225 @@
+"""Background export jobs of the Excel reports, so /genera-report doesn't build the workbook in the
+request thread.
+
+A POST creates a job in job_report and runs it in a small pool of worker threads, the page polls the
+job and downloads the artifact once completed. The artifacts are the ones of report_cache, so a job
+whose data didn't change since the last export completes at once, and a job already running for the
+same data is reused instead of starting another one. The state lives in the database, so any server
+process can answer the polls.
+
+Requires migrations/010_job_report.sql
+"""
+
+import logging
+import os
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # First attempt direct import (works when running server.py)
+    import fredbconn
+    import report_cache
+    import report_generator_completo
+except ImportError:
+    # Fall back to package import (works when running the scripts from the root)
+    from python import fredbconn
+    from python import report_cache
+    from python import report_generator_completo
+
+logger = logging.getLogger("ReportJobs")
+
+# report type -> (tables read, generate(output, progress), count of the rows)
+REPORTS = {
+    "completo": (("ditte", "dipendenti", "ruoli"),
+                 report_generator_completo.generate_report,
+                 report_generator_completo.count_rows),
+}
+
+# A job not updated for this long was lost with its process, e.g. a restart
+STALE_MINUTES = 10
+
+_max_workers = 2
+_keep_hours = 24
+
+_lock = threading.Lock()
+_executor = None
+
+
+def configure_report_jobs(max_workers=2, keep_hours=24):
+    """Sets how many exports run at the same time and how long the jobs and their artifacts are kept"""
+    global _max_workers, _keep_hours
+    _max_workers = max_workers
+    _keep_hours = keep_hours
+
+
+def worker_count():
+    """Returns how many exports may run at the same time, each holding a database connection"""
+    return _max_workers
+
+
+def _get_executor():
+    """Creates the pool on first use, in the process serving the requests"""
+    global _executor
+
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_max_workers, thread_name_prefix="report-job")
+        return _executor
+
+
+@fredbconn.connected_to_database
+def _fetch_reusable_jobs(cursor, report_type, key):
+    """Returns the (id, stato, percorso) of the jobs of the same data, completed or still running"""
+    cursor.execute(f"""
+    SELECT id, stato, percorso
+    FROM job_report
+    WHERE tipo = %s
+        AND chiave = %s
+        AND (stato = 'completato' OR aggiornato_il > NOW() - INTERVAL {STALE_MINUTES} MINUTE)
+        AND stato <> 'fallito'
+    ORDER BY creato_il DESC
+    """, (report_type, key))
+
+    return cursor.fetchall()
+
+
+@fredbconn.connected_to_database
+def _insert_job(cursor, id, report_type, key, utente, percorso=None):
+    cursor.execute("""
+    INSERT INTO job_report (id, tipo, chiave, stato, percorso, utente)
+    VALUES (%s, %s, %s, %s, %s, %s)
+    """, (id, report_type, key, "completato" if percorso else "in_coda", percorso, utente))
+
+
+@fredbconn.connected_to_database
+def _update_job(cursor, id, **fields):
+    assignments = ", ".join(f"{field} = %s" for field in fields)
+    cursor.execute(f"""
+    UPDATE job_report
+    SET {assignments}
+    WHERE id = %s
+    """, (*fields.values(), id))
+
+
+def submit(report_type, utente):
+    """Starts an export, or reuses the one of the same data, and returns the id of its job.
+
+    Inside a request the job starts after the request commits, so the worker always finds its row.
+
+    Returns:
+        str: the id of the job, None if the job couldn't be created
+    """
+    tables, _, _ = REPORTS[report_type]
+    key = report_cache.artifact_key(report_type, tables)
+
+    jobs = _fetch_reusable_jobs(report_type, key)
+
+    # The decorator returns the error as a string
+    if isinstance(jobs, str):
+        logger.error(f"Unable to read the report jobs: {jobs}")
+        return None
+
+    # A completed job is reused only while its artifact is still on disk
+    for id, stato, percorso in jobs:
+        if stato != "completato" or os.path.exists(percorso):
+            return id
+
+    id = uuid.uuid4().hex
+
+    # Already generated, e.g. by the synchronous download, there is nothing to run
+    path = report_cache.artifact_path(report_type, key)
+    generated = os.path.exists(path)
+
+    result = _insert_job(id, report_type, key, utente, path if generated else None)
+    if isinstance(result, str):
+        logger.error(f"Unable to create the report job: {result}")
+        return None
+
+    if generated:
+        return id
+
+    fredbconn.call_after_commit(lambda: _get_executor().submit(_run, id, report_type))
+    return id
+
+
+def _run(id, report_type):
+    """Runs an export in a worker thread, each update of the job commits on its own"""
+    tables, generate, count = REPORTS[report_type]
+
+    try:
+        totale = count()
+
+        # The decorator returns the error as a string, the progress is then shown without the total
+        if isinstance(totale, str):
+            totale = None
+
+        _update_job(id, stato="in_corso", totale=totale)
+
+        def progress(righe):
+            _update_job(id, righe=righe)
+
+        # The key is computed again, the data may have changed while the job was queued
+        path, key = report_cache.get_report(report_type, tables, lambda output: generate(output, progress))
+
+        _update_job(id, stato="completato", percorso=path, chiave=key, righe=totale or 0)
+        logger.info(f"Report job {id} completed: {path}")
+
+    except Exception:
+        errore = traceback.format_exc()
+        logger.error(f"Report job {id} failed:\n{errore}")
+        _update_job(id, stato="fallito", errore=errore)
+
+
+@fredbconn.connected_to_database
+def get_job(cursor, id):
+    """Returns the job as a dict, None if it doesn't exist"""
+    cursor.execute(f"""
+    SELECT tipo, stato, righe, totale, percorso, chiave, creato_il,
+        stato IN ('in_coda', 'in_corso') AND aggiornato_il < NOW() - INTERVAL {STALE_MINUTES} MINUTE
+    FROM job_report
+    WHERE id = %s
+    """, (id,))
+    row = cursor.fetchone()
+
+    if row is None:
+        return None
+
+    tipo, stato, righe, totale, percorso, chiave, creato_il, stale = row
+
+    # The process running it stopped, the page can start a new one
+    if stale:
+        stato = "fallito"
+
+    return {
+        "id": id,
+        "tipo": tipo,
+        "stato": stato,
+        "righe": righe,
+        "totale": totale,
+        "percorso": percorso,
+        "chiave": chiave,
+        "creato_il": creato_il,
+    }
+
+
+@fredbconn.connected_to_database
+def _delete_old_jobs(cursor, hours):
+    cursor.execute("""
+    DELETE FROM job_report
+    WHERE creato_il < NOW() - INTERVAL %s HOUR
+    """, (hours,))
+    return cursor.rowcount
+
+
+def cleanup():
+    """Scheduler job: deletes the jobs older than keep_hours and the artifacts not served since then"""
+    deleted = _delete_old_jobs(_keep_hours)
+    if isinstance(deleted, str):
+        logger.error(f"Unable to delete the old report jobs: {deleted}")
+        return False
+
+    report_cache.evict(max_age_seconds=_keep_hours * 3600)
+    logger.info(f"Deleted {deleted} old report jobs")
+    return True
\ No newline at end of file
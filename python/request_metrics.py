@@ -0,0 +1,221 @@
+"""Timing of the requests of the Flask app, per endpoint: latency, time in the database, time rendering
+the templates and size of the response.
+
+init_app registers the hooks, which only take a few clocks and one append per request. Each endpoint
+keeps its last `samples` requests in ring buffers, from which the /metrics page computes the
+percentiles when it's opened, and cumulative latency buckets for the Prometheus format. The latency
+is measured until the teardown of the request, so the commit of the unit of work of fredbconn is
+included, the streamed responses (e.g. send_file) until their headers.
+
+The metrics are per process: with several workers, see serving.py, each one answers with its own.
+"""
+
+import threading
+import time
+from collections import deque
+
+from flask import before_render_template, g, request, template_rendered
+
+try:
+    # First attempt direct import (works when running server.py)
+    import fredbconn
+    from fredbconn.pool_metrics import BUCKETS_MS, Histogram
+except ImportError:
+    # Fall back to package import (works when running the scripts from the root)
+    from python import fredbconn
+    from python.fredbconn.pool_metrics import BUCKETS_MS, Histogram
+
+# The requests not worth timing, e.g. the static files and the metrics themselves
+IGNORED_ENDPOINTS = {"static", "metrics", "metrics_pool"}
+
+_enabled = True
+_samples = 1024
+
+_lock = threading.Lock()
+
+# endpoint -> _Endpoint
+_endpoints = {}
+_started_at = time.time()
+
+
+def configure_request_metrics(enabled=True, samples=1024):
+    """Switches the timing of the requests, and sets how many requests per endpoint the percentiles cover"""
+    global _enabled, _samples
+    _enabled = enabled
+    _samples = samples
+
+
+class _Endpoint:
+    """Ring buffers of the last requests of an endpoint, with the totals since the start"""
+    __slots__ = ("latency", "db", "render", "size", "histogram", "statuses", "count", "bytes", "db_total", "render_total")
+
+    def __init__(self, samples):
+        self.latency = deque(maxlen=samples)
+        self.db = deque(maxlen=samples)
+        self.render = deque(maxlen=samples)
+        self.size = deque(maxlen=samples)
+        self.histogram = Histogram()
+        self.statuses = {}
+        self.count = 0
+        self.bytes = 0
+        self.db_total = 0.0
+        self.render_total = 0.0
+
+    def record(self, latency_ms, db_ms, render_ms, size, status):
+        self.latency.append(latency_ms)
+        self.db.append(db_ms)
+        self.render.append(render_ms)
+        self.size.append(size)
+        self.histogram.record(latency_ms)
+        status_class = f"{status // 100}xx"
+        self.statuses[status_class] = self.statuses.get(status_class, 0) + 1
+        self.count += 1
+        self.bytes += size
+        self.db_total += db_ms
+        self.render_total += render_ms
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "max": None}
+
+    def pick(fraction):
+        return round(values[min(len(values) - 1, int(fraction * len(values)))], 3)
+
+    return {"p50": pick(0.5), "p95": pick(0.95), "p99": pick(0.99), "max": round(values[-1], 3)}
+
+
+def _average(values):
+    return round(sum(values) / len(values), 3) if values else None
+
+
+def _before_request():
+    if _enabled:
+        g.request_metrics_start = time.perf_counter()
+        g.request_metrics_render = 0.0
+
+
+def _after_request(response):
+    if _enabled and "request_metrics_start" in g:
+        # Unknown for the streamed responses without Content-Length
+        g.request_metrics_size = response.content_length or 0
+        g.request_metrics_status = response.status_code
+    return response
+
+
+def _teardown_request(exc):
+    start = g.pop("request_metrics_start", None)
+    if start is None or request.endpoint in IGNORED_ENDPOINTS:
+        return
+
+    latency_ms = (time.perf_counter() - start) * 1000
+    status = g.pop("request_metrics_status", 500)
+    size = g.pop("request_metrics_size", 0)
+    render_ms = g.pop("request_metrics_render", 0.0) * 1000
+    db_ms = fredbconn.db_time() * 1000
+
+    # The unmatched urls are counted together, their paths are unbounded
+    endpoint = request.endpoint or "404"
+
+    with _lock:
+        entry = _endpoints.get(endpoint)
+        if entry is None:
+            entry = _endpoints[endpoint] = _Endpoint(_samples)
+        entry.record(latency_ms, db_ms, render_ms, size, status)
+
+
+def _before_render(sender, template, context, **extra):
+    if "request_metrics_start" in g:
+        g.request_metrics_render_start = time.perf_counter()
+
+
+def _rendered(sender, template, context, **extra):
+    start = g.pop("request_metrics_render_start", None)
+    if start is not None:
+        g.request_metrics_render += time.perf_counter() - start
+
+
+def init_app(app):
+    """Registers the timing hooks on the app.
+
+    Call it before fredbconn.init_app, so that the commit of the unit of work, done in an after_request
+    registered later and therefore run earlier, is counted in the latency and the database time.
+    """
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+
+
+def snapshot():
+    """Returns the metrics of every endpoint, the slowest p95 first"""
+    with _lock:
+        entries = [(endpoint, entry, list(entry.latency), list(entry.db), list(entry.render), list(entry.size))
+                   for endpoint, entry in _endpoints.items()]
+
+    endpoints = []
+    for endpoint, entry, latency, db, render, size in entries:
+        endpoints.append({
+            "endpoint": endpoint,
+            "richieste": entry.count,
+            "stati": dict(entry.statuses),
+            "campioni": len(latency),
+            "latenza_ms": _percentiles(latency),
+            "db_ms": dict(_percentiles(db), media=_average(db)),
+            "render_ms": dict(_percentiles(render), media=_average(render)),
+            "dimensione_media": _average(size),
+        })
+
+    endpoints.sort(key=lambda entry: entry["latenza_ms"]["p95"] or 0, reverse=True)
+    return {"da_secondi": round(time.time() - _started_at), "endpoint": endpoints}
+
+
+def prometheus():
+    """Returns the totals of every endpoint in the Prometheus text format"""
+    with _lock:
+        entries = sorted(_endpoints.items())
+        rows = [(endpoint, list(entry.histogram.counts), entry.histogram.count, entry.histogram.total_ms,
+                 dict(entry.statuses), entry.bytes, entry.db_total, entry.render_total)
+                for endpoint, entry in entries]
+
+    lines = [
+        "# HELP acca_request_duration_seconds Latency of the requests by endpoint",
+        "# TYPE acca_request_duration_seconds histogram",
+    ]
+    for endpoint, counts, count, total_ms, _, _, _, _ in rows:
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS_MS, counts):
+            cumulative += bucket
+            lines.append(f'acca_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{bound / 1000:g}"}} {cumulative}')
+        lines.append(f'acca_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {count}')
+        lines.append(f'acca_request_duration_seconds_sum{{endpoint="{endpoint}"}} {total_ms / 1000:.6f}')
+        lines.append(f'acca_request_duration_seconds_count{{endpoint="{endpoint}"}} {count}')
+
+    counters = (
+        ("acca_requests_total", "Requests by endpoint and status class", 4, None),
+        ("acca_response_bytes_total", "Bytes of the responses by endpoint", 5, 1),
+        ("acca_request_db_seconds_total", "Time in the database by endpoint", 6, 1000),
+        ("acca_request_render_seconds_total", "Time rendering the templates by endpoint", 7, 1000),
+    )
+    for name, description, index, divisor in counters:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} counter")
+        for row in rows:
+            endpoint = row[0]
+            if divisor is None:
+                for status_class, count in sorted(row[index].items()):
+                    lines.append(f'{name}{{endpoint="{endpoint}",status="{status_class}"}} {count}')
+            else:
+                lines.append(f'{name}{{endpoint="{endpoint}"}} {row[index] / divisor:g}')
+
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    """Forgets every request recorded so far"""
+    global _started_at
+    with _lock:
+        _endpoints.clear()
+        _started_at = time.time()
\ No newline at end of file
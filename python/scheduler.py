@@ -0,0 +1,326 @@
+"""In-process scheduler running the periodic jobs (weekly report, expired badges check, mail outbox,
+gate events rollups, report jobs cleanup) on cron-like schedules, in place of a cron entry per script.
+
+It runs as a thread inside server.py when scheduler_config['run_in_server'] is set in passwords.py,
+or as a long-lived daemon with: python scheduler.py
+Either way the jobs share the warm database pool and Gmail client of the process.
+
+Each run takes a MySQL named lock and is recorded in esecuzioni_job, so a job never runs twice at the
+same time and each scheduled occurrence runs once, even with several schedulers. The occurrences
+missed while no scheduler was running are skipped.
+
+Requires migrations/006_esecuzioni_job.sql
+
+Usage:
+    python scheduler.py              run the scheduler until interrupted
+    python scheduler.py --run NAME   run a job once now
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import traceback
+from datetime import datetime, time, timedelta
+
+try:
+    # First attempt direct import (works when running server.py)
+    import fredbconn
+except ImportError:
+    # Fall back to package import (works when running the scripts from the root)
+    from python import fredbconn
+
+logger = logging.getLogger("Scheduler")
+
+# Schedules of the jobs, overridable in passwords.scheduler_config['jobs'], None disables a job
+DEFAULT_SCHEDULES = {
+    "weekly_report": "0 7 * * 1",     # Monday at 7:00
+    "expired_badges": "0 6 * * *",    # Every day at 6:00
+    "mail_outbox": "*/15 * * * *",    # Retries the queued emails every 15 minutes
+    "access_hourly": "5 * * * *",     # Headcounts of the gate events, every hour
+    "access_daily": "20 0 * * *",     # Daily headcounts and partitions of the gate events
+    "report_cleanup": "40 * * * *",   # Old report jobs and artifacts, every hour
+}
+
+
+class CronSchedule:
+    """A cron expression: minute hour day-of-month month day-of-week.
+
+    Each field accepts *, numbers, ranges (1-5), lists (1,15) and steps (*/15, 0-30/10).
+    Day of week goes from 0 (Sunday) to 6, 7 is Sunday too. As in cron, when both day fields
+    are restricted a day matching either of them matches.
+    """
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f"Invalid cron expression {expression!r}: 5 fields expected")
+
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse_field(part, low, high) for part, (low, high) in zip(parts, self.FIELDS)
+        )
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self.days_restricted = parts[2] != "*"
+        self.weekdays_restricted = parts[4] != "*"
+
+        self.minutes = sorted(self.minutes)
+        self.hours = sorted(self.hours)
+
+    @staticmethod
+    def _parse_field(field, low, high):
+        values = set()
+        for item in field.split(","):
+            step = 1
+            if "/" in item:
+                item, step_str = item.split("/", 1)
+                step = int(step_str)
+            if item == "*":
+                start, end = low, high
+            elif "-" in item:
+                start, end = (int(bound) for bound in item.split("-", 1))
+            else:
+                start = end = int(item)
+                if step != 1:
+                    end = high
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"Invalid cron field {field!r}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _matches_day(self, day):
+        if day.month not in self.months:
+            return False
+        # isoweekday is 1 (Monday) to 7 (Sunday), cron counts from 0 (Sunday)
+        day_match = day.day in self.days
+        weekday_match = day.isoweekday() % 7 in self.weekdays
+        if self.days_restricted and self.weekdays_restricted:
+            return day_match or weekday_match
+        return day_match and weekday_match
+
+    def next_after(self, moment):
+        """Returns the first time matching the schedule strictly after moment"""
+        start = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.date()
+
+        # Every valid expression matches at least once within a few years (e.g. 29 February)
+        for _ in range(366 * 8):
+            if self._matches_day(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = datetime.combine(day, time(hour, minute))
+                        if candidate >= start:
+                            return candidate
+            day += timedelta(days=1)
+
+        raise ValueError(f"The cron expression {self.expression!r} never matches")
+
+
+class Job:
+    """A function run on a schedule.
+
+    Args:
+        name (str): name of the job, used for the lock and the history
+        schedule (str): cron expression
+        func (callable): called without arguments, returning False marks the run as failed
+        record_history (bool): record the runs in esecuzioni_job, disable for frequent jobs
+    """
+    def __init__(self, name, schedule, func, record_history=True):
+        self.name = name
+        self.schedule = CronSchedule(schedule)
+        self.func = func
+        self.record_history = record_history
+        self.next_run = None
+
+
+@fredbconn.connected_to_database
+def _start_run(cursor, job_name, scheduled_for):
+    """Records the start of a run, returns its id or None if the occurrence already ran"""
+    cursor.execute("""
+    INSERT IGNORE INTO esecuzioni_job (job, programmata_per)
+    VALUES (%s, %s)
+    """, (job_name, scheduled_for))
+    return cursor.lastrowid if cursor.rowcount == 1 else None
+
+
+@fredbconn.connected_to_database
+def _finish_run(cursor, id_run, stato, errore):
+    cursor.execute("""
+    UPDATE esecuzioni_job
+    SET terminata_il = NOW(), stato = %s, errore = %s
+    WHERE id = %s
+    """, (stato, errore, id_run))
+
+
+def run_job(job, scheduled_for=None):
+    """Runs the job now, unless another process is running it or already ran this occurrence.
+
+    Returns:
+        bool: True if the job ran and succeeded, False if it failed, None if it was skipped
+    """
+    scheduled_for = scheduled_for or datetime.now().replace(microsecond=0)
+
+    with fredbconn.named_lock(f"acca_job_{job.name}") as acquired:
+        if not acquired:
+            logger.info(f"Job {job.name} is already running in another process, skipped")
+            return None
+
+        id_run = None
+        if job.record_history:
+            id_run = _start_run(job.name, scheduled_for)
+            if isinstance(id_run, str):
+                logger.error(f"Unable to record the run of job {job.name}, skipped: {id_run}")
+                return None
+            if id_run is None:
+                logger.info(f"Job {job.name} already ran for {scheduled_for}, skipped")
+                return None
+
+        logger.info(f"Running job {job.name} scheduled for {scheduled_for}")
+        errore = None
+        try:
+            success = job.func() is not False
+            if not success:
+                errore = "The job reported a failure, see its log"
+        except Exception:
+            success = False
+            errore = traceback.format_exc()
+            logger.error(f"Job {job.name} failed:\n{errore}")
+
+        if id_run is not None:
+            _finish_run(id_run, "completata" if success else "fallita", errore)
+
+        logger.info(f"Job {job.name} {'completed' if success else 'failed'}")
+        return success
+
+
+class Scheduler(threading.Thread):
+    """Thread running the jobs when they are due, one at a time"""
+    def __init__(self, jobs=()):
+        super().__init__(name="scheduler", daemon=True)
+        self.jobs = list(jobs)
+        self.stop_event = threading.Event()
+
+    def add_job(self, name, schedule, func, record_history=True):
+        self.jobs.append(Job(name, schedule, func, record_history))
+
+    def run(self):
+        now = datetime.now()
+        for job in self.jobs:
+            job.next_run = job.schedule.next_after(now)
+            logger.info(f"Job {job.name} ({job.schedule.expression}) next run at {job.next_run}")
+
+        while self.jobs and not self.stop_event.is_set():
+            next_run = min(job.next_run for job in self.jobs)
+            wait = (next_run - datetime.now()).total_seconds()
+            if wait > 0:
+                # Woken at least every minute, so that clock changes are noticed
+                self.stop_event.wait(min(wait, 60))
+                continue
+
+            for job in self.jobs:
+                if job.next_run <= datetime.now() and not self.stop_event.is_set():
+                    try:
+                        run_job(job, job.next_run)
+                    except Exception:
+                        logger.exception(f"Error running job {job.name}")
+                    # The occurrences passed while the job was running are skipped
+                    job.next_run = job.schedule.next_after(max(job.next_run, datetime.now()))
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def default_jobs(schedules=None):
+    """Builds the jobs of ACCA.
+
+    Args:
+        schedules (dict, optional): cron expression by job name, overriding DEFAULT_SCHEDULES, None disables a job
+    """
+    import passwords
+    import mail_outbox
+    import access_events
+    import report_jobs
+    import send_weekly_report_oauth
+    import send_email_scaduti_oauth
+
+    def drain_outbox():
+        transport = mail_outbox.transport_from_config(passwords.email_config,
+                                                      **getattr(passwords, "outbox_config", {}))
+        mail_outbox.drain(transport)
+
+    access_events.configure_access_events(**getattr(passwords, "access_events_config", {}))
+    report_jobs.configure_report_jobs(**getattr(passwords, "report_jobs_config", {}))
+
+    functions = {
+        "weekly_report": (send_weekly_report_oauth.send_weekly_report, True),
+        "expired_badges": (send_email_scaduti_oauth.check_expired_badges, True),
+        "mail_outbox": (drain_outbox, False),
+        "access_hourly": (access_events.run_hourly_rollup, False),
+        "access_daily": (access_events.run_daily_maintenance, True),
+        "report_cleanup": (report_jobs.cleanup, False),
+    }
+
+    all_schedules = dict(DEFAULT_SCHEDULES, **(schedules or {}))
+
+    jobs = []
+    for name, schedule in all_schedules.items():
+        if schedule is None:
+            continue
+        if name not in functions:
+            raise ValueError(f"Unknown job {name!r} in scheduler_config")
+        func, record_history = functions[name]
+        jobs.append(Job(name, schedule, func, record_history))
+    return jobs
+
+
+def start_scheduler(jobs=None, run_in_server=True):
+    """Starts the scheduler thread, takes passwords.scheduler_config as keyword arguments and returns the thread"""
+    scheduler = Scheduler(default_jobs(jobs))
+    scheduler.start()
+    return scheduler
+
+
+def setup_logging():
+    """Logs to email-logs/scheduler.log, used when running as a daemon"""
+    log_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "email-logs")
+    os.makedirs(log_dir, exist_ok=True)
+
+    logging.basicConfig(
+        filename=os.path.join(log_dir, "scheduler.log"),
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    )
+
+
+def main():
+    import passwords
+
+    parser = argparse.ArgumentParser(description="Runs the periodic jobs of ACCA")
+    parser.add_argument("--run", metavar="NAME", help="run a job once now and exit")
+    args = parser.parse_args()
+
+    setup_logging()
+    fredbconn.initialize_database(*passwords.database_config)
+
+    jobs = default_jobs(getattr(passwords, "scheduler_config", {}).get("jobs"))
+
+    if args.run:
+        for job in jobs:
+            if job.name == args.run:
+                return 0 if run_job(job) else 1
+        parser.error(f"unknown or disabled job {args.run!r}")
+
+    scheduler = Scheduler(jobs)
+    scheduler.start()
+    try:
+        while scheduler.is_alive():
+            scheduler.join(1)
+    except KeyboardInterrupt:
+        scheduler.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -4,95 +4,109 @@ import logging
 from datetime import datetime
 import traceback
 
-# Set up logging
-log_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "email-logs")
-os.makedirs(log_dir, exist_ok=True)
-log_file = os.path.join(log_dir, "weekly_report.log")
+import passwords
+import fredbconn
+import report_generator
+import gmail_oauth
+import mail_outbox
 
-logging.basicConfig(
-    filename=log_file,
-    filemode='w',  # 'w' mode overwrites the existing file
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-)   
 logger = logging.getLogger("WeeklyReport")
 
-def main():
-    """Main function to generate and email the weekly report."""
+
+def setup_logging():
+    """Logs to email-logs/weekly_report.log, used when running as a script"""
+    log_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "email-logs")
+    os.makedirs(log_dir, exist_ok=True)
+    log_file = os.path.join(log_dir, "weekly_report.log")
+
+    logging.basicConfig(
+        filename=log_file,
+        filemode='w',  # 'w' mode overwrites the existing file
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+
+
+@fredbconn.connected_to_database
+def fetch_email_recipients(cursor):
+    """Fetch email recipients from the dedicated table."""
+    cursor.execute("""
+    SELECT email
+    FROM email_recipients
+    """)
+    
+    recipients = []
+    for row in cursor.fetchall():
+        email = row[0].strip()
+        if email:
+            recipients.append(email)
+    
+    return recipients
+
+
+def send_weekly_report():
+    """Generate the weekly report and email it, the database must be initialized.
+
+    Returns:
+        bool: True if the email was queued, it stays in the outbox to retry when sending fails
+    """
     try:
         logger.info("Starting weekly report generation and email process")
         
-        # Import modules from python directory
-        import passwords
-        import fredbconn
-        import report_generator
-        import email_manager_oauth  # Use the OAuth version
-        
-        # Initialize database connection
-        logger.info("Initializing database connection")
-        fredbconn.initialize_database(*passwords.database_config_weekly_report)
-        
         # Fetch recipients from database
         logger.info("Fetching email recipients from database")
         
-        @fredbconn.connected_to_database
-        def fetch_email_recipients(cursor):
-            """Fetch email recipients from the dedicated table."""
-            cursor.execute("""
-            SELECT email
-            FROM email_recipients
-            """)
+        # Recipients and report data are read with a single connection and transaction
+        with fredbconn.unit_of_work():
+            recipients = fetch_email_recipients()
             
-            recipients = []
-            for row in cursor.fetchall():
-                email = row[0].strip()
-                if email:
-                    recipients.append(email)
+            # Check if we have any recipients
+            if isinstance(recipients, str) or not recipients:
+                logger.error("No email recipients found in database. Report will not be sent.")
+                return False
             
-            return recipients
-        
-        recipients = fetch_email_recipients()
-        
-        # Check if we have any recipients
-        if not recipients:
-            logger.error("No email recipients found in database. Report will not be sent.")
-            sys.exit(1)
-        
-        logger.info(f"Found {len(recipients)} email recipients")
+            logger.info(f"Found {len(recipients)} email recipients")
+                
+            # Generate the report using the weekly report function
+            logger.info("Generating weekly report (badge valido only)")
+            report_data = report_generator.generate_weekly_report()
             
-        # Generate the report using the weekly report function
-        logger.info("Generating weekly report (badge valido only)")
-        report_data = report_generator.generate_weekly_report()
-        
-        # Initialize the email manager with OAuth support
-        logger.info("Initializing OAuth email manager")
-        email_mgr = email_manager_oauth.EmailManager(passwords.email_config, logger)
-        
-        # Check if OAuth is authenticated
-        if not email_mgr.oauth_handler.authenticate():
-            logger.error("""
-            Gmail OAuth not authenticated. Please authenticate first by:
-            1. Open your web browser
-            2. Go to http://localhost:16000/oauth/check_gmail_auth
-            3. Click 'Authorize Gmail' and follow the prompts
-            4. Once authorization is complete, run this script again
-            """)
-            sys.exit(1)
+            # Queue the email with the report in the same transaction, so nothing is lost if Gmail is unreachable
+            subject, body, attachments = gmail_oauth.weekly_report_email(report_data)
+            queued = mail_outbox.enqueue(passwords.email_config['sender_email'], recipients,
+                                         subject, body, attachments, use_bcc=True)
+            
+            if isinstance(queued, str):
+                logger.error(f"Failed to queue weekly report email: {queued}")
+                return False
         
-        # Send the email with the report
+        # Send the queued emails, the ones failing are retried by the next runs
         logger.info(f"Sending report to {len(recipients)} recipients")
-        success = email_mgr.send_weekly_report(recipients, report_data)
+        transport = mail_outbox.transport_from_config(passwords.email_config,
+                                                      **getattr(passwords, "outbox_config", {}))
+        sent, failed = mail_outbox.drain(transport)
         
-        if success:
-            logger.info("Weekly report process completed successfully")
+        if failed:
+            logger.warning(f"{failed} email(s) could not be sent and were left in the outbox to retry")
         else:
-            logger.error("Failed to send weekly report email")
-            sys.exit(1)
+            logger.info(f"Weekly report process completed successfully, {sent} email(s) sent")
+        return True
             
     except Exception as e:
         logger.error(f"Unhandled exception in main function: {str(e)}")
         logger.error(traceback.format_exc())
-        sys.exit(1)
+        return False
+
+
+def main():
+    """Main function to generate and email the weekly report."""
+    setup_logging()
+    
+    # Initialize database connection
+    logger.info("Initializing database connection")
+    fredbconn.initialize_database(*passwords.database_config_weekly_report)
+    
+    return 0 if send_weekly_report() else 1
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -1,12 +1,10 @@
-from flask import Flask, jsonify, render_template, request, redirect, url_for, flash, session, send_file
+from flask import Flask, jsonify, render_template, request, redirect, url_for, flash, session, send_file, Response
 import passwords
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.exceptions import BadRequest
+from markupsafe import Markup
 import fredbconn
 import fredauth
-from waitress import serve
-import xlsxwriter
-import io
 from datetime import datetime, date
 import os
 import sys
@@ -14,10 +12,60 @@ import logging
 import traceback
 import report_generator_completo
 import oauth_routes
+import pagination
+import dipendenti_search
+import data_versions
+import reference_data
+import report_cache
+import badge_expiry
+import badge_state
+import access_index
+import access_events
+import report_jobs
+import request_metrics
+import fragment_cache
+import http_cache
+import serving
 
 app = Flask(__name__, template_folder="../templates", static_folder="../static")
 app.secret_key = passwords.app_secret_key
 
+# Optional, e.g. {"samples": 1024}: latency, database and template times per page, on /metrics
+request_metrics.configure_request_metrics(**getattr(passwords, "request_metrics_config", {}))
+
+# Before fredbconn.init_app, so that the timing includes the commit of the request
+request_metrics.init_app(app)
+
+# One pooled connection and one transaction per request, shared by every decorated function
+fredbconn.init_app(app)
+
+# Optional, e.g. {"warm_up": 4, "min_connections": 4}: see fredbconn.configure_pool, before the pool is created
+fredbconn.configure_pool(**getattr(passwords, "pool_config", {}))
+
+# Optional, e.g. {"enabled": True, "slow_ms": 200}: see fredbconn.configure_profiling, also switched from /admin/profiling
+fredbconn.configure_profiling(**getattr(passwords, "profiling_config", {}))
+
+# Optional, e.g. {"ttl_seconds": 300, "use_version_column": True} after migrations/001
+fredauth.configure_authorization_cache(**getattr(passwords, "authorization_cache_config", {}))
+
+# Optional, e.g. {"poll_seconds": 5}: how stale the versions read outside of a request can be after another process wrote
+data_versions.configure_data_versions(**getattr(passwords, "data_versions_config", {}))
+
+# Optional, e.g. {"directory": "D:/report-cache", "max_bytes": 500 * 1024 * 1024}
+report_cache.configure_report_cache(**getattr(passwords, "report_cache_config", {}))
+
+# Optional, e.g. {"poll_seconds": 2}: how stale /api/access-check can be after another process wrote
+access_index.configure_access_index(**getattr(passwords, "access_check_config", {}))
+
+# Optional, e.g. {"flush_seconds": 2, "retention_days": 400}: see access_events.configure_access_events
+access_events.configure_access_events(**getattr(passwords, "access_events_config", {}))
+
+# Optional, e.g. {"max_workers": 2, "keep_hours": 24}: background exports of /genera-report
+report_jobs.configure_report_jobs(**getattr(passwords, "report_jobs_config", {}))
+
+# Optional, e.g. {"max_bytes": 32 * 1024 * 1024}: the rendered rows of /ditte and /dipendenti
+fragment_cache.configure_fragment_cache(**getattr(passwords, "fragment_cache_config", {}))
+
 class NoDittaSelectedException(Exception):
     """Exception raised when no ditta (entity) is selected."""
     pass
@@ -115,6 +163,12 @@ class Dipendente:
         """, (fields[0], fields[1], ditta_id, fields[3], fields[4], fields[5], 
               scadenza_autorizzazione, fields[7], fields[8], fields[9], fields[10], fields[11]))
 
+        # Read before the UPDATE of bump, which resets it
+        new_id = cursor.lastrowid
+
+        data_versions.bump(cursor, "dipendenti")
+        access_index.track_changes(cursor, ("dipendenti",), dipendenti_ids=(new_id,))
+
 
 class Ditta:
 
@@ -141,6 +195,9 @@ class Ditta:
         VALUES
         (%s, %s, %s, %s, %s, %s)
         """, self.get_fields())
+
+        data_versions.bump(cursor, "ditte")
+        access_index.track_changes(cursor, ("ditte",))
     
 
     def __init__(self, nome: str, piva: str, nome_cognome_referente: str,
@@ -232,29 +289,6 @@ def aggiorna_dipendente():
                 "ruolo_id": dipendente_tuple[11]
             }
 
-            cursor.execute("""
-                SELECT id, nome
-                FROM ditte
-                ORDER BY nome ASC
-            """)
-            
-            ditte_tuple = cursor.fetchall()
-
-            # Flatten the tuple of tuples into a single tuple of names
-            ditte = tuple(ditta for ditta in ditte_tuple)
-
-            # Add the ditte entry to the dictionary
-            ret["ditte"] = ditte
-
-            # Get all roles
-            cursor.execute("""
-                SELECT id, nome_ruolo
-                FROM ruoli
-                ORDER BY id ASC
-            """)
-            
-            ret["ruoli"] = cursor.fetchall()
-
             return ret
         
         fetched = fetch_info()
@@ -267,22 +301,10 @@ def aggiorna_dipendente():
 
         fetched["dipendente_id"] = dipendente_id
 
-        @fredbconn.connected_to_database
-        def fetch_selected_ditta_name(cursor):
-            cursor.execute("""
-            SELECT
-                ditte.nome
-            FROM
-                ditte
-            WHERE
-                ditte.id = %s
-            """, (fetched["selected_ditta"],))
-
-            return cursor.fetchone()
-
-        fetched_selected_ditta_name = fetch_selected_ditta_name()
-
-        fetched["selected_ditta_name"] = fetched_selected_ditta_name[0]
+        # The lookup lists and the name of the selected ditta come from the in-process cache
+        fetched["ditte"] = reference_data.get_ditte()
+        fetched["ruoli"] = reference_data.get_ruoli()
+        fetched["selected_ditta_name"] = reference_data.get_ditta_name(fetched["selected_ditta"])
 
         is_there_already_a_date = int(bool(fetched.get("scadenza_autorizzazione")))
 
@@ -371,6 +393,9 @@ def aggiorna_dipendente():
                  note, scadenza_autorizzazione, badge_sospeso, badge_annullato, 
                  is_badge_temporaneo, numero_badge, ruolo_id, dipendente_id))
 
+            data_versions.bump(cursor, "dipendenti")
+            access_index.track_changes(cursor, ("dipendenti",), dipendenti_ids=(dipendente_id,))
+
         update_db()
 
         flash("Dipendente aggiornato con successo", "success")
@@ -394,6 +419,9 @@ def elimina_dipendente():
         FROM dipendenti
         WHERE id = %s
         """, (dipendente_id,))
+
+        data_versions.bump(cursor, "dipendenti")
+        access_index.track_changes(cursor, ("dipendenti",), dipendenti_ids=(dipendente_id,))
     
     eliminate_dipendente()
 
@@ -403,12 +431,15 @@ def elimina_dipendente():
 
 @app.route("/")
 @fredauth.authorized("user")
+@http_cache.conditional_get("dipendenti", daily=True)
 def index():
-    return render_template("index.html", username = session['user']) # username = session['user'] usato in jinja
+    return render_template("index.html", username = session['user'], # username = session['user'] usato in jinja
+                           fasce_scadenza = badge_expiry.get_bucket_counts())
 
 
 @app.route("/ditte")
 @fredauth.authorized("user")
+@http_cache.conditional_get("ditte")
 def ditte():
 
     nome = request.args.get("nome")
@@ -455,28 +486,24 @@ def ditte():
         fetch_ditte_info = func
 
 
-    @fredbconn.connected_to_database
-    def fetch_ditte_names(cursor):
-        cursor.execute("""
-        SELECT
-            ditte.nome
-        FROM
-            ditte
-        ORDER BY
-            nome ASC
-        """)
+    # The rows are rendered again only after a write to ditte, see fragment_cache
+    fragment_key = fragment_cache.make_key("ditte", {"nome": nome}, ("ditte",))
+    cached = fragment_cache.get(fragment_key)
 
-        fetched = cursor.fetchall()
+    if cached is not None:
+        righe, _ = cached
+    else:
+        fetched_ditte_info = fetch_ditte_info()
 
-        return fetched
+        righe = Markup(render_template("partials/ditte_rows.html", ditte = fetched_ditte_info))
 
-    fetched_ditte_info = None 
+        # The decorator returns the error as a string, which must never be cached
+        if not isinstance(fetched_ditte_info, str):
+            fragment_cache.put(fragment_key, righe)
 
-    fetched_ditte_info = fetch_ditte_info()
-    
-    ditte_names = fetch_ditte_names()
+    ditte_names = reference_data.get_ditte()
 
-    return render_template("ditte.html", ditte = fetched_ditte_info, ditte_names = ditte_names)
+    return render_template("ditte.html", righe = righe, ditte_names = ditte_names)
 
 
 @app.route("/aggiorna-ditta", methods = ["GET", "POST"])
@@ -548,6 +575,9 @@ def aggiorna_ditta():
             WHERE id = %s
             """, (nome, piva, nome_cognome_referente, email_referente, telefono_referente, note, ditta_id))
 
+            data_versions.bump(cursor, "ditte")
+            access_index.track_changes(cursor, ("ditte",), ditta_ids=(ditta_id,))
+
         update_db()
 
         flash("Ditta aggiornata con successo", "success")
@@ -617,6 +647,10 @@ def elimina_ditta():
         FROM ditte
         WHERE id = %s
         """, (ditta_id,))
+
+        # The dipendenti of the ditta are deleted in cascade
+        data_versions.bump(cursor, "ditte", "dipendenti")
+        access_index.track_changes(cursor, ("ditte", "dipendenti"), ditta_ids=(ditta_id,))
     
     eliminate_ditta()
 
@@ -624,181 +658,262 @@ def elimina_ditta():
     return redirect(request.referrer or "/ditte")
 
 
+# Columns of a row of the dipendenti listing, in the order used by dipendenti.html
+DIPENDENTI_LISTING_COLUMNS = (
+    "nome_ditta", "nome_dipendente", "cognome", "is_badge_already_emesso", "accesso_bloccato",
+    "note", "id", "scadenza_autorizzazione", "badge_sospeso", "badge_annullato",
+    "is_badge_temporaneo", "numero_badge", "nome_ruolo"
+)
+
+DIPENDENTI_LISTING_SELECT = """
+    SELECT 
+        ditte.nome AS nome_ditta,
+        dipendenti.nome AS nome_dipendente, 
+        dipendenti.cognome,  
+        dipendenti.is_badge_already_emesso, 
+        dipendenti.accesso_bloccato,
+        dipendenti.note,
+        dipendenti.id,
+        dipendenti.scadenza_autorizzazione,
+        dipendenti.badge_sospeso,
+        dipendenti.badge_annullato,
+        dipendenti.is_badge_temporaneo,
+        dipendenti.numero_badge,
+        ruoli.nome_ruolo
+    FROM 
+        dipendenti
+    JOIN 
+        ditte
+    ON 
+        dipendenti.ditta_id = ditte.id
+    LEFT JOIN
+        ruoli
+    ON
+        dipendenti.ruolo_id = ruoli.id
+"""
+
+
+@fredbconn.connected_to_database
+def fetch_dipendenti_page(cursor, filter_sql, filter_params, key, backwards, page_size):
+    """Fetches one keyset page of the dipendenti listing, ordered by (cognome, id).
+
+    Returns page_size + 1 rows at most, the extra row only tells that another page exists.
+    """
+    conditions = [filter_sql]
+    params = list(filter_params)
+
+    if key is not None:
+        keyset_sql, keyset_params = pagination.keyset_condition(
+            "dipendenti.cognome", "dipendenti.id", key, backwards)
+        conditions.append(keyset_sql)
+        params.extend(keyset_params)
+
+    order_by = pagination.keyset_order("dipendenti.cognome", "dipendenti.id", backwards)
+    params.append(page_size + 1)
+
+    cursor.execute(f"""
+    {DIPENDENTI_LISTING_SELECT}
+    WHERE
+        {" AND ".join(conditions)}
+    ORDER BY
+        {order_by}
+    LIMIT %s
+    """, tuple(params))
+
+    return cursor.fetchall()
+
+
+@fredbconn.connected_to_database
+def fetch_dipendenti_by_ids(cursor, ids):
+    """Fetches the listing rows of the given dipendenti, in the order of ids"""
+    if not ids:
+        return []
+
+    placeholders = ", ".join(["%s"] * len(ids))
+
+    cursor.execute(f"""
+    {DIPENDENTI_LISTING_SELECT}
+    WHERE
+        dipendenti.id IN ({placeholders})
+    """, tuple(ids))
+
+    rows_by_id = {row[6]: row for row in cursor.fetchall()}
+
+    return [rows_by_id[row_id] for row_id in ids if row_id in rows_by_id]
+
+
+def search_dipendenti(cognome, limit):
+    """Returns the listing rows matching the surname search, best match first, with their match kind"""
+    results = dipendenti_search.search_dipendenti_ids(cognome, limit)
+
+    # The decorator returns the error as a string
+    if isinstance(results, str):
+        return []
+
+    kinds = dict(results)
+
+    rows = fetch_dipendenti_by_ids([row_id for row_id, _ in results])
+
+    return [(row, kinds[row[6]]) for row in rows]
+
+
+def dipendente_row_to_json(row):
+    """Converts a row of the dipendenti listing to a JSON serializable dict"""
+    ret = dict(zip(DIPENDENTI_LISTING_COLUMNS, row))
+
+    if ret["scadenza_autorizzazione"] is not None:
+        ret["scadenza_autorizzazione"] = ret["scadenza_autorizzazione"].isoformat()
+
+    return ret
+
+
 @app.route("/dipendenti")
 @fredauth.authorized("user")
+@http_cache.conditional_get("dipendenti", "ditte", "ruoli", daily=True)
 def show_dipendenti():
+    """Lists the dipendenti matching one filter, a keyset page at a time.
+
+    Query parameters:
+        id_ditta, cognome, annullati or scadenza: the filter, no rows are shown without one
+            (cognome matches the start of the surname, then anywhere in it, see dipendenti_search,
+            scadenza is a bucket of badge_expiry)
+        page_size: rows per page
+        after / before: cursors of the next / previous page
+        format=json: returns the page as JSON, used to load more rows while scrolling
+    """
     if request.method == "GET":
         id_ditta = request.args.get("id_ditta")
         cognome = request.args.get("cognome")
         annullati = request.args.get("annullati")  # Parameter for filtered view
+        scadenza = request.args.get("scadenza")
 
-        fetch_dipendenti_data = None
+        page_size = pagination.parse_page_size(request.args.get("page_size"))
+        after = pagination.decode_cursor(request.args.get("after"))
+        before = pagination.decode_cursor(request.args.get("before"))
+
+        filters = {}
+        filter_sql = None
+        filter_params = ()
 
         if id_ditta is not None:
-            @fredbconn.connected_to_database
-            def func(cursor):
-                cursor.execute("""
-                SELECT 
-                    ditte.nome AS nome_ditta,
-                    dipendenti.nome AS nome_dipendente, 
-                    dipendenti.cognome,  
-                    dipendenti.is_badge_already_emesso, 
-                    dipendenti.accesso_bloccato,
-                    dipendenti.note,
-                    dipendenti.id,
-                    dipendenti.scadenza_autorizzazione,
-                    dipendenti.badge_sospeso,
-                    dipendenti.badge_annullato,
-                    dipendenti.is_badge_temporaneo,
-                    dipendenti.numero_badge,
-                    ruoli.nome_ruolo
-                FROM 
-                    dipendenti
-                JOIN 
-                    ditte
-                ON 
-                    dipendenti.ditta_id = ditte.id
-                LEFT JOIN
-                    ruoli
-                ON
-                    dipendenti.ruolo_id = ruoli.id
-                WHERE
-                    ditte.id = %s
-                ORDER BY
-                    dipendenti.cognome ASC
-                """, (id_ditta,))
-
-                return cursor.fetchall()
-            
-            fetch_dipendenti_data = func
+            filters["id_ditta"] = id_ditta
+            filter_sql = "ditte.id = %s"
+            filter_params = (id_ditta,)
 
         elif cognome is not None:
-            @fredbconn.connected_to_database
-            def func(cursor):
-                cursor.execute("""
-                SELECT 
-                    ditte.nome AS nome_ditta,
-                    dipendenti.nome AS nome_dipendente, 
-                    dipendenti.cognome,  
-                    dipendenti.is_badge_already_emesso, 
-                    dipendenti.accesso_bloccato,
-                    dipendenti.note,
-                    dipendenti.id,
-                    dipendenti.scadenza_autorizzazione,
-                    dipendenti.badge_sospeso,
-                    dipendenti.badge_annullato,
-                    dipendenti.is_badge_temporaneo,
-                    dipendenti.numero_badge,
-                    ruoli.nome_ruolo
-                FROM 
-                    dipendenti
-                JOIN 
-                    ditte
-                ON 
-                    dipendenti.ditta_id = ditte.id
-                LEFT JOIN
-                    ruoli
-                ON
-                    dipendenti.ruolo_id = ruoli.id
-                WHERE
-                    INSTR(LOWER(dipendenti.cognome), LOWER(%s)) > 0 
-                ORDER BY
-                    dipendenti.cognome ASC
-                """, (cognome,))
-
-                return cursor.fetchall()
-
-            fetch_dipendenti_data = func
-            
+            filters["cognome"] = cognome
+
         elif annullati is not None:
-            @fredbconn.connected_to_database
-            def func(cursor):
-                cursor.execute("""
-                SELECT 
-                    ditte.nome AS nome_ditta,
-                    dipendenti.nome AS nome_dipendente, 
-                    dipendenti.cognome,  
-                    dipendenti.is_badge_already_emesso, 
-                    dipendenti.accesso_bloccato,
-                    dipendenti.note,
-                    dipendenti.id,
-                    dipendenti.scadenza_autorizzazione,
-                    dipendenti.badge_sospeso,
-                    dipendenti.badge_annullato,
-                    dipendenti.is_badge_temporaneo,
-                    dipendenti.numero_badge,
-                    ruoli.nome_ruolo
-                FROM 
-                    dipendenti
-                JOIN 
-                    ditte
-                ON 
-                    dipendenti.ditta_id = ditte.id
-                LEFT JOIN
-                    ruoli
-                ON
-                    dipendenti.ruolo_id = ruoli.id
-                WHERE
-                    dipendenti.badge_annullato = 1
-                ORDER BY
-                    dipendenti.cognome ASC
-                """)
-
-                return cursor.fetchall()
-
-            fetch_dipendenti_data = func
-        
-        # Set fetched to an empty list when no filter is applied
-        fetched = [] if fetch_dipendenti_data is None else fetch_dipendenti_data()
+            filters["annullati"] = annullati
+            filter_sql = badge_state.CANCELLED_BADGE_SQL
+
+        elif scadenza is not None:
+            bucket = badge_expiry.bucket_filter(scadenza)
+            if bucket is not None:
+                filters["scadenza"] = scadenza
+                filter_sql, filter_params = bucket
+
+        def fetch_page():
+            """Returns the rows of the page, its cursors and whether they can be cached"""
+            if filter_sql is not None:
+                backwards = after is None and before is not None
+                key = after if after is not None else before
+
+                rows = fetch_dipendenti_page(filter_sql, filter_params, key, backwards, page_size)
+
+                # The decorator returns the error as a string, which must never be cached
+                if isinstance(rows, str):
+                    return [], None, None, False
+
+                return (*pagination.paginate(rows, page_size, backwards, key is not None,
+                                             lambda row: (row[2], row[6])), True)
+
+            if "cognome" in filters:
+                # The prefix matches first, then the substring ones, each tier paged in (cognome, id) order
+                backwards = after is None and before is not None
+                key = after if after is not None else before
+
+                ids = dipendenti_search.search_dipendenti_page(cognome, key, backwards, page_size + 1)
+                rows = fetch_dipendenti_by_ids(ids) if not isinstance(ids, str) else ids
+
+                # The decorators return the error as a string, which must never be cached
+                if isinstance(rows, str):
+                    return [], None, None, False
+
+                return (*pagination.paginate(rows, page_size, backwards, key is not None,
+                                             lambda row: (row[2], row[6])), True)
+
+            # No rows are shown when no filter is applied
+            return [], None, None, True
+
+        if request.args.get("format") == "json":
+            fetched, next_cursor, prev_cursor, _ = fetch_page()
+            return jsonify({
+                "dipendenti": [dipendente_row_to_json(row) for row in fetched],
+                "next": next_cursor,
+                "prev": prev_cursor
+            })
+
+        # The rows are rendered again only after a write, see fragment_cache. The day is in the key,
+        # the scadenza buckets move with it
+        fragment_key = fragment_cache.make_key(
+            "dipendenti",
+            dict(filters, page_size=page_size, after=request.args.get("after"),
+                 before=request.args.get("before"), giorno=date.today()),
+            ("dipendenti", "ditte", "ruoli"))
+        cached = fragment_cache.get(fragment_key)
+
+        if cached is not None:
+            righe, (next_cursor, prev_cursor) = cached
+        else:
+            fetched, next_cursor, prev_cursor, cacheable = fetch_page()
 
-        @fredbconn.connected_to_database
-        def fetch_ditte_names(cursor):
-            cursor.execute("""
-            SELECT id, nome
-            FROM ditte
-            ORDER BY nome ASC
-            """)
+            righe = Markup(render_template("partials/dipendenti_rows.html", dipendenti = fetched))
 
-            return cursor.fetchall()
-        
-        ditte = fetch_ditte_names()
+            if cacheable:
+                fragment_cache.put(fragment_key, righe, (next_cursor, prev_cursor))
 
-        return render_template("dipendenti.html", dipendenti = fetched, ditte = ditte)
+        def page_url(**cursor):
+            return url_for("show_dipendenti", **filters, page_size=page_size, **cursor)
+
+        ditte = reference_data.get_ditte()
+
+        return render_template(
+            "dipendenti.html", righe = righe, ditte = ditte,
+            fascia_scadenza = badge_expiry.bucket_label(scadenza) if "scadenza" in filters else None,
+            next_url = page_url(after=next_cursor) if next_cursor else None,
+            prev_url = page_url(before=prev_cursor) if prev_cursor else None,
+            next_json_url = page_url(after=next_cursor, format="json") if next_cursor else None)
+
+
+@app.route("/dipendenti/cerca")
+@fredauth.authorized("user")
+@http_cache.conditional_get("dipendenti", "ditte", "ruoli")
+def cerca_dipendenti():
+    """Search-as-you-type suggestions for the surname search, as JSON"""
+    query = request.args.get("q", "")
+    limit = min(pagination.parse_page_size(request.args.get("limit", 10)), 20)
+
+    return jsonify({
+        "risultati": [
+            {
+                "id": row[6],
+                "nome": row[1],
+                "cognome": row[2],
+                "nome_ditta": row[0],
+                "match": match
+            }
+            for row, match in search_dipendenti(query, limit)
+        ]
+    })
 
 
 @app.route("/aggiungi-dipendenti", methods=["GET", "POST"])
 @fredauth.authorized("admin")
 def aggiungi_dipendenti():
     if request.method == "GET":
-        @fredbconn.connected_to_database
-        def fetch_ditte(cursor):
-            cursor.execute("""
-            SELECT nome
-            FROM ditte
-            ORDER BY nome ASC
-            """)
-
-            fetched = cursor.fetchall()
-
-            ret = []
-
-            for row in fetched:
-                ret.append(row[0])
-            
-            return ret
-        
-        @fredbconn.connected_to_database
-        def fetch_ruoli(cursor):
-            cursor.execute("""
-            SELECT id, nome_ruolo
-            FROM ruoli
-            ORDER BY id ASC
-            """)
-            
-            return cursor.fetchall()
-        
-        ditte = fetch_ditte()
-        ruoli = fetch_ruoli()
+        ditte = reference_data.get_ditte_names()
+        ruoli = reference_data.get_ruoli()
         return render_template("aggiungi-dipendenti.html", ditte=ditte, ruoli=ruoli)
     
     if request.method == "POST":
@@ -902,6 +1017,12 @@ def aggiungi_dipendenti():
                     badge_sospeso, badge_annullato, is_badge_temporaneo, numero_badge,
                     ruolo_id
                 ))
+
+                # Read before the UPDATE of bump, which resets it
+                new_id = cursor.lastrowid
+
+                data_versions.bump(cursor, "dipendenti")
+                access_index.track_changes(cursor, ("dipendenti",), dipendenti_ids=(new_id,))
                 
             add_dipendente()
             flash("Dipendente aggiunto con successo", "success")
@@ -934,6 +1055,9 @@ def login():
             flash("Il suo account è stato disabilitato.", "error")
             return redirect("/login")
 
+        # Start the new session from fresh authorization flags
+        fredauth.invalidate_authorization(username, bump_version=False)
+
         session["user"] = username
         return redirect("/")
         
@@ -950,15 +1074,92 @@ def logout():
 @fredauth.authorized("user")
 def genera_report():
     
-    # Get the report as a BytesIO object
-    output = report_generator_completo.generate_report()
+    # Get the path of the report, generated only if ditte, dipendenti or ruoli changed since the last one
+    try:
+        path, etag = report_cache.get_report(
+            "completo", ("ditte", "dipendenti", "ruoli"), report_generator_completo.generate_report)
+    except RuntimeError as e:
+        logging.error(str(e))
+        flash("Errore durante la generazione del report", "error")
+        return redirect(request.referrer or "/")
     
-    # Send the in-memory file as an attachment
+    # Send the file as an attachment, answering 304 if the client already has this version
+    return send_file(
+        path,
+        as_attachment=True,
+        download_name="report.xlsx",
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        etag=etag,
+        conditional=True,
+        max_age=0)
+
+
+def report_job_to_json(job):
+    """Converts a job of report_jobs to the JSON polled by report.js"""
+    return {
+        "id": job["id"],
+        "stato": job["stato"],
+        "righe": job["righe"],
+        "totale": job["totale"],
+        "url_stato": url_for("stato_report", job_id=job["id"]),
+        "url_download": url_for("scarica_report", job_id=job["id"]) if job["stato"] == "completato" else None,
+    }
+
+
+@app.route('/genera-report', methods=["POST"])
+@fredauth.authorized("user")
+def avvia_report():
+    """Starts the export of the report in background and answers 202 with the job to poll"""
+    job_id = report_jobs.submit("completo", session["user"])
+
+    if job_id is None:
+        return jsonify({"error": "Impossibile avviare la generazione del report"}), 500
+
+    job = report_jobs.get_job(job_id)
+    if job is None or isinstance(job, str):
+        # Not committed yet in another transaction, the page polls it anyway
+        job = {"id": job_id, "stato": "in_coda", "righe": 0, "totale": None}
+
+    return jsonify(report_job_to_json(job)), 202
+
+
+@app.route('/genera-report/<job_id>')
+@fredauth.authorized("user")
+def stato_report(job_id):
+    """State and progress of an export, polled by report.js"""
+    job = report_jobs.get_job(job_id)
+
+    if isinstance(job, str):
+        return jsonify({"error": job}), 500
+    if job is None:
+        return jsonify({"error": "Report non trovato"}), 404
+
+    return jsonify(report_job_to_json(job)), 200
+
+
+@app.route('/genera-report/<job_id>/download')
+@fredauth.authorized("user")
+def scarica_report(job_id):
+    """Downloads the artifact of a completed export"""
+    job = report_jobs.get_job(job_id)
+
+    if job is None or isinstance(job, str) or job["stato"] != "completato":
+        flash("Il report non è disponibile, generarlo di nuovo", "error")
+        return redirect(request.referrer or url_for("index"))
+
+    # Evicted by report_cache meanwhile
+    if not os.path.exists(job["percorso"]):
+        flash("Il report è scaduto, generarlo di nuovo", "error")
+        return redirect(request.referrer or url_for("index"))
+
     return send_file(
-        output,
+        job["percorso"],
         as_attachment=True,
         download_name="report.xlsx",
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        etag=job["chiave"],
+        conditional=True,
+        max_age=0)
 
 
 @app.route('/checkbox-pressed', methods=["POST"])
@@ -1036,6 +1237,8 @@ def checkbox_pressed():
                             return redirect(request.referrer or url_for("/"))
                         
                         cursor.execute("UPDATE dipendenti SET accesso_bloccato = %s WHERE id = %s", (new_value, id))
+                        data_versions.bump(cursor, "dipendenti")
+                        access_index.track_changes(cursor, ("dipendenti",), dipendenti_ids=(id,))
                         return jsonify({
                             "success": "Accesso aggiornato con successo",
                             "newState": new_value
@@ -1064,6 +1267,8 @@ def checkbox_pressed():
                             return redirect(request.referrer or url_for("/"))
                         
                         cursor.execute("UPDATE dipendenti SET is_badge_already_emesso = %s WHERE id = %s", (new_value, id))
+                        data_versions.bump(cursor, "dipendenti")
+                        access_index.track_changes(cursor, ("dipendenti",), dipendenti_ids=(id,))
                         return jsonify({
                             "success": "Stato del badge aggiornato con successo",
                             "newState": new_value
@@ -1083,6 +1288,8 @@ def checkbox_pressed():
                             return redirect(request.referrer or url_for("/"))
                         
                         cursor.execute("UPDATE dipendenti SET badge_sospeso = %s WHERE id = %s", (new_value, id))
+                        data_versions.bump(cursor, "dipendenti")
+                        access_index.track_changes(cursor, ("dipendenti",), dipendenti_ids=(id,))
                         return jsonify({
                             "success": "Stato di sospensione del badge aggiornato con successo",
                             "newState": new_value
@@ -1102,6 +1309,8 @@ def checkbox_pressed():
                             return redirect(request.referrer or url_for("/"))
                         
                         cursor.execute("UPDATE dipendenti SET badge_annullato = %s WHERE id = %s", (new_value, id))
+                        data_versions.bump(cursor, "dipendenti")
+                        access_index.track_changes(cursor, ("dipendenti",), dipendenti_ids=(id,))
                         return jsonify({
                             "success": "Stato di annullamento del badge aggiornato con successo",
                             "newState": new_value
@@ -1129,6 +1338,8 @@ def checkbox_pressed():
                             return redirect(request.referrer or url_for("/"))
                         
                         cursor.execute("UPDATE ditte SET is_ditta_individuale = %s WHERE id = %s", (new_value, id))
+                        data_versions.bump(cursor, "ditte")
+                        access_index.track_changes(cursor, ("ditte",))
                         return jsonify({
                             "success": "Stato ditta individuale aggiornato con successo",
                             "newState": new_value
@@ -1149,9 +1360,404 @@ def checkbox_pressed():
             return redirect(request.referrer or url_for("/"))
 
 
-if __name__ == "__main__":
-    fredbconn.initialize_database(*passwords.database_config)
+# The checkboxes editable through /checkbox-pressed/batch: (type, field) -> (table, column, reserved to capo1 and capo2)
+CHECKBOX_FIELDS = {
+    ("dipendente", "accesso"): ("dipendenti", "accesso_bloccato", False),
+    ("dipendente", "badge"): ("dipendenti", "is_badge_already_emesso", True),
+    ("dipendente", "badge_sospeso"): ("dipendenti", "badge_sospeso", False),
+    ("dipendente", "badge_annullato"): ("dipendenti", "badge_annullato", False),
+    ("ditta", "ditta_individuale"): ("ditte", "is_ditta_individuale", False),
+}
+
+NOT_FOUND_MESSAGES = {
+    "dipendente": "Dipendente non trovato",
+    "ditta": "Ditta non trovata",
+}
+
+MAX_CHECKBOX_CHANGES = 500
+
+
+def parse_checkbox_change(change, can_edit_badge):
+    """Validates one change of a batch.
+
+    Returns:
+        tuple: ((table, column, id, value), None) if valid, (None, error message) otherwise
+    """
+    if not isinstance(change, dict):
+        return None, "Modifica non valida"
+
+    target = CHECKBOX_FIELDS.get((change.get("type"), change.get("field")))
+    if target is None:
+        return None, "Campo non riconosciuto"
+
+    table, column, reserved = target
+    if reserved and not can_edit_badge:
+        return None, "Non hai i permessi per modificare questo campo"
+
+    try:
+        id = int(change.get("id"))
+        value = int(change.get("clicked"))
+    except (TypeError, ValueError):
+        return None, "Campi richiesti mancanti"
+
+    if value not in (0, 1):
+        return None, "Il valore 'clicked' deve essere 0 o 1"
+
+    return (table, column, id, value), None
+
+
+@fredbconn.connected_to_database
+def apply_checkbox_changes(cursor, changes):
+    """Applies the validated changes in one transaction, with one conditional UPDATE per (column, value).
+
+    Args:
+        changes (dict): (table, column, id) -> new value, already coalesced
+
+    Returns:
+        set: the (table, id) pairs found, the other rows were deleted meanwhile
+    """
+    ids_by_table = {}
+    groups = {}
+    for (table, column, id), value in changes.items():
+        ids_by_table.setdefault(table, set()).add(id)
+        groups.setdefault((table, column, value), []).append(id)
+
+    # The rows are locked, so none can be deleted between the check and the update
+    found = set()
+    for table, ids in ids_by_table.items():
+        placeholders = ", ".join(["%s"] * len(ids))
+        cursor.execute(f"SELECT id FROM {table} WHERE id IN ({placeholders}) FOR UPDATE", tuple(sorted(ids)))
+        found.update((table, row[0]) for row in cursor.fetchall())
+
+    changed_tables = set()
+    for (table, column, value), ids in groups.items():
+        ids = [id for id in ids if (table, id) in found]
+        if not ids:
+            continue
+
+        placeholders = ", ".join(["%s"] * len(ids))
+        # Only the rows actually changing are written, <=> so that the NULL flags are written too
+        cursor.execute(f"""
+        UPDATE {table}
+        SET {column} = %s
+        WHERE id IN ({placeholders}) AND NOT ({column} <=> %s)
+        """, (value, *ids, value))
+        if cursor.rowcount:
+            changed_tables.add(table)
+
+    if changed_tables:
+        data_versions.bump(cursor, *sorted(changed_tables))
+        access_index.track_changes(cursor, tuple(sorted(changed_tables)), dipendenti_ids=[
+            id for table, id in found if table == "dipendenti"])
+
+    return found
+
+
+@app.route('/checkbox-pressed/batch', methods=["POST"])
+@fredauth.authorized("admin")
+def checkbox_pressed_batch():
+    """
+    Applies a list of checkbox changes at once, as sent by dipendenti.js.
+    Takes JSON data {"modifiche": [{"type", "id", "field", "clicked"}, ...]} and returns
+    {"risultati": [{"id", "type", "field", "newState"} or {..., "error"}, ...]}, in the same order.
+    """
+
+    # Kick out user from changing the checkboxes
+    if session["user"] == passwords.no_permessi_eliminare or session["user"] == "Pippo2":
+        return jsonify({"error": "Non hai i permessi per modificare questo campo"}), 403
+
+    data = request.get_json(silent=True)
+    changes = data.get("modifiche") if isinstance(data, dict) else None
+
+    if not isinstance(changes, list) or not changes:
+        return jsonify({"error": "Non sono stati ricevuti dati JSON"}), 400
+
+    if len(changes) > MAX_CHECKBOX_CHANGES:
+        return jsonify({"error": f"Troppe modifiche, massimo {MAX_CHECKBOX_CHANGES}"}), 400
+
+    can_edit_badge = session['user'] in (passwords.capo1, passwords.capo2)
+
+    parsed = [parse_checkbox_change(change, can_edit_badge) for change in changes]
+
+    # The last change of the same checkbox wins
+    valid = {}
+    for target, _ in parsed:
+        if target is not None:
+            table, column, id, value = target
+            valid[(table, column, id)] = value
+
+    found = set()
+    if valid:
+        found = apply_checkbox_changes(valid)
+        if isinstance(found, str):
+            return jsonify({"error": found}), 500
+
+    results = []
+    for change, (target, error) in zip(changes, parsed):
+        result = {
+            "id": change.get("id") if isinstance(change, dict) else None,
+            "type": change.get("type") if isinstance(change, dict) else None,
+            "field": change.get("field") if isinstance(change, dict) else None,
+        }
+
+        if target is None:
+            result["error"] = error
+        else:
+            table, column, id, _ = target
+            if (table, id) in found:
+                result["newState"] = valid[(table, column, id)]
+            else:
+                result["error"] = NOT_FOUND_MESSAGES[change["type"]]
+
+        results.append(result)
+
+    return jsonify({"risultati": results}), 200
+
+
+MAX_ACCESS_CHECKS = 1000
+
+
+def access_check_result(numero_badge=None, dipendente_id=None):
+    """Answers one access check from the in-memory index"""
+    may_enter, reason, badge = access_index.lookup(dipendente_id=dipendente_id, numero_badge=numero_badge)
+
+    result = {"accesso": may_enter, "motivo": reason}
+
+    if badge is not None:
+        result.update({
+            "id": badge.id,
+            "nome": badge.nome,
+            "cognome": badge.cognome,
+            "ditta": badge.nome_ditta,
+            "numero_badge": badge.numero_badge,
+            "scadenza_autorizzazione": badge.scadenza_autorizzazione.isoformat()
+                                       if badge.scadenza_autorizzazione else None,
+            "badge_temporaneo": badge.is_badge_temporaneo,
+        })
+
+    return result
+
+
+def parse_access_check(values):
+    """Returns the (numero_badge, dipendente_id) keys of one check, raises ValueError if neither is valid"""
+    numero_badge = values.get("numero_badge")
+    if numero_badge:
+        return str(numero_badge), None
+
+    dipendente_id = values.get("id")
+    if dipendente_id is None or dipendente_id == "":
+        raise ValueError("Specificare numero_badge o id")
+
+    try:
+        return None, int(dipendente_id)
+    except (TypeError, ValueError):
+        raise ValueError("L'id deve essere un numero")
+
+
+@app.route('/api/access-check', methods=["GET", "POST"])
+@fredauth.api_key_authorized(getattr(passwords, "access_check_api_keys", ()))
+def api_access_check():
+    """
+    Tells the gates whether a badge may enter now, from the in-memory index of access_index.
+    GET ?numero_badge=... or ?id=... checks one badge, POST {"richieste": [{"numero_badge"} or {"id"}, ...]}
+    checks many of them at once for the batch sync of the turnstiles, answering {"risultati": [...]} in order.
+    """
+    # The index is built by the first check, then kept fresh in background
+    if not access_index.ensure_started():
+        return jsonify({"error": "Indice dei badge non disponibile, riprovare più tardi"}), 503
+
+    if request.method == "GET":
+        try:
+            numero_badge, dipendente_id = parse_access_check(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        return jsonify(access_check_result(numero_badge, dipendente_id)), 200
+
+    data = request.get_json(silent=True)
+    checks = data.get("richieste") if isinstance(data, dict) else None
+
+    if not isinstance(checks, list):
+        return jsonify({"error": "Campo richiesto mancante: 'richieste'"}), 400
+
+    if len(checks) > MAX_ACCESS_CHECKS:
+        return jsonify({"error": f"Troppe richieste, massimo {MAX_ACCESS_CHECKS}"}), 400
+
+    results = []
+    for check in checks:
+        try:
+            if not isinstance(check, dict):
+                raise ValueError("Specificare numero_badge o id")
+            results.append(access_check_result(*parse_access_check(check)))
+        except ValueError as e:
+            results.append({"accesso": False, "error": str(e)})
+
+    return jsonify({"risultati": results}), 200
+
+
+MAX_ACCESS_EVENTS = 5000
+
+
+@app.route('/api/eventi-accesso', methods=["POST"])
+@fredauth.api_key_authorized(getattr(passwords, "access_check_api_keys", ()))
+def api_eventi_accesso():
+    """
+    Receives the gate events of the turnstiles: {"eventi": [{"numero_badge" or "id", "registrato_il",
+    "varco", "direzione", "esito"}, ...]}. The valid events are buffered and written in background,
+    the answer tells how many were accepted and the errors of the others, by position.
+    """
+    # The badges are resolved with the index of /api/access-check
+    if not access_index.ensure_started():
+        return jsonify({"error": "Indice dei badge non disponibile, riprovare più tardi"}), 503
+
+    data = request.get_json(silent=True)
+    events = data.get("eventi") if isinstance(data, dict) else None
+
+    if not isinstance(events, list):
+        return jsonify({"error": "Campo richiesto mancante: 'eventi'"}), 400
+
+    if len(events) > MAX_ACCESS_EVENTS:
+        return jsonify({"error": f"Troppi eventi, massimo {MAX_ACCESS_EVENTS}"}), 400
+
+    now = datetime.now()
+    rows = []
+    errors = []
+    for index, event in enumerate(events):
+        try:
+            if not isinstance(event, dict):
+                raise ValueError("Evento non valido")
+            rows.append(access_events.parse_event(event, now))
+        except ValueError as e:
+            errors.append({"indice": index, "error": str(e)})
+
+    # The whole request is refused when the buffer is full, so the turnstile sends it again later
+    if rows and not access_events.ingest(rows):
+        return jsonify({"error": "Troppi eventi in attesa di scrittura, riprovare più tardi"}), 503
+
+    return jsonify({"accettati": len(rows), "errori": errors}), 202
+
+
+@app.route('/api/presenze')
+@fredauth.authorized("user")
+def api_presenze():
+    """Who was on site on a day (?giorno=AAAA-MM-GG, today by default), with the headcounts per ditta"""
+    try:
+        giorno = date.fromisoformat(request.args["giorno"]) if request.args.get("giorno") else date.today()
+    except ValueError:
+        return jsonify({"error": "Data non valida, usare il formato AAAA-MM-GG"}), 400
+
+    # The unit of work of the request reads the three lists in one transaction
+    ditte = access_events.fetch_daily_headcounts(giorno)
+    orarie = access_events.fetch_hourly_headcounts(giorno)
+    presenti = access_events.fetch_present(giorno)
+
+    for result in (ditte, orarie, presenti):
+        if isinstance(result, str):
+            return jsonify({"error": result}), 500
+
+    return jsonify({
+        "giorno": giorno.isoformat(),
+        "ditte": [
+            {"ditta_id": ditta_id, "nome_ditta": nome_ditta, "persone": persone, "eventi": eventi}
+            for ditta_id, nome_ditta, persone, eventi in ditte
+        ],
+        "orarie": [
+            {"ora": ora.isoformat(), "ditta_id": ditta_id, "nome_ditta": nome_ditta, "persone": persone, "eventi": eventi}
+            for ora, ditta_id, nome_ditta, persone, eventi in orarie
+        ],
+        "dipendenti": [
+            {"id": id, "nome": nome, "cognome": cognome, "nome_ditta": nome_ditta,
+             "primo_evento": primo.isoformat(), "ultimo_evento": ultimo.isoformat()}
+            for id, nome, cognome, nome_ditta, primo, ultimo in presenti
+        ],
+    }), 200
+
+
+@app.route('/metrics')
+@fredauth.authorized("admin")
+def metrics():
+    """Latency, database time, template time and size of the responses of each page of this process.
+    ?formato=prometheus returns the totals in the Prometheus text format
+    """
+    if request.args.get("formato") == "prometheus":
+        return Response(request_metrics.prometheus(), mimetype="text/plain; version=0.0.4")
+
+    return render_template("metrics.html", metriche=request_metrics.snapshot(),
+                           pool=fredbconn.pool_stats(), frammenti=fragment_cache.stats(), pid=os.getpid())
+
+
+@app.route('/metrics/pool')
+@fredauth.authorized("admin")
+def metrics_pool():
+    """Metrics of the connection pool of this process: checkouts, wait and hold times, dead connections"""
+    stats = fredbconn.pool_stats()
+    if stats is None:
+        return jsonify({"error": "Pool non inizializzato"}), 503
+
+    return jsonify(dict(stats, pid=os.getpid())), 200
+
+
+PROFILING_ORDERS = ("totale_ms", "count", "max_ms", "p95_ms", "errori")
+
+
+@app.route('/admin/profiling', methods=["GET", "POST"])
+@fredauth.authorized("admin")
+def admin_profiling():
+    """
+    Profiling of the database calls of this process, see fredbconn.profiling.
+    GET returns the statements and functions by ?ordine= (totale_ms by default), POST {"attivo", "soglia_ms",
+    "explain_lente", "azzera"} switches it on or off at runtime and returns the new settings.
+    """
+    if request.method == "GET":
+        ordine = request.args.get("ordine", "totale_ms")
+        if ordine not in PROFILING_ORDERS:
+            return jsonify({"error": f"Ordine non valido, usare uno tra {', '.join(PROFILING_ORDERS)}"}), 400
 
+        return jsonify(dict(fredbconn.profiling.report(ordine), pid=os.getpid())), 200
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Non sono stati ricevuti dati JSON"}), 400
+
+    soglia_ms = data.get("soglia_ms")
+    if soglia_ms is not None and (not isinstance(soglia_ms, (int, float)) or soglia_ms < 0):
+        return jsonify({"error": "La soglia deve essere un numero di millisecondi"}), 400
+
+    fredbconn.profiling.set_enabled(data.get("attivo", fredbconn.profiling.is_enabled()),
+                                    soglia_ms, data.get("explain_lente"))
+    if data.get("azzera"):
+        fredbconn.profiling.reset()
+
+    return jsonify(dict(fredbconn.profiling.settings(), pid=os.getpid())), 200
+
+
+@fredbconn.connected_to_database
+def explain_profiled_statement(cursor, fingerprint):
+    return fredbconn.profiling.explain(cursor, fingerprint)
+
+
+@app.route('/admin/profiling/explain', methods=["POST"])
+@fredauth.authorized("admin")
+def admin_profiling_explain():
+    """Runs the EXPLAIN of the last slow sample of a statement, {"fingerprint": ...} as in GET /admin/profiling"""
+    data = request.get_json(silent=True)
+    fingerprint = data.get("fingerprint") if isinstance(data, dict) else None
+    if not isinstance(fingerprint, str):
+        return jsonify({"error": "Campo richiesto mancante: 'fingerprint'"}), 400
+
+    rows = explain_profiled_statement(fingerprint)
+
+    # The decorator returns the error as a string
+    if isinstance(rows, str):
+        return jsonify({"error": rows}), 500
+
+    if rows is None:
+        return jsonify({"error": "Nessuna esecuzione lenta di questa query da analizzare"}), 404
+
+    return jsonify({"fingerprint": fingerprint, "explain": rows}), 200
+
+
+if __name__ == "__main__":
     class CrashLogger:
         def __init__(self, log_dir=None):
             # Set default log directory if none provided
@@ -1215,5 +1821,9 @@ if __name__ == "__main__":
 
     oauth_routes.init_oauth_routes(app, passwords.email_config)
 
-    serve(app, host='0.0.0.0', port=16000)
+    # Opens the pool in each worker, then the periodic jobs run in the first one unless they run in
+    # their own daemon, see serving.py and scheduler.py
+    serving.run(app, passwords.database_config,
+                getattr(passwords, "server_config", {}),
+                getattr(passwords, "scheduler_config", {}))
     # app.run(host="127.0.0.1", port="5000", debug=True)
\ No newline at end of file
@@ -0,0 +1,235 @@
+"""Serves the Flask app with Waitress, tuned by passwords.server_config, in one or more processes.
+
+Every request holds one pooled connection for its whole unit of work (see fredbconn.init_app), so a
+Waitress thread count above the maxconnections of the pool leaves requests blocked in
+pool.connection(). The settings are checked against database_config before serving: more threads
+than connections is refused, too few connections left for the background threads is logged.
+
+With workers > 1 the listening socket is bound once and shared by that many forked processes, each
+with its own pool and its own Waitress threads, so MySQL must allow workers * maxconnections
+connections. Nothing touches the database before the fork: every worker opens its pool, and the
+scheduler runs in the first worker only. The other background threads (access_index, access_events,
+report_jobs) already start on first use, in the worker serving the request. A worker that dies is
+started again by the parent. Forking needs os.fork, elsewhere the server runs in one process.
+
+Example of passwords.py:
+    server_config = {
+        'port': 16000,
+        'threads': 8,
+        'workers': 1,
+        'connection_limit': 100,
+        'backlog': 1024,
+        'channel_timeout': 120
+    }
+"""
+
+import atexit
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from waitress import serve
+
+try:
+    # First attempt direct import (works when running server.py)
+    import fredbconn
+    import report_jobs
+    import scheduler
+except ImportError:
+    # Fall back to package import (works when running the scripts from the root)
+    from python import fredbconn
+    from python import report_jobs
+    from python import scheduler
+
+logger = logging.getLogger("Serving")
+
+DEFAULT_CONFIG = {
+    "host": "0.0.0.0",
+    "port": 16000,
+    "workers": 1,
+    "threads": 4,               # Waitress default
+    "connection_limit": 100,    # Waitress default
+    "backlog": 1024,            # Waitress default
+    "channel_timeout": 120,     # Waitress default
+}
+
+# Threads of a worker holding a connection outside of the requests: the access_index refresher
+# and the access_events writer, plus the report_jobs pool and the scheduler
+BACKGROUND_THREADS = 2
+
+# A worker dying sooner than this after its start is restarted after a pause, not in a loop
+MIN_WORKER_SECONDS = 5
+
+
+def load_config(server_config=None):
+    """Returns passwords.server_config completed with DEFAULT_CONFIG, raises ValueError on an unknown key"""
+    unknown = set(server_config or {}) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError(f"Unknown settings in server_config: {', '.join(sorted(unknown))}")
+
+    config = dict(DEFAULT_CONFIG, **(server_config or {}))
+
+    for name in ("workers", "threads", "connection_limit", "backlog", "channel_timeout"):
+        if not isinstance(config[name], int) or config[name] < 1:
+            raise ValueError(f"server_config['{name}'] must be a positive integer")
+
+    return config
+
+
+def background_connections(run_scheduler):
+    """Returns how many connections the background threads of a worker may hold at once"""
+    return BACKGROUND_THREADS + report_jobs.worker_count() + (1 if run_scheduler else 0)
+
+
+def validate(config, database_config, run_scheduler=False):
+    """Checks the threads of a worker against its pool, see database_config in passwords.py.
+
+    Raises:
+        ValueError: if the threads are more than the connections of the pool
+    """
+    max_connections, _, max_cached = database_config[:3]
+    threads = config["threads"]
+
+    # 0 means no limit for PooledDB, nothing to check
+    if max_connections:
+        if threads > max_connections:
+            raise ValueError(
+                f"server_config['threads'] is {threads} but the pool of database_config has "
+                f"{max_connections} connections: the requests would wait in pool.connection()"
+            )
+
+        needed = threads + background_connections(run_scheduler)
+        if needed > max_connections:
+            logger.warning(f"The pool has {max_connections} connections for {threads} threads and "
+                           f"up to {needed - threads} background threads, raise it to {needed}")
+
+    # The connections above maxcached are closed when given back, and opened again at the next request
+    if max_cached and max_cached < threads:
+        logger.warning(f"The pool caches {max_cached} connections for {threads} threads")
+
+    if config["connection_limit"] < threads:
+        logger.warning(f"server_config['connection_limit'] is lower than the threads, "
+                       f"{threads - config['connection_limit']} threads are never used")
+
+
+def _serve_worker(app, number, config, database_config, scheduler_config, sockets=None):
+    """Opens the pool and the background threads of this process, then serves until stopped"""
+    fredbconn.initialize_database(*database_config)
+
+    # One scheduler for all the workers, the named locks of scheduler.py would also keep a second
+    # one from running a job twice
+    if number == 0 and scheduler_config.get("run_in_server"):
+        scheduler.start_scheduler(**scheduler_config)
+
+    settings = {name: config[name] for name in ("threads", "connection_limit", "backlog", "channel_timeout")}
+    if sockets is None:
+        serve(app, host=config["host"], port=config["port"], **settings)
+    else:
+        serve(app, sockets=sockets, **settings)
+
+
+def run(app, database_config, server_config=None, scheduler_config=None):
+    """Serves the app, in config['workers'] processes. Returns when the server is stopped"""
+    config = load_config(server_config)
+    scheduler_config = scheduler_config or {}
+    run_scheduler = bool(scheduler_config.get("run_in_server"))
+
+    validate(config, database_config, run_scheduler)
+
+    workers = config["workers"]
+    if workers > 1 and not hasattr(os, "fork"):
+        logger.warning(f"server_config['workers'] is {workers} but this system can't fork, serving in one process")
+        workers = 1
+
+    if workers == 1:
+        _serve_worker(app, 0, config, database_config, scheduler_config)
+        return
+
+    if database_config[0]:
+        logger.info(f"{workers} workers with up to {database_config[0]} connections each, "
+                    f"MySQL max_connections must allow {workers * database_config[0]}")
+
+    _Supervisor(app, workers, config, database_config, scheduler_config).run()
+
+
+class _Supervisor:
+    """Parent process forking the workers on one listening socket and starting them again when they die"""
+    def __init__(self, app, workers, config, database_config, scheduler_config):
+        self.app = app
+        self.workers = workers
+        self.config = config
+        self.database_config = database_config
+        self.scheduler_config = scheduler_config
+        self.children = {}  # pid -> (worker number, start time)
+        self.stopping = False
+
+    def _bind(self):
+        sock = socket.socket(socket.AF_INET6 if ":" in self.config["host"] else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.config["host"], self.config["port"]))
+        sock.listen(self.config["backlog"])
+        return sock
+
+    def _spawn(self, number):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (number, time.monotonic())
+            return
+
+        # In the worker: it never returns into the loop of the parent
+        code = 1
+        try:
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            _serve_worker(self.app, number, self.config, self.database_config, self.scheduler_config,
+                          sockets=[self.sock])
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 0
+        except BaseException:
+            logger.exception(f"Worker {number} crashed")
+        finally:
+            # os._exit skips atexit, the worker still flushes its buffers, e.g. access_events
+            atexit._run_exitfuncs()
+            logging.shutdown()
+            os._exit(code)
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self):
+        self.sock = self._bind()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        for number in range(self.workers):
+            self._spawn(number)
+        logger.info(f"Serving on {self.config['host']}:{self.config['port']} with {self.workers} workers")
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+
+            number, started = self.children.pop(pid, (None, None))
+            if number is None or self.stopping:
+                continue
+
+            logger.error(f"Worker {number} (pid {pid}) exited with status {status}, starting it again")
+            if time.monotonic() - started < MIN_WORKER_SECONDS:
+                time.sleep(MIN_WORKER_SECONDS)
+            if not self.stopping:
+                self._spawn(number)
+
+        self.sock.close()
\ No newline at end of file
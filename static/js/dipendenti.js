@@ -86,6 +86,49 @@ document.addEventListener("DOMContentLoaded", function () {
 
     searchButton.addEventListener("click", handleSearch);
 
+    // Search-as-you-type suggestions, debounced so that only the last keystroke queries the server
+    const suggestions = document.getElementById("search-by-cognome-suggestions");
+    let suggestionsTimer = null;
+    let suggestionsRequest = 0;
+
+    searchInput.addEventListener("input", function () {
+        clearTimeout(suggestionsTimer);
+
+        suggestionsTimer = setTimeout(function () {
+            const query = searchInput.value.trim();
+            const requestNumber = ++suggestionsRequest;
+
+            if (!query) {
+                suggestions.innerHTML = "";
+                return;
+            }
+
+            fetch(`/dipendenti/cerca?q=${encodeURIComponent(query)}`, {
+                credentials: 'same-origin',
+                headers: { 'X-Requested-With': 'XMLHttpRequest' }
+            })
+                .then(response => response.ok ? response.json() : { risultati: [] })
+                .then(data => {
+                    // Ignore the answers arriving after a newer request
+                    if (requestNumber !== suggestionsRequest) {
+                        return;
+                    }
+
+                    suggestions.innerHTML = "";
+
+                    data.risultati.forEach(risultato => {
+                        const button = document.createElement("button");
+                        button.textContent = `${risultato.cognome} ${risultato.nome} (${risultato.nome_ditta})`;
+                        button.addEventListener("click", function () {
+                            window.location.href = `/dipendenti?cognome=${encodeURIComponent(risultato.cognome)}`;
+                        });
+                        suggestions.appendChild(button);
+                    });
+                })
+                .catch(error => console.error(error));
+        }, 200);
+    });
+
     // Allow "Enter" key to trigger search
     searchInput.addEventListener("keydown", function (event) {
         if (event.key === "Enter") {
@@ -101,8 +144,15 @@ document.addEventListener("DOMContentLoaded", function () {
     });
 });
 
+// Checkbox changes waiting to be sent, by "type:id:field"
+const pendingCheckboxChanges = new Map();
+let checkboxFlushTimer = null;
+
+// Clicks closer than this are sent together to /checkbox-pressed/batch
+const CHECKBOX_BATCH_DELAY = 400;
+
 /**
- * Handle button click for toggling state and send updates to the server
+ * Handle button click for toggling state, the changes are sent in batches by flushCheckboxChanges
  * 
  * @param {HTMLElement} buttonElement - The button element that was clicked
  * @param {string} entityId - The ID of the entity to update
@@ -122,80 +172,299 @@ function handleCheckboxClick(buttonElement, entityId, fieldName) {
     // Determine the current state by checking if the button contains a checkmark
     const currentStateHasCheckmark = buttonElement.innerHTML.includes('✅');
     const newState = currentStateHasCheckmark ? 0 : 1;
+
+    const key = `${entityType}:${entityId}:${fieldName}`;
+    const pending = pendingCheckboxChanges.get(key);
+
+    if (pending && pending.originalContent.includes('✅') === (newState === 1)) {
+        // Clicked back to the saved state before sending, there is nothing to send
+        pendingCheckboxChanges.delete(key);
+        buttonElement.innerHTML = pending.originalContent;
+        buttonElement.classList.remove('pending');
+    } else {
+        pendingCheckboxChanges.set(key, {
+            button: buttonElement,
+            originalContent: pending ? pending.originalContent : buttonElement.innerHTML,
+            change: {
+                type: entityType,
+                id: entityId,
+                field: fieldName,
+                clicked: newState
+            }
+        });
+
+        // Show the new state right away, it is confirmed or reverted by the server answer
+        buttonElement.innerHTML = newState === 1 ? ' ✅ ' : ' ❌ ';
+        buttonElement.classList.add('pending');
+    }
+
+    // Debounce, so that a burst of clicks makes a single request
+    clearTimeout(checkboxFlushTimer);
+    checkboxFlushTimer = setTimeout(flushCheckboxChanges, CHECKBOX_BATCH_DELAY);
+}
+
+/**
+ * Reads the answer of a checkbox request, turning the HTML pages of the login and
+ * authorization redirects into errors
+ *
+ * @param {Response} response - The fetch response
+ * @returns {Promise<Object>} The JSON data of the answer
+ */
+function readCheckboxResponse(response) {
+    const contentType = response.headers.get('content-type');
     
-    // Create the request data
-    const requestData = {
-        type: entityType,
-        id: entityId,
-        field: fieldName,
-        clicked: newState
-    };
+    // If it's JSON, process normally
+    if (contentType && contentType.includes('application/json')) {
+        return response.json().then(data => {
+            if (!response.ok) {
+                throw new Error(data.error || 'Errore nella risposta del server');
+            }
+            return data;
+        });
+    } 
     
+    // If it's HTML, check for specific error patterns
+    return response.text().then(html => {
+        if (html.includes("Il suo account non dispone delle autorizzazioni necessarie")) {
+            throw new Error('Non hai i permessi necessari per questa operazione');
+        } else if (html.includes("Il suo account è stato disabilitato")) {
+            throw new Error('Account disabilitato. Contatta l\'amministratore');
+        } else if (html.includes("Sessione scaduta") || html.includes("login")) {
+            throw new Error('Sessione scaduta. Effettua nuovamente il login');
+        } else {
+            throw new Error('Operazione non riuscita. Ricarica la pagina e riprova');
+        }
+    });
+}
+
+/**
+ * Sends the pending checkbox changes in one request and applies the result of each of them
+ *
+ * @param {boolean} keepalive - Let the request outlive the page, used when leaving it
+ */
+function flushCheckboxChanges(keepalive = false) {
+    clearTimeout(checkboxFlushTimer);
+
+    if (pendingCheckboxChanges.size === 0) {
+        return;
+    }
+
+    const batch = Array.from(pendingCheckboxChanges.values());
+    pendingCheckboxChanges.clear();
+
     // Show loading state
-    const originalContent = buttonElement.innerHTML;
-    buttonElement.innerHTML = ' ⟳ ';
-    buttonElement.classList.add('rotating');
-    buttonElement.disabled = true;
+    batch.forEach(pending => {
+        pending.button.innerHTML = ' ⟳ ';
+        pending.button.classList.remove('pending');
+        pending.button.classList.add('rotating');
+        pending.button.disabled = true;
+    });
     
     // Send the request to the server
-    fetch('/checkbox-pressed', {
+    fetch('/checkbox-pressed/batch', {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json',
             'X-Requested-With': 'XMLHttpRequest'
         },
-        body: JSON.stringify(requestData),
-        credentials: 'same-origin'
+        body: JSON.stringify({ modifiche: batch.map(pending => pending.change) }),
+        credentials: 'same-origin',
+        keepalive: keepalive
     })
-    .then(response => {
-        const contentType = response.headers.get('content-type');
-        
-        // If it's JSON, process normally
-        if (contentType && contentType.includes('application/json')) {
-            return response.json().then(data => {
-                if (!response.ok) {
-                    throw new Error(data.error || 'Errore nella risposta del server');
-                }
-                return data;
-            });
-        } 
-        
-        // If it's HTML, check for specific error patterns
-        return response.text().then(html => {
-            if (html.includes("Il suo account non dispone delle autorizzazioni necessarie")) {
-                throw new Error('Non hai i permessi necessari per questa operazione');
-            } else if (html.includes("Il suo account è stato disabilitato")) {
-                throw new Error('Account disabilitato. Contatta l\'amministratore');
-            } else if (html.includes("Sessione scaduta") || html.includes("login")) {
-                throw new Error('Sessione scaduta. Effettua nuovamente il login');
+    .then(readCheckboxResponse)
+    .then(data => {
+        const errors = new Set();
+        let failed = 0;
+
+        // The results come in the order of the changes
+        batch.forEach((pending, index) => {
+            const risultato = data.risultati[index];
+
+            if (!risultato || risultato.error) {
+                // On error, revert to original content
+                pending.button.innerHTML = pending.originalContent;
+                errors.add(risultato ? risultato.error : 'Errore nella risposta del server');
+                failed++;
             } else {
-                throw new Error('Operazione non riuscita. Ricarica la pagina e riprova');
+                pending.button.innerHTML = risultato.newState === 1 ? ' ✅ ' : ' ❌ ';
             }
         });
-    })
-    .then(data => {
-        // Success handling
-        console.log('Aggiornamento completato:', data.success);
-        
-        // Update the UI based on the new state
-        if (newState === 1) {
-            buttonElement.innerHTML = ' ✅ ';
-        } else {
-            buttonElement.innerHTML = ' ❌ ';
+
+        console.log(`Aggiornamento completato: ${batch.length - failed} modifiche`);
+
+        // Show error messages to user, once each
+        if (errors.size > 0) {
+            alert(Array.from(errors).join('\n'));
         }
     })
     .catch(error => {
         console.error('Errore durante l\'aggiornamento:', error);
         
         // On error, revert to original content
-        buttonElement.innerHTML = originalContent;
+        batch.forEach(pending => {
+            pending.button.innerHTML = pending.originalContent;
+        });
         
         // Show error message to user
         alert(error.message);
     })
     .finally(() => {
-        // Re-enable the button and remove rotation
-        buttonElement.disabled = false;
-        buttonElement.classList.remove('rotating');
+        // Re-enable the buttons and remove rotation
+        batch.forEach(pending => {
+            pending.button.disabled = false;
+            pending.button.classList.remove('rotating');
+        });
     });
-}
\ No newline at end of file
+}
+
+// Sends the changes still waiting when leaving the page
+window.addEventListener('pagehide', () => flushCheckboxChanges(true));
+
+/**
+ * Builds a table row for a dipendente received from /dipendenti?format=json,
+ * with the same markup rendered by dipendenti.html
+ *
+ * @param {Object} dipendente - The dipendente as returned by the JSON listing
+ * @returns {HTMLTableRowElement} The row to append to the table body
+ */
+function buildDipendenteRow(dipendente) {
+    const row = document.createElement('tr');
+
+    function addTextCell(value) {
+        const cell = document.createElement('td');
+        cell.textContent = value ?? "";
+        row.appendChild(cell);
+    }
+
+    function addCheckboxCell(value, fieldName) {
+        const cell = document.createElement('td');
+        const button = document.createElement('button');
+        button.className = 'checkbox-button';
+        button.textContent = value === 1 ? ' ✅ ' : ' ❌ ';
+
+        if (fieldName) {
+            button.addEventListener('click', () => handleCheckboxClick(button, dipendente.id, fieldName));
+        } else {
+            button.classList.add('read-only');
+            button.disabled = true;
+        }
+
+        cell.appendChild(button);
+        row.appendChild(cell);
+    }
+
+    addTextCell(dipendente.id);
+    addTextCell(dipendente.nome_ditta);
+    addTextCell(dipendente.nome_dipendente);
+    addTextCell(dipendente.cognome);
+    addTextCell(dipendente.nome_ruolo);
+    addTextCell(dipendente.scadenza_autorizzazione);
+    addCheckboxCell(dipendente.is_badge_already_emesso, 'badge');
+    addCheckboxCell(dipendente.accesso_bloccato, 'accesso');
+    addCheckboxCell(dipendente.badge_sospeso, 'badge_sospeso');
+    addCheckboxCell(dipendente.badge_annullato, 'badge_annullato');
+    addCheckboxCell(dipendente.is_badge_temporaneo, null);
+    addTextCell(dipendente.numero_badge);
+    addTextCell(dipendente.note);
+
+    const actions = document.createElement('td');
+    actions.className = 'action-buttons';
+
+    const form = document.createElement('form');
+    form.id = 'form-elimina-dipendente';
+    form.action = '/elimina-dipendente';
+    form.method = 'POST';
+    form.innerHTML = '<button type="submit" class="btn btn-danger">Elimina</button>';
+
+    const idInput = document.createElement('input');
+    idInput.type = 'hidden';
+    idInput.name = 'id';
+    idInput.value = dipendente.id;
+    form.appendChild(idInput);
+
+    form.addEventListener('submit', function (e) {
+        e.preventDefault();
+        if (confirm('Sei sicuro di voler eliminare questo dipendente?')) {
+            this.submit();
+        }
+    });
+
+    const updateButton = document.createElement('button');
+    updateButton.className = 'btn btn-primary';
+    updateButton.textContent = 'Aggiorna';
+    updateButton.addEventListener('click', () => confirmAction('aggiorna', dipendente.id));
+
+    actions.appendChild(form);
+    actions.appendChild(updateButton);
+    row.appendChild(actions);
+
+    return row;
+}
+
+// Loads the next pages while scrolling, falling back to the pagination links without IntersectionObserver
+document.addEventListener("DOMContentLoaded", function () {
+    const pagination = document.getElementById("paginazione");
+    const tableBody = document.querySelector("table tbody");
+
+    if (!pagination || !tableBody || !("IntersectionObserver" in window)) {
+        return;
+    }
+
+    let nextJsonUrl = pagination.dataset.nextJsonUrl;
+    let loading = false;
+
+    if (!nextJsonUrl) {
+        return;
+    }
+
+    // The rows are appended in place, so only the link to the previous page stays meaningful
+    const nextLink = document.getElementById("pagina-successiva");
+    if (nextLink) {
+        nextLink.style.display = 'none';
+    }
+
+    const observer = new IntersectionObserver(entries => {
+        if (!entries.some(entry => entry.isIntersecting) || loading || !nextJsonUrl) {
+            return;
+        }
+
+        loading = true;
+
+        fetch(nextJsonUrl, { credentials: 'same-origin', headers: { 'X-Requested-With': 'XMLHttpRequest' } })
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error('Errore nel caricamento dei dipendenti');
+                }
+                return response.json();
+            })
+            .then(data => {
+                data.dipendenti.forEach(dipendente => tableBody.appendChild(buildDipendenteRow(dipendente)));
+
+                if (data.next) {
+                    const url = new URL(nextJsonUrl, window.location.origin);
+                    url.searchParams.set('after', data.next);
+                    nextJsonUrl = url.toString();
+
+                    // Observe again, so a short page still visible on screen triggers the next load
+                    observer.unobserve(pagination);
+                    observer.observe(pagination);
+                } else {
+                    nextJsonUrl = null;
+                    observer.disconnect();
+                }
+            })
+            .catch(error => {
+                console.error(error);
+                nextJsonUrl = null;
+                observer.disconnect();
+                if (nextLink) {
+                    nextLink.style.display = '';
+                }
+            })
+            .finally(() => {
+                loading = false;
+            });
+    });
+
+    observer.observe(pagination);
+});
\ No newline at end of file
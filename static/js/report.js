@@ -0,0 +1,96 @@
+/**
+ * Generates the report in background: the Report button of the navbar starts an export job,
+ * shows its progress and downloads the file once ready, so the pages stay usable meanwhile.
+ * Without JavaScript the link still downloads the report directly.
+ */
+document.addEventListener("DOMContentLoaded", function () {
+    const link = document.getElementById("genera-report-link");
+    if (!link) {
+        return;
+    }
+
+    const button = link.querySelector("button");
+    const originalText = button.textContent;
+    let running = false;
+
+    // How often the state of the job is asked
+    const POLL_INTERVAL = 1000;
+
+    function showProgress(job) {
+        if (job.totale) {
+            const percent = Math.min(99, Math.floor(job.righe * 100 / job.totale));
+            button.textContent = `Report ${percent}%`;
+        } else {
+            button.textContent = 'Report ⟳';
+        }
+    }
+
+    function finish() {
+        running = false;
+        button.textContent = originalText;
+        button.disabled = false;
+    }
+
+    function readJob(response) {
+        if (!response.ok || !(response.headers.get('content-type') || '').includes('application/json')) {
+            throw new Error('Impossibile generare il report');
+        }
+        return response.json();
+    }
+
+    function follow(job) {
+        if (job.stato === 'completato') {
+            window.location.href = job.url_download;
+            finish();
+            return;
+        }
+
+        if (job.stato === 'fallito') {
+            alert('La generazione del report non è riuscita, riprovare');
+            finish();
+            return;
+        }
+
+        showProgress(job);
+
+        setTimeout(function () {
+            fetch(job.url_stato, {
+                credentials: 'same-origin',
+                headers: { 'X-Requested-With': 'XMLHttpRequest' }
+            })
+                .then(readJob)
+                .then(follow)
+                .catch(error => {
+                    console.error(error);
+                    alert(error.message);
+                    finish();
+                });
+        }, POLL_INTERVAL);
+    }
+
+    link.addEventListener("click", function (event) {
+        event.preventDefault();
+
+        if (running) {
+            return;
+        }
+
+        running = true;
+        button.disabled = true;
+        button.textContent = 'Report ⟳';
+
+        fetch(link.href, {
+            method: 'POST',
+            credentials: 'same-origin',
+            headers: { 'X-Requested-With': 'XMLHttpRequest' }
+        })
+            .then(readJob)
+            .then(follow)
+            .catch(error => {
+                // E.g. the jobs table is missing, the direct download still works
+                console.error(error);
+                finish();
+                window.location.href = link.href;
+            });
+    });
+});
\ No newline at end of file